@@ -1,10 +1,72 @@
+import hashlib
+import json
+import math
+import os
+import sys
 from collections import namedtuple
+from contextlib import contextmanager
 from functools import lru_cache
+from pathlib import Path
 
+import numpy as np
 from neuron import h
 
+from src.instrument import stage, staged
+
 pvParams = namedtuple(
     "pvParams", "target_myelinated_L node_spacing node_length ais_L")
+BiophysSnapshot = namedtuple("BiophysSnapshot", "ptrs values ra")
+# pointers to a parameter of every segment (`ptrs`) and of the middle segment of every section (`mid_ptrs`) that has it,
+# the number of segments of those sections, and the names of sections of the section list without the parameter
+_IndexEntry = namedtuple("_IndexEntry", "ptrs mid_ptrs n_segs missing")
+
+GEOMETRY_CACHE_DIR = Path(".cache") / "geometry"
+# distance-dependent values of basal sections (see `init` in PV_template.hoc)
+#   value = (-0.8696 + 2.087*exp(distance*0.0031))*scale
+DISTANCE_PARAMS = {
+    "gImbar_Im": 4.9053963032026885e-07,
+    "gIhbar_Ih": 4.3100495575754699e-05,
+}
+_SECTION_ARRAYS = ("soma", "dend", "apic", "axon", "myelin", "node")
+_SECTION_LISTS = ("all", "somatic", "apical", "ais", "axonal", "basal", "myelinated", "nodes")
+# path of the compiled mechanisms for `get_mechanisms_path`, if not built in this directory (see README)
+MECHANISMS_ENV = "PV_MECHANISMS"
+
+
+def get_mechanisms_path():
+    """Path of the compiled mechanisms to pass to `init_nrn` (e.g. by the module checks): that in the `MECHANISMS_ENV`
+    environment variable, or that built by `nrnivmodl mechanisms` in this directory"""
+    if os.environ.get(MECHANISMS_ENV):
+        return os.environ[MECHANISMS_ENV]
+    return "nrnmech.dll" if sys.platform == "win32" else str(Path("x86_64") / ".libs" / "libnrnmech.so")
+
+
+def _mechanisms_loaded():
+    # (by `init_nrn`, or by NEURON itself from the "x86_64" directory of the working directory)
+    mech_type = h.MechanismType(0)
+    mech_name = h.ref("")
+    for i in range(int(mech_type.count())):
+        mech_type.select(i)
+        mech_type.selected(mech_name)
+        if mech_name[0] == "Nav11":
+            return True
+    return False
+
+
+def init_nrn(mechanisms=None, celsius=34, v_init=-80):
+    """Load compiled mechanisms (if a path is given), the PV templates, and global simulation values.
+
+    Default values are as per the optimisation by BBP. Call once per process (e.g. per sweep worker). Mechanisms are
+    only loaded once per process (loading them twice is an error), and not if NEURON already loaded them (see
+    `get_mechanisms_path`).
+    """
+    if mechanisms is not None and not _mechanisms_loaded():
+        h.nrn_load_dll(str(mechanisms))
+    h.load_file("stdrun.hoc")
+    h.load_file("PV_template_orig.hoc")
+    h.load_file("PV_template.hoc")
+    h.celsius = celsius
+    h.v_init = v_init
 
 
 @lru_cache()
@@ -13,13 +75,16 @@ def get_pv(name="default", target_myelinated_L=1000., node_spacing=30., node_len
 
     Note that this function is cached to reduce the number of neurons created by repeated calls.
 
+    The geometry is cached on disk (see `build_pv`).
+
+    Cells from different calls exist side by side and are all simulated by a run. Under (global) CVODE they would
+    share time steps, so runs default to a local time step while there is more than one cell (see `get_solver` in
+    `src.run`).
     """
     try:
         if "orig" in name:
             pv = h.pv_orig('morphologies', 'C210401C.asc')
-        pv = h.pv('morphologies', 'C210401C.asc',
-                  target_myelinated_L, node_spacing, node_length, ais_L)
-        pv.name = f"{name}({target_myelinated_L}, {node_spacing}, {node_length}, {ais_L})"
+        pv = build_pv(name, target_myelinated_L, node_spacing, node_length, ais_L)
     except AttributeError:
         h.load_file("PV_template_orig.hoc")
         h.load_file("PV_template.hoc")
@@ -52,6 +117,14 @@ def reset_biophys(pv, display=False):
     return base_nav
 
 
+def reset_biophys_pulse(pv, **kwargs):
+    """As `reset_biophys`, but with less dependence on (somatic) transient Na (which was quite high in the original model)"""
+    base_nav = reset_biophys(pv, **kwargs)
+    base_gNaT = pv.soma[0].gNaTs2_tbar_NaTs2_t
+    get_segment_index(pv).set("gNaTs2_tbar_NaTs2_t", base_gNaT*0.01, "somatic")
+    return base_nav
+
+
 def reset_biophys_alt1(pv):
     pv.biophys()
 
@@ -67,18 +140,15 @@ def reset_biophys_alt1(pv):
 
     print(f"{nav_ais:.2f} | {kv3_ais:.2f} | {nav_nodes:.2f} | {kv3_nodes:.2f}")
 
-    for sec in pv.somatic:
-        sec.gNaTs2_tbar_NaTs2_t = 0.95585841724208476
-        sec.gNav11bar_Nav11 = 0.11504623309972959
-        sec.gSKv3_1bar_SKv3_1 = 0.18497365407533689
-
-    for sec in pv.ais:
-        sec.gNav11bar_Nav11 = nav_ais
-        sec.gSKv3_1bar_SKv3_1 = kv3_ais
-
-    for sec in pv.nodes:
-        sec.gNav11bar_Nav11 = nav_nodes
-        sec.gSKv3_1bar_SKv3_1 = kv3_nodes
+    get_segment_index(pv).apply({
+        ("gNaTs2_tbar_NaTs2_t", "somatic"): 0.95585841724208476,
+        ("gNav11bar_Nav11", "somatic"): 0.11504623309972959,
+        ("gSKv3_1bar_SKv3_1", "somatic"): 0.18497365407533689,
+        ("gNav11bar_Nav11", "ais"): nav_ais,
+        ("gSKv3_1bar_SKv3_1", "ais"): kv3_ais,
+        ("gNav11bar_Nav11", "nodes"): nav_nodes,
+        ("gSKv3_1bar_SKv3_1", "nodes"): kv3_nodes,
+    })
 
     base_nav = {
         "somatic": pv.soma[0].gNav11bar_Nav11,
@@ -104,18 +174,16 @@ def reset_biophys_alt2(pv):
 
     print(f"{nav_ais:.2f} | {kv3_ais:.2f} | {nav_nodes:.2f} | {kv3_nodes:.2f}")
 
-    for sec in pv.somatic:
-        sec.gNaTs2_tbar_NaTs2_t = 0.95585841724208476
-        sec.gNav11bar_Nav11 = 0.21504623309972959
-        sec.gNap_Et2bar_Nap_Et2 = 7.9295968986726376e-07
-        sec.gSKv3_1bar_SKv3_1 = 0.18497365407533689
-    for sec in pv.ais:
-        sec.gNav11bar_Nav11 = nav_ais
-        sec.gSKv3_1bar_SKv3_1 = kv3_ais
-
-    for sec in pv.nodes:
-        sec.gNav11bar_Nav11 = nav_nodes
-        sec.gSKv3_1bar_SKv3_1 = kv3_nodes
+    get_segment_index(pv).apply({
+        ("gNaTs2_tbar_NaTs2_t", "somatic"): 0.95585841724208476,
+        ("gNav11bar_Nav11", "somatic"): 0.21504623309972959,
+        ("gNap_Et2bar_Nap_Et2", "somatic"): 7.9295968986726376e-07,
+        ("gSKv3_1bar_SKv3_1", "somatic"): 0.18497365407533689,
+        ("gNav11bar_Nav11", "ais"): nav_ais,
+        ("gSKv3_1bar_SKv3_1", "ais"): kv3_ais,
+        ("gNav11bar_Nav11", "nodes"): nav_nodes,
+        ("gSKv3_1bar_SKv3_1", "nodes"): kv3_nodes,
+    })
 
     base_nav = {
         "somatic": pv.soma[0].gNav11bar_Nav11,
@@ -141,19 +209,16 @@ def reset_biophys_orig(pv):
 
     print(f"{nav_ais:.2f} | {kv3_ais:.2f} | {nav_nodes:.2f} | {kv3_nodes:.2f}")
 
-    for sec in pv.somatic:
-        sec.gNaTs2_tbar_NaTs2_t = 0.95585841724208476
-        sec.gNav11bar_Nav11 = 0.21504623309972959
-        sec.gNap_Et2bar_Nap_Et2 = 7.9295968986726376e-07
-        sec.gSKv3_1bar_SKv3_1 = 0.018497365407533689
-
-    for sec in pv.ais:
-        sec.gNav11bar_Nav11 = nav_ais
-        sec.gSKv3_1bar_SKv3_1 = kv3_ais
-
-    for sec in pv.nodes:
-        sec.gNav11bar_Nav11 = nav_nodes
-        sec.gSKv3_1bar_SKv3_1 = kv3_nodes
+    get_segment_index(pv).apply({
+        ("gNaTs2_tbar_NaTs2_t", "somatic"): 0.95585841724208476,
+        ("gNav11bar_Nav11", "somatic"): 0.21504623309972959,
+        ("gNap_Et2bar_Nap_Et2", "somatic"): 7.9295968986726376e-07,
+        ("gSKv3_1bar_SKv3_1", "somatic"): 0.018497365407533689,
+        ("gNav11bar_Nav11", "ais"): nav_ais,
+        ("gSKv3_1bar_SKv3_1", "ais"): kv3_ais,
+        ("gNav11bar_Nav11", "nodes"): nav_nodes,
+        ("gSKv3_1bar_SKv3_1", "nodes"): kv3_nodes,
+    })
 
     base_nav = {
         "somatic": pv.soma[0].gNav11bar_Nav11,
@@ -164,9 +229,386 @@ def reset_biophys_orig(pv):
     return base_nav
 
 
+# pool of cells that can be reset cheaply
+
+def read_morphology(morphology_dir="morphologies", morphology_name="C210401C.asc"):
+    """Read a morphology file once, so that it can be passed to the `pv` template to build many cells"""
+    if morphology_name.endswith(".swc"):
+        morph = h.Import3d_SWC_read()
+    else:
+        morph = h.Import3d_Neurolucida3()
+    morph.quiet = 1
+    morph.input(f"{morphology_dir}/{morphology_name}")
+    return morph
+
+
+@lru_cache()
+def get_mech_param_names(mech_name):
+    """Names of the PARAMETERs (not states or assigned variables) of a density mechanism, e.g. 'gNav11bar_Nav11'"""
+    ms = h.MechanismStandard(mech_name, 1)
+    name = h.ref("")
+    names = []
+    for i in range(int(ms.count())):
+        ms.name(name, i)
+        names.append(name[0])
+    return tuple(names)
+
+
+def snapshot_biophys(pv):
+    """Pointers to, and current values of, every mechanism PARAMETER (and cm, ena, ek) of every segment of `pv`
+
+    Note that the pointers are invalid if the structure of `pv` changes (e.g. `nseg` or inserted mechanisms).
+    """
+    refs = []
+    ra = []
+    for sec in pv.all:
+        ra.append(sec.Ra)
+        for seg in sec:
+            refs.append(seg._ref_cm)
+            for ion_e in ("ena", "ek"):
+                if hasattr(seg, ion_e):
+                    refs.append(getattr(seg, f"_ref_{ion_e}"))
+            for mech in seg:
+                refs += [getattr(seg, f"_ref_{param}") for param in get_mech_param_names(mech.name())]
+
+    ptrs = h.PtrVector(len(refs))
+    for i, ref in enumerate(refs):
+        ptrs.pset(i, ref)
+    values = h.Vector(len(refs))
+    ptrs.gather(values)
+    return BiophysSnapshot(ptrs, values, ra)
+
+
+@staged("restore_biophys")
+def restore_biophys(pv, snapshot: BiophysSnapshot):
+    """Restore the values of `snapshot_biophys` (a single array write, instead of re-running `biophys()`)"""
+    snapshot.ptrs.scatter(snapshot.values)
+    for sec, ra in zip(pv.all, snapshot.ra):
+        sec.Ra = ra
+
+
+def _ptr_vector(segments, param):
+    ptrs = h.PtrVector(len(segments))
+    for i, seg in enumerate(segments):
+        ptrs.pset(i, getattr(seg, f"_ref_{param}"))
+    return ptrs
+
+
+class SegmentIndex:
+    """Pointers to a (range) parameter, e.g. "gNav11bar_Nav11", of every segment of a section list of a cell, to get and
+    set its values with a single array read/write instead of Python loops over sections and segments.
+
+        index = get_segment_index(pv)
+        index.apply({("gNav11bar_Nav11", "ais"): 0.5*base_nav["ais"], ("gNav11bar_Nav11", "nodes"): 0.})
+
+    Pointers are built on first use of each (parameter, section list). As for `snapshot_biophys`, they are invalid if
+    the structure of the cell changes. With `require`, only the sections that also have those parameters are used
+    (e.g. to read and set the parameters of two mechanisms through the same sections).
+    """
+
+    def __init__(self, pv):
+        self.pv = pv
+        self._entries = {}
+
+    def _entry(self, param, secs="all", require=()) -> _IndexEntry:
+        if isinstance(require, str):
+            require = (require,)
+        key = (param, secs, tuple(sorted(set(require) - {param})))
+        if key not in self._entries:
+            segments, mids, n_segs, missing = [], [], [], []
+            for sec in getattr(self.pv, secs):
+                if not all(hasattr(sec(0.5), _param) for _param in (param, *key[2])):
+                    missing.append(_short_name(sec))
+                    continue
+                sec_segments = list(sec)
+                segments += sec_segments
+                mids.append(sec(0.5))
+                n_segs.append(len(sec_segments))
+            ptrs, mid_ptrs = (_ptr_vector(segments, param), _ptr_vector(mids, param)) if segments else (None, None)
+            self._entries[key] = _IndexEntry(ptrs, mid_ptrs, np.array(n_segs, dtype=int), missing)
+        return self._entries[key]
+
+    def missing(self, param, secs="all", require=()):
+        """Names of the sections of `secs` without `param` (or a parameter of `require`)"""
+        return self._entry(param, secs, require).missing
+
+    def get(self, param, secs="all", require=()) -> np.ndarray:
+        """Values of `param` of every segment (of the sections of `secs` that have it)"""
+        ptrs = self._entry(param, secs, require).ptrs
+        if ptrs is None:
+            return np.array([])
+        values = h.Vector(int(ptrs.size()))
+        ptrs.gather(values)
+        return values.as_numpy().copy()
+
+    def get_section_values(self, param, secs="all", require=()) -> np.ndarray:
+        """As `get`, but each segment has the value of its section (e.g. `sec.gNav11bar_Nav11`, at 0.5)"""
+        entry = self._entry(param, secs, require)
+        if entry.mid_ptrs is None:
+            return np.array([])
+        values = h.Vector(int(entry.mid_ptrs.size()))
+        entry.mid_ptrs.gather(values)
+        return np.repeat(values.as_numpy(), entry.n_segs)
+
+    def set(self, param, value, secs="all", ignore_missing=False, require=()):
+        """Set `param` of every segment to `value` (a number, or an array as from `get`).
+
+        Raises an AttributeError if sections of `secs` don't have `param` (or `require`), unless `ignore_missing`.
+        """
+        entry = self._entry(param, secs, require)
+        if entry.missing and not ignore_missing:
+            raise AttributeError(f"'{param}' is not in section(s) {', '.join(entry.missing)}")
+        if entry.ptrs is None:
+            return
+        values = np.broadcast_to(np.asarray(value, dtype=float), (int(entry.ptrs.size()),))
+        entry.ptrs.scatter(h.Vector(values))
+
+    def apply(self, params: dict, ignore_missing=False, require=()):
+        """`set` many values at once, from a dict of `param` (for all sections) or `(param, secs)` to value"""
+        for key, value in params.items():
+            param, secs = (key, "all") if isinstance(key, str) else key
+            self.set(param, value, secs, ignore_missing=ignore_missing, require=require)
+
+
+_segment_indices = {}
+
+
+def get_segment_index(pv, rebuild=False) -> SegmentIndex:
+    """The `SegmentIndex` of `pv`, which is kept between calls (`rebuild` it after changing the structure of `pv`)"""
+    index = _segment_indices.get(pv.hname())
+    if rebuild or index is None or index.pv != pv:
+        index = _segment_indices[pv.hname()] = SegmentIndex(pv)
+    return index
+
+
+class CellPool:
+    """Independent cells built from one cached geometry (see `build_pv`), to be handed out and returned (e.g. by sweep
+    drivers).
+
+    Each cell is set up with `reset_biophys` once, which is then snapshotted and restored when a cell is returned.
+
+        pool = CellPool(4, node_spacing=33, node_length=1., ais_L=26.5)
+        with pool.borrow() as pv:
+            set_nav_frac(pv, 0.5, "ais", pool.base_nav)
+            ...
+    """
+
+    def __init__(self, n_cells=1, name="default", target_myelinated_L=1000., node_spacing=30., node_length=1.,
+                 ais_L=60., reset_biophys=reset_biophys):
+        self.cells = []
+        self._snapshots = {}
+        for _ in range(n_cells):
+            pv = build_pv(name, target_myelinated_L, node_spacing, node_length, ais_L)
+            with stage("biophys"):
+                self.base_nav = reset_biophys(pv)
+            self._snapshots[pv.hname()] = snapshot_biophys(pv)
+            self.cells.append(pv)
+        self._free = list(self.cells)
+
+    def __len__(self):
+        return len(self.cells)
+
+    def acquire(self):
+        """Get a cell with baseline biophysics (see `release`)"""
+        if not self._free:
+            raise RuntimeError("no free cells in pool")
+        return self._free.pop()
+
+    def release(self, pv):
+        """Restore a cell's baseline biophysics and return it to the pool"""
+        restore_biophys(pv, self._snapshots[pv.hname()])
+        self._free.append(pv)
+
+    @contextmanager
+    def borrow(self):
+        pv = self.acquire()
+        try:
+            yield pv
+        finally:
+            self.release(pv)
+
+
+# fast construction from a cached geometry
+
+def distribute_distance(pv, sec_list="basal", params=None):
+    """Vectorised version of the template's `distribute_distance` for every parameter in `params`
+    (default: `DISTANCE_PARAMS`), with a single array write per parameter instead of a hoc statement per segment.
+    """
+    if params is None:
+        params = DISTANCE_PARAMS
+    h.distance(0, pv.soma[0](0.5))
+    segments = [seg for sec in getattr(pv, sec_list) for seg in sec]
+    # `math.exp` (libm, as used by hoc) rather than `np.exp`, which can differ in the last bit
+    dist_values = -0.8696 + 2.087*np.array([math.exp(h.distance(seg)*0.0031) for seg in segments])
+    for param, scale in params.items():
+        _ptr_vector(segments, param).scatter(h.Vector(dist_values*scale))
+
+
+def _short_name(sec):
+    sec_name = sec.hname()
+    return sec_name[sec_name.find(".")+1:]
+
+
+def save_geometry(pv, path):
+    """Save the topology and geometry (3D points, or length and diameters) of every section of `pv` as json"""
+    x, y, z = h.ref(0.), h.ref(0.), h.ref(0.)
+    sections = []
+    for sec in pv.all:
+        parent_seg = sec.parentseg()
+        sec_geom = {"name": _short_name(sec),
+                    "parent": None if parent_seg is None else _short_name(parent_seg.sec),
+                    "parent_x": None if parent_seg is None else parent_seg.x,
+                    "orientation": sec.orientation(),
+                    "nseg": sec.nseg}
+        if sec.n3d():
+            sec_geom["pt3d"] = [(sec.x3d(i), sec.y3d(i), sec.z3d(i), sec.diam3d(i)) for i in range(sec.n3d())]
+            if h.pt3dstyle(1, x, y, z, sec=sec):
+                sec_geom["pt3dstyle"] = (x[0], y[0], z[0])
+        else:
+            sec_geom["L"] = sec.L
+            sec_geom["diam"] = [seg.diam for seg in sec]
+        sections.append(sec_geom)
+
+    geometry = {"sizes": [sum(1 for sec in pv.all if _short_name(sec).startswith(f"{arr}["))
+                          for arr in _SECTION_ARRAYS],
+                "sections": sections,
+                "lists": {sec_list: [_short_name(sec) for sec in getattr(pv, sec_list)]
+                          for sec_list in _SECTION_LISTS}}
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = Path(path).with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(geometry))
+    tmp_path.replace(path)
+
+
+def _get_section(pv, sec_name):
+    arr, idx = sec_name.rstrip("]").split("[")
+    return getattr(pv, arr)[int(idx)]
+
+
+def load_geometry(path):
+    """Build a `pv` cell (with channels and biophysics) from a geometry saved by `save_geometry`"""
+    geometry = json.loads(Path(path).read_text())
+    pv = h.pv()
+    pv.create_sections(*geometry["sizes"])
+
+    for sec_geom in geometry["sections"]:
+        sec = _get_section(pv, sec_geom["name"])
+        if "pt3d" in sec_geom:
+            for pt in sec_geom["pt3d"]:
+                h.pt3dadd(*pt, sec=sec)
+            if "pt3dstyle" in sec_geom:
+                h.pt3dstyle(1, *sec_geom["pt3dstyle"], sec=sec)
+            sec.nseg = sec_geom["nseg"]
+        else:
+            sec.L = sec_geom["L"]
+            sec.nseg = sec_geom["nseg"]
+            for seg, diam in zip(sec, sec_geom["diam"]):
+                seg.diam = diam
+    for sec_geom in geometry["sections"]:
+        if sec_geom["parent"] is not None:
+            _get_section(pv, sec_geom["name"]).connect(_get_section(pv, sec_geom["parent"])(sec_geom["parent_x"]),
+                                                       sec_geom["orientation"])
+    for sec_list, sec_names in geometry["lists"].items():
+        for sec_name in sec_names:
+            getattr(pv, sec_list).append(sec=_get_section(pv, sec_name))
+
+    pv.geom_nsec()
+    pv.insertChannel()
+    pv.biophys()
+    distribute_distance(pv)
+    pv.re_init_rng()
+    return pv
+
+
+def get_geometry_path(target_myelinated_L=1000., node_spacing=30., node_length=1., ais_L=60.,
+                      morphology_dir="morphologies", morphology_name="C210401C.asc", cache_dir=None):
+    """Path of the cached geometry, which also depends on the contents of the morphology and template files"""
+    if cache_dir is None:
+        cache_dir = GEOMETRY_CACHE_DIR
+    sha = hashlib.sha1()
+    for file_path in [Path(morphology_dir) / morphology_name, Path("PV_template.hoc")]:
+        sha.update(file_path.read_bytes())
+    params = "_".join(str(float(param)) for param in (target_myelinated_L, node_spacing, node_length, ais_L))
+    name = f"{Path(morphology_name).stem}_{params}"
+    return Path(cache_dir) / f"{name}_{sha.hexdigest()[:10]}.json"
+
+
+@staged("build")
+def build_pv(name="default", target_myelinated_L=1000., node_spacing=30., node_length=1., ais_L=60.,
+             morphology=None, cache_dir=None):
+    """Create a `pv` cell (as `get_pv`, but not cached in memory) from its geometry cached on disk.
+
+    The first build for a set of parameters imports the morphology (or uses the `morphology` from `read_morphology`)
+    and saves the geometry (with the replaced axon) to `cache_dir` (default: `GEOMETRY_CACHE_DIR`).
+    """
+    path = get_geometry_path(target_myelinated_L, node_spacing, node_length, ais_L, cache_dir=cache_dir)
+    if path.exists():
+        pv = load_geometry(path)
+    else:
+        morphology_args = () if morphology is None else (morphology,)
+        pv = h.pv('morphologies', 'C210401C.asc',
+                  target_myelinated_L, node_spacing, node_length, ais_L, *morphology_args)
+        save_geometry(pv, path)
+    pv.name = f"{name}({target_myelinated_L}, {node_spacing}, {node_length}, {ais_L})"
+    return pv
+
+
+def benchmark_build(n_cells=5, cache_dir=None):
+    """Mean time (s) to build a cell from the morphology file, from a read morphology, and from the cached geometry"""
+    import time
+
+    def mean_time(build):
+        start_time = time.perf_counter()
+        cells = [build() for _ in range(n_cells)]
+        return (time.perf_counter() - start_time)/len(cells)
+
+    morph = read_morphology()
+    build_pv(cache_dir=cache_dir)  # make sure the geometry is cached
+    return {
+        "morphology file": mean_time(lambda: h.pv('morphologies', 'C210401C.asc', 1000., 30., 1., 60.)),
+        "read morphology": mean_time(lambda: h.pv('morphologies', 'C210401C.asc', 1000., 30., 1., 60., morph)),
+        "cached geometry": mean_time(lambda: build_pv(cache_dir=cache_dir)),
+    }
+
+
 if __name__ == "__main__":
+    import tempfile
+
+    init_nrn(get_mechanisms_path())
     pv1 = get_pv()
     pv_same = get_pv()
     pv_diff = get_pv("test_pv_dif")
     assert pv1 == pv_same, "not the same object as excepted for the same call to pv()"
     assert pv1 != pv_diff, "expected different argument calls to produce different objects!"
+
+    assert len(list(pv1.all)) > 0, "expected earlier cells to keep their sections"
+
+    pool = CellPool(2, name="test_pool")
+    with pool.borrow() as pv_a, pool.borrow() as pv_b:
+        assert pv_a.soma[0] != pv_b.soma[0], "expected independent cells"
+        base_nav = pv_a.axon[0].gNav11bar_Nav11
+        pv_a.axon[0].gNav11bar_Nav11 = 0
+        assert pv_b.axon[0].gNav11bar_Nav11 == base_nav, "expected independent cells"
+    assert pv_a.axon[0].gNav11bar_Nav11 == base_nav, "expected cell to be restored after release"
+
+    index = get_segment_index(pv1)
+    assert index is get_segment_index(pv1), "expected the index to be kept"
+    index.set("gNav11bar_Nav11", 0.5*index.get("gNav11bar_Nav11", "ais"), "ais")
+    assert pv1.axon[0].gNav11bar_Nav11 == 0.5*pv_diff.axon[0].gNav11bar_Nav11
+    assert np.all(index.get_section_values("gNav11bar_Nav11", "nodes") == pv1.node[0].gNav11bar_Nav11)
+    assert "myelin[0]" in index.missing("gNav11bar_Nav11", "axonal")
+    both_missing = index.missing("gNav11bar_Nav11", require="gNav11bar_Nav11m")
+    assert set(index.missing("gNav11bar_Nav11")) | set(index.missing("gNav11bar_Nav11m")) == set(both_missing)
+    assert len(index.get("gNav11bar_Nav11", require="gNav11bar_Nav11m")) == \
+        len(index.get("gNav11bar_Nav11m", require="gNav11bar_Nav11"))
+    reset_biophys(pv1)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        pv_file = build_pv("test_geometry", cache_dir=cache_dir)
+        pv_cached = build_pv("test_geometry", cache_dir=cache_dir)
+        for sec_file, sec_cached in zip(pv_file.all, pv_cached.all):
+            for seg_file, seg_cached in zip(sec_file, sec_cached):
+                assert seg_file.area() == seg_cached.area(), "expected the same geometry from the cache"
+                if hasattr(seg_file, "gIhbar_Ih"):
+                    assert seg_file.gIhbar_Ih == seg_cached.gIhbar_Ih, "expected the same distance-based values"
+        print(benchmark_build(cache_dir=cache_dir))
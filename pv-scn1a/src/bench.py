@@ -0,0 +1,231 @@
+"""Benchmarks of the simulation and analysis hot paths, with golden reference outputs and a history of timings.
+
+    python -m src.bench                                  # every benchmark at `DEFAULT_SIZES`
+    python -m src.bench --sizes 250                      # longer traces (minutes)
+    python -m src.bench --only get_trace get_ap_times --sizes 10 50
+    python -m src.bench --update-golden                  # after an intended change of results
+
+Sizes are trace durations (ms) of a pulse train (see `STIM`). Each benchmark returns outputs that a faster path must
+reproduce (AP counts, AP times, propagation distances, ...), which are compared to the golden outputs in
+`GOLDEN_PATH` (floats to within `GOLDEN_ATOL`, e.g. ms). The best time of every benchmark is appended to a history
+(`bench_history.csv` in the cache root) with the git commit, and is flagged as a regression if it is more than
+`REGRESSION_FACTOR` times the median of previous runs.
+"""
+import argparse
+import json
+import subprocess
+import tempfile
+import time
+from collections import namedtuple
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from neuron import h
+
+from pv_nrn import build_pv, get_mechanisms_path, get_pv, init_nrn, reset_biophys
+from src.data import ap_to_series, get_cache_root, load_cached_df, save_cached_df, wide_to_long
+from src.measure import calculate_failures, get_ap_times, get_max_propagation
+from src.run import get_trace, getIF
+from src.store import _append_csv
+from src.utils import get_last_sec
+
+GOLDEN_PATH = Path(__file__).parent.parent / "benchmarks" / "golden.json"
+GOLDEN_ATOL = 0.01
+REGRESSION_FACTOR = 1.5
+DEFAULT_SIZES = (10, 50)
+# (amplitude (nA), frequency (Hz)) of every trace
+STIM = (0.75, 120)
+PV_PARAMS = (1000., 33., 1., 26.5)
+
+# `setup(size)` returns the arguments of `run`, which is timed and returns the outputs to compare to the golden ones.
+# Benchmarks with `sizes` only run at those sizes.
+Benchmark = namedtuple("Benchmark", "setup run sizes", defaults=(None,))
+
+
+@lru_cache(maxsize=1)
+def _get_bench_pv():
+    return get_pv("bench", *PV_PARAMS)
+
+
+@lru_cache(maxsize=None)
+def _get_bench_trace(size):
+    # the same trace for every analysis benchmark of a size
+    pv = _get_bench_pv()
+    reset_biophys(pv)
+    _, _, AP, x_df = get_trace(pv, STIM[0], size, stim_freq=STIM[1], shape_plot=True)
+    return ap_to_series(AP), x_df
+
+
+def _site_times(x_df):
+    return {sec: get_ap_times(x_df, thresh=-20, sec=sec) for sec in ("soma[0]", "axon[1]", get_last_sec(x_df))}
+
+
+def _build(size):
+    pv = build_pv("bench_build", *PV_PARAMS)
+    sections = list(pv.all)
+    # the cell isn't freed, and would change the (default) solver of the other benchmarks (see `get_solver`)
+    for sec in sections:
+        h.delete_section(sec=sec)
+    return {"n_sections": len(sections)}
+
+
+def _trace_outputs(size, shape_plot):
+    pv = _get_bench_pv()
+    _, _, AP, x_df = get_trace(pv, STIM[0], size, stim_freq=STIM[1], shape_plot=shape_plot)
+    outputs = {"APCount": ap_to_series(AP).to_dict()}
+    if shape_plot:
+        outputs["shape"] = list(x_df.shape)
+    return outputs
+
+
+def _cached_df(x_df, ap_series):
+    with tempfile.TemporaryDirectory() as cache_root:
+        save_cached_df("bench", ap_series, x_df, cache_root=cache_root)
+        AP, loaded_df = load_cached_df("bench", cache_root=cache_root)
+    return {"equal": bool(np.array_equal(loaded_df.values, x_df.values)),
+            "APCount": ap_to_series(AP).to_dict()}
+
+
+def _failures(x_df):
+    site_times = list(_site_times(x_df).values())
+    failures = calculate_failures(site_times[1], site_times[2])
+    return {"n": len(site_times[1]), "failures": failures.tolist()}
+
+
+def _pv_setup(size):
+    pv = _get_bench_pv()
+    reset_biophys(pv)
+    return (pv,)
+
+
+BENCHMARKS = {
+    "get_pv": Benchmark(lambda size: (size,), _build, sizes=(1,)),
+    "reset_biophys": Benchmark(_pv_setup, lambda pv: reset_biophys(pv), sizes=(1,)),
+    "get_trace": Benchmark(lambda size: (size, False), _trace_outputs),
+    "get_trace_shape_plot": Benchmark(lambda size: (size, True), _trace_outputs),
+    "getIF": Benchmark(lambda size: (np.linspace(0.1, 1, 4), _pv_setup(size)[0], size),
+                       lambda amps, pv, dur: {"rates": getIF(amps, pv, dur=dur, ap_secs="soma")}),
+    "get_cached_df": Benchmark(lambda size: (_get_bench_trace(size)[1], _get_bench_trace(size)[0]), _cached_df),
+    "wide_to_long": Benchmark(lambda size: (_get_bench_trace(size)[1],),
+                              lambda x_df: {"shape": list(wide_to_long(x_df).shape)}),
+    "get_ap_times": Benchmark(lambda size: (_get_bench_trace(size)[1],),
+                              lambda x_df: {sec: times.tolist() for sec, times in _site_times(x_df).items()}),
+    "get_max_propagation": Benchmark(lambda size: (_get_bench_trace(size)[1],),
+                                     lambda x_df: {"distance": float(get_max_propagation(x_df)[1])}),
+    "calculate_failures": Benchmark(lambda size: (_get_bench_trace(size)[1],), _failures),
+}
+
+
+def _to_json(outputs):
+    # numpy values (e.g. of `ap_to_series`) as plain ones
+    return json.loads(json.dumps(outputs, default=lambda val: val.tolist() if hasattr(val, "tolist") else str(val)))
+
+
+def matches(golden, outputs, atol=GOLDEN_ATOL):
+    """Whether `outputs` are the `golden` ones, with floats (and lists of them) to within `atol`"""
+    if isinstance(golden, dict):
+        return (isinstance(outputs, dict) and set(golden) == set(outputs)
+                and all(matches(golden[key], outputs[key], atol) for key in golden))
+    if isinstance(golden, list):
+        return (isinstance(outputs, list) and len(golden) == len(outputs)
+                and all(matches(gold, out, atol) for gold, out in zip(golden, outputs)))
+    if isinstance(golden, float) or isinstance(outputs, float):
+        return outputs is not None and golden is not None and bool(np.isclose(golden, outputs, rtol=0, atol=atol,
+                                                                             equal_nan=True))
+    return golden == outputs
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _add_regressions(results_df, history_path):
+    if not history_path.exists():
+        results_df["median"] = np.nan
+    else:
+        history = pd.read_csv(history_path)
+        median = history.groupby(["benchmark", "size"])["best"].median().rename("median")
+        results_df = results_df.join(median, on=["benchmark", "size"])
+    results_df["regression"] = results_df["best"] > REGRESSION_FACTOR*results_df["median"]
+    return results_df
+
+
+def run_benchmarks(names=None, sizes=DEFAULT_SIZES, repeat=3, golden_path=GOLDEN_PATH, history_path=None,
+                   update_golden=False, mechanisms=None) -> pd.DataFrame:
+    """Time every benchmark (or those in `names`) at every size, and compare their outputs to the golden ones.
+
+    Returns a DataFrame with the best and mean time (s) of each (benchmark, size), whether its outputs match the
+    golden ones ("ok", "mismatch", or "new" if there are none), and whether it is a regression (see module docs).
+    With `update_golden`, the golden outputs are replaced by these. `history_path=False` keeps no history.
+    `mechanisms` is passed to `init_nrn`.
+    """
+    init_nrn(mechanisms)
+    golden_path = Path(golden_path)
+    golden = json.loads(golden_path.read_text()) if golden_path.exists() else {}
+    rows = []
+    for name, benchmark in BENCHMARKS.items():
+        if names is not None and name not in names:
+            continue
+        for size in benchmark.sizes or sizes:
+            args = benchmark.setup(size)
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                outputs = benchmark.run(*args)
+                times.append(time.perf_counter() - start)
+            outputs = _to_json(outputs)
+
+            golden_key = f"{name}[{size:g}]"
+            if golden_key not in golden:
+                status = "new"
+            else:
+                status = "ok" if matches(golden[golden_key], outputs) else "mismatch"
+            if update_golden or golden_key not in golden:
+                golden[golden_key] = outputs
+            rows.append({"benchmark": name, "size": size, "best": min(times), "mean": np.mean(times),
+                         "repeat": repeat, "golden": status})
+
+    if update_golden or any(row["golden"] == "new" for row in rows):
+        golden_path.parent.mkdir(parents=True, exist_ok=True)
+        golden_path.write_text(json.dumps(golden, indent=1, sort_keys=True))
+
+    results_df = pd.DataFrame(rows, columns=["benchmark", "size", "best", "mean", "repeat", "golden"])
+    if history_path is False:
+        return results_df
+    history_path = Path(get_cache_root()) / "bench_history.csv" if history_path is None else Path(history_path)
+    history_path.parent.mkdir(parents=True, exist_ok=True)
+    results_df = _add_regressions(results_df, history_path)
+    _append_csv(history_path, results_df.drop(columns=["median", "regression"]).assign(
+        date=datetime.now().isoformat(timespec="seconds"), commit=_git_commit()))
+    return results_df
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks with golden outputs and a history of timings")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="benchmarks to run (default: all)")
+    parser.add_argument("--sizes", nargs="+", type=float, default=DEFAULT_SIZES, help="trace durations (ms)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--update-golden", action="store_true", help="replace the golden outputs by these")
+    parser.add_argument("--history", default=None, help="history file (default: in the cache root)")
+    parser.add_argument("--mechanisms", default=None, help="compiled mechanisms (default: see `get_mechanisms_path`)")
+    args = parser.parse_args(argv)
+
+    results_df = run_benchmarks(args.only, args.sizes, args.repeat, history_path=args.history,
+                                update_golden=args.update_golden, mechanisms=args.mechanisms or get_mechanisms_path())
+    with pd.option_context("display.width", 120, "display.max_rows", None):
+        print(results_df)
+    failed = results_df[(results_df["golden"] == "mismatch") | results_df["regression"]]
+    return 1 if len(failed) else 0
+
+
+if __name__ == "__main__":
+    import sys
+
+    sys.exit(main())
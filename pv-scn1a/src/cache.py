@@ -0,0 +1,223 @@
+"""Content-addressed cache of simulations.
+
+Unlike `get_cached_df` (where `name` decides a cache hit), the key here is a hash of everything that affects the
+result: the parameter values of every segment of the cell (of every cell in the process under global CVODE), the
+stimulus and `get_trace` options, solver settings, and the contents of the template, morphology, mechanism and
+`src/run.py` files.
+
+The cache is size-bounded with least-recently-used eviction (see `set_cache_limit`).
+"""
+import hashlib
+import json
+import os
+from functools import lru_cache, partial
+from pathlib import Path
+
+import numpy as np
+from neuron import h
+
+from pv_nrn import get_mech_param_names
+from src.data import get_cache_root, load_cached_df, save_cached_df, ap_to_series, _ap_series_to_ap
+from src.run import _short_name, get_solver, get_trace
+from src.settings import STIM_ONSET, STIM_PULSE_DUR
+
+_MODEL_FILES = ("PV_template.hoc", "PV_template_orig.hoc",
+                "mechanisms/*.mod", "morphologies/*", "src/run.py")
+
+_max_cache_bytes = None
+_max_cache_entries = None
+
+
+def set_cache_limit(max_bytes=None, max_entries=None):
+    """Limit the size of the content cache (None for no limit). Least recently used entries are removed first."""
+    global _max_cache_bytes, _max_cache_entries
+    _max_cache_bytes = max_bytes
+    _max_cache_entries = max_entries
+
+
+def get_content_cache_dir(root=None):
+    if root is None:
+        root = get_cache_root()
+    cache_dir = Path(root) / "content"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
+@lru_cache()
+def _file_hash(path, mtime_ns):
+    # `mtime_ns` is only part of the (lru_cache) key, so that changed files are hashed again
+    return hashlib.sha1(Path(path).read_bytes()).hexdigest()
+
+
+def get_file_hash(path):
+    """Hash of the contents of a file (only read again after it changes)"""
+    path = Path(path)
+    return _file_hash(path, path.stat().st_mtime_ns)
+
+
+def get_files_hash(patterns=_MODEL_FILES, root="."):
+    """Hash of the contents of the model files (template, morphology, mechanisms, ...)"""
+    sha = hashlib.sha1()
+    for pattern in patterns:
+        for path in sorted(Path(root).glob(pattern)):
+            sha.update(str(path.as_posix()).encode())
+            sha.update(get_file_hash(path).encode())
+    return sha.hexdigest()
+
+
+def get_cell_hash(nrn_cell):
+    """Hash of the topology, geometry and mechanism parameter values of every segment of `nrn_cell`"""
+    return get_sections_hash(nrn_cell.all)
+
+
+def get_sections_hash(sections):
+    """As `get_cell_hash`, for any sections (e.g. `h.allsec()` for every cell)"""
+    sha = hashlib.sha1()
+    for sec in sections:
+        parent_seg = sec.parentseg()
+        # without the cell's name (e.g. "pv[1]."), so that identical cells have the same hash
+        parent_name = None if parent_seg is None else f"{_short_name(parent_seg.sec)}({parent_seg.x})"
+        sha.update(f"{_short_name(sec)}|{parent_name}|{sec.nseg}|{sec.Ra}".encode())
+        values = [sec.L]
+        for seg in sec:
+            values += [seg.diam, seg.cm]
+            for ion_e in ("ena", "ek"):
+                if hasattr(seg, ion_e):
+                    values.append(getattr(seg, ion_e))
+            for mech in seg:
+                mech_name = mech.name()
+                sha.update(mech_name.encode())
+                values += [getattr(seg, param) for param in get_mech_param_names(mech_name)]
+        sha.update(np.array(values, dtype=float).tobytes())
+    return sha.hexdigest()
+
+
+def get_solver_settings(solver=None):
+    # `hRun` sets dt and CVODE tolerances from the `solver` (`h.dt` also changes during a CVODE run)
+    return {
+        "celsius": h.celsius,
+        "v_init": h.v_init,
+        "secondorder": h.secondorder,
+        "solver": tuple(get_solver(solver)),
+    }
+
+
+def describe(obj):
+    """A stable description of functions (e.g. `init_state=get_snapshot`) to hash, which are otherwise hashed by
+    address (other objects are returned as they are)"""
+    if isinstance(obj, partial):
+        return [describe(obj.func), obj.args, obj.keywords]
+    if callable(obj):
+        return f"{obj.__module__}.{obj.__qualname__}"
+    return obj
+
+
+def get_state_hash(nrn_cell, stim_amp: float, stim_dur: float, **kwargs):
+    """Hash of everything that affects the result of `get_trace(nrn_cell, stim_amp, stim_dur, **kwargs)`
+
+    With a (global) CVODE solver, the time steps depend on every cell in the process, so all sections are hashed.
+    """
+    solver = kwargs.pop("solver", None)
+    kwargs = {key: describe(val) for key, val in kwargs.items()}
+    independent = get_solver(solver).method in ("lvardt", "fixed")
+    state = {
+        "cell": get_cell_hash(nrn_cell) if independent else get_sections_hash(h.allsec()),
+        "files": get_files_hash(),
+        "solver": get_solver_settings(solver),
+        "stim": {"amp": stim_amp, "dur": stim_dur, "onset": STIM_ONSET, "pulse_dur": STIM_PULSE_DUR},
+        "kwargs": kwargs,
+    }
+    return hashlib.sha1(json.dumps(state, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def evict(root=None, max_bytes=None, max_entries=None):
+    """Remove least recently used entries until the content cache is within `max_bytes` and `max_entries`"""
+    if max_bytes is None and max_entries is None:
+        return []
+    paths = sorted(get_content_cache_dir(root).glob("*.h5"),
+                   key=lambda p: p.stat().st_mtime)
+    sizes = [path.stat().st_size for path in paths]
+    total = sum(sizes)
+    removed = []
+    for path, size in zip(paths, sizes):
+        if (max_bytes is None or total <= max_bytes) and (max_entries is None or len(paths) - len(removed) <= max_entries):
+            break
+        os.remove(path)
+        total -= size
+        removed.append(path)
+    return removed
+
+
+def get_content_cached_df(nrn_cell, stim_amp: float, stim_dur: float, cache_root=None, **kwargs):
+    """Like `get_cached_df`, but the cache key is the hash of the full model state (see `get_state_hash`).
+
+    Keyword arguments are passed to `get_trace`.
+    """
+    state_hash = get_state_hash(nrn_cell, stim_amp, stim_dur, **kwargs)
+    path = get_content_cache_dir(cache_root) / f"{state_hash}.h5"
+
+    if path.exists():
+        # mark as recently used
+        os.utime(path)
+        return load_cached_df(path, cache_root=path.parent)
+
+    t, v, AP, x_df = get_trace(nrn_cell, stim_amp, stim_dur, **kwargs)
+    ap_series = ap_to_series(AP)
+    save_cached_df(path, ap_series, x_df, cache_root=path.parent)
+    evict(cache_root, max_bytes=_max_cache_bytes, max_entries=_max_cache_entries)
+
+    return _ap_series_to_ap(ap_series), x_df
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    try:
+        from pv_nrn import get_mechanisms_path, get_pv, init_nrn, reset_biophys
+    except ImportError:
+        print("must be run from `pv-scn1a` directory")
+    from src.run import set_nav_frac
+
+    init_nrn(get_mechanisms_path())
+    pv = get_pv()
+    base_nav = reset_biophys(pv)
+    base_hash = get_state_hash(pv, 0.1, 10)
+    assert base_hash == get_state_hash(pv, 0.1, 10), "expected the same hash for the same state"
+    assert base_hash != get_state_hash(pv, 0.1, 20), "expected stimulus to change the hash"
+
+    with tempfile.TemporaryDirectory() as cache_root:
+        AP, x_df = get_content_cached_df(pv, 0.1, 10, cache_root=cache_root, shape_plot=True)
+        assert get_state_hash(pv, 0.1, 10) == base_hash, "expected running a simulation not to change the hash"
+
+        set_nav_frac(pv, 0.5, "ais", base_nav)
+        assert get_state_hash(pv, 0.1, 10) != base_hash, "expected Nav1.1 changes to change the hash"
+        get_content_cached_df(pv, 0.1, 10, cache_root=cache_root, shape_plot=True)
+        assert len(list(get_content_cache_dir(cache_root).glob("*.h5"))) == 2
+
+        reset_biophys(pv)
+        AP_cached, x_df_cached = get_content_cached_df(pv, 0.1, 10, cache_root=cache_root, shape_plot=True)
+        assert np.all(x_df_cached == x_df), "values weren't stored/loaded properly!"
+
+        # through `get_cached_df`, whose name is then not part of the key
+        from src.data import get_cached_df, get_file_path, set_content_cache
+
+        set_content_cache(True)
+        _, x_df_named = get_cached_df("any name", pv, 0.1, 10, cache_root=cache_root, shape_plot=True)
+        set_content_cache(False)
+        assert np.all(x_df_named == x_df) and len(list(get_content_cache_dir(cache_root).glob("*.h5"))) == 2
+        assert not get_file_path("any name", root=cache_root).exists()
+
+        assert len(evict(cache_root, max_entries=1)) == 1
+
+    # another cell in the process changes the (global) CVODE time steps, but not those of a local time step
+    from pv_nrn import build_pv
+    from src.run import CVODE, LVARDT
+
+    assert get_solver(None) == CVODE
+    lvardt_hash = get_state_hash(pv, 0.1, 10, solver=LVARDT)
+    cvode_hash = get_state_hash(pv, 0.1, 10, solver=CVODE)
+    other_pv = build_pv("test_cache_other")
+    assert get_state_hash(pv, 0.1, 10, solver=CVODE) != cvode_hash, "expected other cells to change the hash under CVODE"
+    assert get_state_hash(pv, 0.1, 10, solver=LVARDT) == lvardt_hash
+    # which runs with a local time step by default
+    assert get_solver(None) == LVARDT and get_state_hash(pv, 0.1, 10) == lvardt_hash
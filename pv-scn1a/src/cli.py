@@ -0,0 +1,179 @@
+"""Run the sweeps of a specification file without a GUI (e.g. on a cluster), from the `pv-scn1a` directory:
+
+    python -m src.cli sweep.json                  # run every duration of the sweep (see `run_spec`)
+    python -m src.cli sweep.json --dry-run        # number of keys, and how many are cached
+    python -m src.cli sweep.json --stages stages.jsonl --n_workers 8
+
+A specification is a JSON object with the fields of `SweepSpec`, e.g.
+
+    {"cell": {"node_spacing": 33, "node_length": 1, "ais_L": 26.5},
+     "reset_biophys": "reset_biophys",
+     "nav_loc_changes": ["ais", "nodes", ["somatic", "nodes"]],
+     "fractions": [1, 0.5, 0.1],
+     "stims": [[0.75, 0], [0.75, 120]],
+     "durations": [250, 1000],
+     "shape_plot": "SPIKE_PLAN"}
+
+Only the standard library is imported until a sweep is run, and no plotting libraries at all, so that this module (which
+"spawn" workers import again) starts quickly.
+"""
+import argparse
+import json
+import logging
+import time
+from collections import namedtuple
+
+logger = logging.getLogger("cli")
+
+# cell: arguments of `get_pv` (name and geometry)
+# reset_biophys: name of a `reset_biophys` variant in `pv_nrn` (e.g. "reset_biophys_pulse")
+# stims: (amplitude (nA), frequency (Hz)) of each stimulus
+# durations: a sweep (see `run_sweep`) is run per duration (ms)
+# shape_plot: as `run_sweep`, or the name of a `RecordingPlan` in `src.run` (e.g. "CONCISE_PLAN", "SPIKE_PLAN")
+# solver: name of a `Solver` method (e.g. "lvardt") or its fields
+# summary, manifest: paths of a `SummaryTable` and a `SweepManifest`
+SweepSpec = namedtuple("SweepSpec", "cell reset_biophys nav_loc_changes fractions stims durations shape_plot solver "
+                                    "batch_size n_workers cache_root mechanisms summary manifest",
+                       defaults=(True, None, 1, None, None, None, None, None))
+
+
+def _to_tuple(value):
+    # lists from JSON as tuples, which are in the key names (see `get_key`)
+    return tuple(_to_tuple(val) for val in value) if isinstance(value, list) else value
+
+
+def read_spec(path) -> SweepSpec:
+    """Read a sweep specification (see module docs) from a JSON file"""
+    with open(path) as f:
+        spec = json.load(f)
+    required = [field for field in SweepSpec._fields if field not in SweepSpec._field_defaults]
+    missing = [field for field in required if field not in spec]
+    unknown = [field for field in spec if field not in SweepSpec._fields]
+    if missing or unknown:
+        raise ValueError(f"invalid sweep specification {path}: missing {missing}, unknown {unknown}")
+    # geometry as floats, which are in the cell's name (and so the key names)
+    spec["cell"] = {arg: val if arg == "name" else float(val) for arg, val in spec["cell"].items()}
+    spec["nav_loc_changes"] = [_to_tuple(nav_loc) for nav_loc in spec["nav_loc_changes"]]
+    spec["stims"] = [_to_tuple(stim) for stim in spec["stims"]]
+    return SweepSpec(**spec)
+
+
+def _get_sweep_args(spec: SweepSpec):
+    import pv_nrn
+    from src import run
+    from src.manifest import SweepManifest
+    from src.summary import SummaryTable
+
+    if not spec.reset_biophys.startswith("reset_biophys") or not hasattr(pv_nrn, spec.reset_biophys):
+        raise ValueError(f"unknown reset_biophys variant '{spec.reset_biophys}'")
+    shape_plot = spec.shape_plot
+    if isinstance(shape_plot, str):
+        shape_plot = getattr(run, shape_plot, None)
+        if not isinstance(shape_plot, run.RecordingPlan):
+            raise ValueError(f"unknown recording plan '{spec.shape_plot}'")
+    elif isinstance(shape_plot, dict):
+        shape_plot = run.RecordingPlan(**{key: _to_tuple(val) for key, val in shape_plot.items()})
+    solver = run.Solver(**spec.solver) if isinstance(spec.solver, dict) else spec.solver
+    return dict(reset_biophys=getattr(pv_nrn, spec.reset_biophys), shape_plot=shape_plot, solver=solver,
+                batch_size=spec.batch_size, n_workers=spec.n_workers, mechanisms=spec.mechanisms,
+                cache_root=spec.cache_root,
+                summary=None if spec.summary is None else SummaryTable(spec.summary),
+                manifest=None if spec.manifest is None else SweepManifest(spec.manifest))
+
+
+def run_spec(spec: SweepSpec, dry_run=False):
+    """Run a sweep (see `run_sweep`) per duration of `spec`, with the mechanisms loaded once in this process.
+
+    Returns a DataFrame with, per duration, the number of keys and of keys run (or cached, with `dry_run`), the number
+    of workers, the wall time (s) and the mean and maximum startup time (s) of the workers.
+    """
+    start = time.perf_counter()
+    import pandas as pd
+    from pv_nrn import get_pv, init_nrn
+    from src.data import get_file_path
+    from src.sweep import get_sweep_keys, get_sweep_stats, run_sweep
+
+    init_nrn(spec.mechanisms)
+    sweep_args = _get_sweep_args(spec)
+    pv = get_pv(**spec.cell)
+    logger.info(f"imports, mechanisms and cell in {time.perf_counter() - start:.2f} s")
+
+    rows = []
+    for dur in spec.durations:
+        if dry_run:
+            sweep_keys = get_sweep_keys(pv, spec.stims, spec.nav_loc_changes, spec.fractions, dur,
+                                        solver=sweep_args["solver"], shape_plot=sweep_args["shape_plot"])
+            n_cached = sum(get_file_path(key_name, root=spec.cache_root).exists() for key_name, *_ in sweep_keys)
+            rows.append({"dur": dur, "n_keys": len(sweep_keys), "n_cached": n_cached})
+            continue
+        run_sweep(pv, spec.stims, spec.nav_loc_changes, spec.fractions, dur, **sweep_args)
+        stats = get_sweep_stats()
+        startup_times = stats.startup_times or [float("nan")]
+        rows.append({"dur": dur, "n_keys": stats.n_keys, "n_run": stats.n_run, "n_workers": stats.n_workers,
+                     "wall_time": stats.wall_time, "startup_mean": sum(startup_times)/len(startup_times),
+                     "startup_max": max(startup_times)})
+    return pd.DataFrame(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the sweeps of a specification file without a GUI")
+    parser.add_argument("spec", help="sweep specification (JSON, see `SweepSpec`)")
+    parser.add_argument("--n_workers", type=int, default=None, help="replaces that of the specification")
+    parser.add_argument("--cache_root", default=None, help="replaces that of the specification")
+    parser.add_argument("--dry-run", action="store_true", help="only count the keys, and those cached")
+    parser.add_argument("--stages", default=None, help="record the stages of the runs to this file (see "
+                                                        "`src.instrument`) and print a summary")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s: %(message)s")
+
+    spec = read_spec(args.spec)
+    replace = {arg: getattr(args, arg) for arg in ("n_workers", "cache_root") if getattr(args, arg) is not None}
+    spec = spec._replace(**replace)
+    if args.stages is None:
+        stats_df = run_spec(spec, dry_run=args.dry_run)
+    else:
+        from src.instrument import get_stage_table, instrumented, summarize_stages
+
+        with instrumented(args.stages):
+            stats_df = run_spec(spec, dry_run=args.dry_run)
+    print(stats_df.to_string(index=False))
+    if args.stages is not None:
+        print(summarize_stages(get_stage_table(args.stages)).to_string())
+    return stats_df
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 1:
+        main()
+        sys.exit()
+
+    import os
+    import tempfile
+    from pathlib import Path
+
+    from pv_nrn import get_mechanisms_path
+
+    with tempfile.TemporaryDirectory() as cache_root:
+        spec_path = os.path.join(cache_root, "sweep.json")
+        with open(spec_path, "w") as f:
+            json.dump({"cell": {"name": "test_cli", "node_spacing": 33., "node_length": 1., "ais_L": 26.5},
+                       "reset_biophys": "reset_biophys",
+                       "nav_loc_changes": ["ais", ["somatic", "nodes"]],
+                       "fractions": [1, 0.5],
+                       "stims": [[0.75, 0]],
+                       "durations": [20],
+                       "shape_plot": "CONCISE_PLAN",
+                       "n_workers": 2,
+                       "cache_root": cache_root,
+                       "mechanisms": get_mechanisms_path()}, f)
+
+        stats_df = main([spec_path, "--stages", os.path.join(cache_root, "stages.jsonl")])
+        assert stats_df["n_run"].tolist() == [4] and stats_df["n_workers"].tolist() == [2], stats_df
+        assert stats_df["startup_max"].iloc[0] > 0
+        assert len(list(Path(cache_root).glob("test_cli*.h5"))) == 4
+        assert not {"matplotlib", "seaborn", "neuron.gui"} & set(sys.modules), "expected no plotting imports"
+
+        stats_df = main([spec_path, "--dry-run"])
+        assert stats_df["n_cached"].tolist() == [4], stats_df
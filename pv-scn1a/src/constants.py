@@ -11,6 +11,7 @@ NAV_FRAC_LABEL = f"{NAV1P1} fraction"
 NAV_PERC_LABEL = NAV_FRAC_LABEL.replace("fraction",
                                         "deletion \n(% of baseline)")
 NAV_SECTIONS_LABEL = f"{NAV1P1} section(s)"
+RHEOBASE_LABEL = "Rheobase (nA)"
 SITE_LABEL = "Recording site"
 STIM_FREQ_LABEL = "Stimulation frequency (Hz)"
 TTX_LABEL = "\"TTX strength\""
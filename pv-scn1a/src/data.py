@@ -4,9 +4,10 @@ from collections import namedtuple
 from pathlib import Path
 from typing import Union
 
+import numpy as np
 import pandas as pd
-from tables import NaturalNameWarning, PerformanceWarning
 
+from src.instrument import stage
 from src.run import get_trace
 from src.constants import (AIS_LABEL, DISTANCE_LABEL, SECTION_LABEL,
                            SITE_LABEL, SOMA_LABEL, TERMINAL_LABEL, TIME_LABEL,
@@ -15,6 +16,7 @@ from src.constants import (AIS_LABEL, DISTANCE_LABEL, SECTION_LABEL,
 APCount = namedtuple("APCount", "n")
 
 _cache_root = ".cache"
+_content_cache = False
 
 
 def set_cache_root(root):
@@ -27,6 +29,12 @@ def get_cache_root():
     return _cache_root
 
 
+def set_content_cache(enabled=True):
+    """Cache `get_cached_df` runs by the hash of the full model state (see `src.cache`) by default, instead of by name"""
+    global _content_cache
+    _content_cache = enabled
+
+
 def get_file_path(name: Union[str, Path], root=None, ext=".h5"):
     """From a base name, get the Path object that specifies the 'ext' file in the '.cache' directory."""
     if root is None:
@@ -53,50 +61,136 @@ def _ap_series_to_ap(ap_series):
             }
 
 
+def ap_to_series(AP):
+    """Copy hoc `APCount` objects (as returned by `get_trace`) to a pandas Series of counts"""
+    apn = {}
+    if isinstance(AP, dict):
+        for key, val in AP.items():
+            if isinstance(val, list):
+                apn[key] = tuple([sub_val.n for sub_val in val])
+            else:
+                apn[key] = val.n
+    else:
+        apn["soma"] = AP.n
+
+    return pd.Series(apn)
+
+
+def events_to_frames(ap_times: pd.Series):
+    """Split AP times per site (as from `get_trace` with an `events` plan, e.g. `SPIKE_PLAN`) into a DataFrame of the
+    sites and a DataFrame of (site number, time) per AP, which (unlike arrays in a Series) can be stored as tables.
+    """
+    sites = ap_times.index.to_frame(index=False)
+    n_aps = [len(times) for times in ap_times.values]
+    times = np.concatenate([np.asarray(times, dtype=float) for times in ap_times.values]) if len(n_aps) else []
+    events = pd.DataFrame({"site": np.repeat(np.arange(len(n_aps)), n_aps), TIME_LABEL: times})
+    return sites, events
+
+
+def frames_to_events(sites: pd.DataFrame, events: pd.DataFrame) -> pd.Series:
+    """Inverse of `events_to_frames`"""
+    site_idx = events["site"].values
+    times = events[TIME_LABEL].values
+    return pd.Series([times[site_idx == i] for i in range(len(sites))],
+                     index=pd.MultiIndex.from_frame(sites), dtype=object)
+
+
+def load_cached_df(name, cache_root=None):
+    """Load the AP counts and (if saved) the voltage DataFrame (or AP times, see `events_to_frames`) stored under
+    `name` in the `cache_root`."""
+    path = get_file_path(name, root=cache_root)
+    with stage("load") as info:
+        try:
+            x_df = pd.read_hdf(path, "df")
+        except KeyError:
+            try:
+                x_df = frames_to_events(pd.read_hdf(path, "sites"), pd.read_hdf(path, "events"))
+            except KeyError:
+                x_df = None
+        ap_series = pd.read_hdf(path, "apn")
+        info["bytes_read"] = path.stat().st_size
+    AP = _ap_series_to_ap(ap_series)
+    return AP, x_df
+
+
+def save_cached_df(name, ap_series, x_df=None, cache_root=None):
+    """Store AP counts (see `ap_to_series`) and voltage DataFrame (or AP times) under `name` in the `cache_root`.
+
+    The file is written in full under a temporary name before it replaces any file at its path, so that an interrupted
+    write never leaves a file that looks cached.
+    """
+    # (imported here, as only the processes that save need PyTables)
+    from tables import NaturalNameWarning
+
+    path = get_file_path(name, root=cache_root)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    if tmp_path.exists():
+        os.remove(tmp_path)
+
+    with stage("save") as info:
+        if isinstance(x_df, pd.Series):
+            # AP times per site (see `RecordingPlan`)
+            sites, events = events_to_frames(x_df)
+            with warnings.catch_warnings():
+                warnings.filterwarnings('ignore', category=NaturalNameWarning)
+                # (the "fixed" format pads section names to a large size)
+                sites.to_hdf(tmp_path, "/sites", "w", complevel=7, format="table")
+                events.to_hdf(tmp_path, "/events", complevel=7, format="table")
+        elif x_df is not None:
+            with warnings.catch_warnings():
+                warnings.filterwarnings('ignore', category=NaturalNameWarning)
+                x_df.to_hdf(tmp_path, f"/df", "w", complevel=7)
+
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', category=Warning)
+            ap_series.to_hdf(tmp_path, f"/apn", complevel=7)
+
+        os.replace(tmp_path, path)
+        info["bytes_written"] = path.stat().st_size
+    return path
+
+
+def is_saved(name, cache_root=None):
+    """Whether `name` is in the `cache_root` and can be read (e.g. not left by an interrupted write of an old version)"""
+    path = get_file_path(name, root=cache_root)
+    if not path.exists():
+        return False
+    try:
+        with pd.HDFStore(path, "r") as hdf:
+            return "/apn" in hdf.keys()
+    except Exception:
+        return False
+
+
 def get_cached_df(name, *args, **kwargs):
     """Like `get_trace` but saves a copy.
 
     Internally, calls `get_trace` if it cannot find a local cached version according to `name` in the `cache_root`.
+    With `content=True` (default: see `set_content_cache`), the cache key is instead the hash of everything that
+    affects the result (see `get_content_cached_df`), so that a changed model is never loaded from a stale name (runs
+    loaded by `name` alone, without the arguments of `get_trace`, still are).
     """
     cache_root = kwargs.pop("cache_root", None)
+    if kwargs.pop("content", _content_cache) and len(args):
+        # (imported here, as `src.cache` imports this module)
+        from src.cache import get_content_cached_df
+
+        return get_content_cached_df(*args, cache_root=cache_root, **kwargs)
 
     path = get_file_path(name, root=cache_root)
     is_test = "test" in name
 
     if not is_test and path.exists():
-        try:
-            x_df = pd.read_hdf(path, "df")
-        except KeyError:
-            x_df = None
-        ap_series = pd.read_hdf(path, "apn")
-        AP = _ap_series_to_ap(ap_series)
-        return AP, x_df
+        return load_cached_df(path, cache_root=cache_root)
 
     t, v, AP, x_df = get_trace(*args, **kwargs)
 
-    if x_df is not None and not is_test:
-        with warnings.catch_warnings():
-            warnings.filterwarnings('ignore', category=NaturalNameWarning)
-            x_df.to_hdf(path, f"/df", "w", complevel=7)
-
-    apn = {}
-    if isinstance(AP, dict):
-        for key, val in AP.items():
-            if isinstance(val, list):
-                apn[key] = tuple([sub_val.n for sub_val in val])
-            else:
-                apn[key] = val.n
-    else:
-        apn["soma"] = AP.n
-
     # copy hoc data to a pandas Series
-    ap_series = pd.Series(apn)
+    ap_series = ap_to_series(AP)
     AP = _ap_series_to_ap(ap_series)
 
     if not is_test:
-        with warnings.catch_warnings():
-            warnings.filterwarnings('ignore', category=Warning)
-            ap_series.to_hdf(path, f"/apn", complevel=7)
+        save_cached_df(path, ap_series, x_df, cache_root=cache_root)
 
     return AP, x_df
 
@@ -108,11 +202,94 @@ def wide_to_long(df):
     return new_df
 
 
+class LongView:
+    """Long-form view of a wide voltage DataFrame (see `get_trace`) that is only melted when (and where) needed.
+
+    Rows are in the same order as `wide_to_long`, but with float times, distances and voltages and categorical
+    section names. Use `sel` to restrict the view to sections and/or a time window, and `to_frame` (or `chunks`) to
+    build long DataFrames.
+    """
+
+    def __init__(self, x_df: pd.DataFrame):
+        self.wide = x_df
+
+    @property
+    def columns(self):
+        return pd.Index([TIME_LABEL, SECTION_LABEL, DISTANCE_LABEL, VOLTAGE_LABEL])
+
+    @property
+    def shape(self):
+        return self.wide.size, len(self.columns)
+
+    def __len__(self):
+        return self.wide.size
+
+    def copy(self):
+        # the wide DataFrame is never modified by the view
+        return LongView(self.wide)
+
+    def sel(self, secs=None, time=None) -> "LongView":
+        """View of only section(s) `secs` and/or a `time` window (a start time or a (start, end) tuple)"""
+        x_df = self.wide
+        if secs is not None:
+            if isinstance(secs, str):
+                secs = [secs]
+            x_df = x_df.loc[:, x_df.columns.get_level_values(SECTION_LABEL).isin(secs)]
+        if time is not None:
+            x_df = x_df.loc[_time_mask(x_df.index.values, time)]
+        return LongView(x_df)
+
+    def _sections(self, col_slice=slice(None)):
+        sec_names = self.wide.columns.get_level_values(SECTION_LABEL)
+        codes, categories = pd.factorize(sec_names)
+        return pd.Categorical.from_codes(np.repeat(codes[col_slice], len(self.wide.index)), categories)
+
+    def _get_column(self, label, col_slice=slice(None)):
+        x_df = self.wide
+        n_t = len(x_df.index)
+        n_cols = len(x_df.columns[col_slice])
+        if label == TIME_LABEL:
+            return np.tile(x_df.index.values.astype(float), n_cols)
+        elif label == SECTION_LABEL:
+            return self._sections(col_slice)
+        elif label == DISTANCE_LABEL:
+            return np.repeat(x_df.columns.get_level_values(DISTANCE_LABEL).values[col_slice].astype(float), n_t)
+        elif label == VOLTAGE_LABEL:
+            return x_df.values[:, col_slice].T.ravel()
+        raise KeyError(label)
+
+    def __getitem__(self, label) -> pd.Series:
+        return pd.Series(self._get_column(label), name=label)
+
+    def chunks(self, n_cols=50):
+        """Long DataFrames of `n_cols` segments at a time (with the same index as in `to_frame`)"""
+        n_t = len(self.wide.index)
+        for col_start in range(0, len(self.wide.columns), n_cols):
+            col_slice = slice(col_start, col_start + n_cols)
+            chunk_df = pd.DataFrame({label: self._get_column(label, col_slice) for label in self.columns})
+            chunk_df.index += col_start*n_t
+            yield chunk_df
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame({label: self._get_column(label) for label in self.columns})
+
+
+def _time_mask(t, time):
+    if isinstance(time, float) or isinstance(time, int):
+        time = (time,)
+    mask = t >= time[0]
+    if len(time) > 1:
+        mask &= t <= time[1]
+    return mask
+
+
 def is_long_form(df):
     return isinstance(df, pd.DataFrame) and TIME_LABEL in df.columns
 
 
 def concise_df(long_df, soma=False):
+    if isinstance(long_df, LongView):
+        return _concise_view(long_df, soma=soma)
     assert is_long_form(long_df), "expected dataframe to be in long form"
 
     section_map = {"axon[1]": AIS_LABEL}
@@ -135,24 +312,68 @@ def concise_df(long_df, soma=False):
     return pd.concat([mask_long_df, ser], axis=1)
 
 
+def _concise_columns(x_df, soma=False):
+    # same selection as `concise_df`, but of columns of the wide DataFrame, and the site of each selected column
+    sec_names = x_df.columns.get_level_values(SECTION_LABEL)
+    distances = x_df.columns.get_level_values(DISTANCE_LABEL).values.astype(float)
+
+    soma_mask = distances == 0 if soma else distances < 0
+    axon_mask = distances == distances[sec_names == "axon[1]"].max()
+    node_mask = distances == distances.max()
+    mask = soma_mask | axon_mask | node_mask
+
+    section_map = {"axon[1]": AIS_LABEL}
+    sites = [section_map.get(sec_name, TERMINAL_LABEL) for sec_name in sec_names[mask]]
+    return mask, sites
+
+
+def _concise_view(long_view, soma=False):
+    # only the selected columns are melted
+    x_df = long_view.wide
+    mask, _ = _concise_columns(x_df, soma=soma)
+    mask_long_df = LongView(x_df.loc[:, mask]).to_frame()
+
+    section_map = {"axon[1]": AIS_LABEL}
+    ser = mask_long_df[SECTION_LABEL].map(
+        lambda x: section_map.get(x, TERMINAL_LABEL)).astype(str)
+    ser.name = SITE_LABEL
+
+    return pd.concat([mask_long_df, ser], axis=1)
+
+
+def long_to_wide(long_df):
+    """Inverse of `wide_to_long` (time x (section, distance) columns, in order of appearance)"""
+    return long_df.pivot_table(index=TIME_LABEL, columns=[SECTION_LABEL, DISTANCE_LABEL], values=VOLTAGE_LABEL,
+                               sort=False).astype(float)
+
+
 if __name__ == "__main__":
-    import numpy as np
+    import tempfile
+
     try:
-        from pv_nrn import get_pv
+        from pv_nrn import get_mechanisms_path, get_pv, init_nrn
     except ImportError:
         print("must be run from `pv-scn1a` directory")
+    init_nrn(get_mechanisms_path())
     pv = get_pv()
     amp = 0.1
     dur = 10
-    test_name = "test"
-    test_path = Path(".cache") / f"{test_name}.h5"
 
-    if test_path.exists():
-        os.remove(test_path)
-        assert not test_path.exists()
+    with tempfile.TemporaryDirectory() as cache_root:
+        # runs with "test" in their name are never saved
+        get_cached_df("test", pv, amp, dur, shape_plot=True, cache_root=cache_root)
+        assert not get_file_path("test", root=cache_root).exists()
+
+        name = "check_data"
+        AP, _df = get_cached_df(name, pv, amp, dur, shape_plot=True, cache_root=cache_root)
+
+        long_view = LongView(_df)
+        assert np.allclose(long_view.to_frame()[VOLTAGE_LABEL],
+                           wide_to_long(_df)[VOLTAGE_LABEL].astype(float)), "long view differs from `wide_to_long`!"
+        assert concise_df(long_view).shape == concise_df(wide_to_long(_df)).shape
 
-    AP, _df = get_cached_df("test", pv, amp, dur, shape_plot=True)
-    assert test_path.exists()
+        assert get_file_path(name, root=cache_root).exists()
 
-    AP, loaded_df = get_cached_df(test_path)
-    assert np.all(loaded_df == _df), "values weren't stored/loaded properly!"
+        loaded_AP, loaded_df = get_cached_df(name, cache_root=cache_root)
+        assert np.all(loaded_df == _df), "values weren't stored/loaded properly!"
+        assert all(loaded_AP[site].n == AP[site].n for site in AP if not isinstance(AP[site], list))
@@ -0,0 +1,176 @@
+"""F-I curves (firing rate per step current amplitude) of many cells or Nav1.1 configurations, across a pool of worker
+processes (as `run_sweep`).
+
+Per configuration, the rheobase is found by bisection, and amplitudes are then added where the curve bends, instead of
+simulating a fixed list of amplitudes (as `getIF`). Runs end early once the firing state is clear (see `get_rates`).
+The result is a tidy table with a row per (configuration, amplitude, APCount site):
+
+    fi_df = run_fi(pv, [("somatic", "ais", "nodes")], [0.5, 1])
+"""
+import logging
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+
+import numpy as np
+import pandas as pd
+
+from pv_nrn import get_pv_params, pvParams, reset_biophys
+from src.constants import (AIS_LABEL, CURRENT_LABEL, FIRING_RATE_LABEL, NAV_FRAC_LABEL, NAV_SECTIONS_LABEL,
+                           RHEOBASE_LABEL, SECTION_LABEL, SITE_LABEL, SOMA_LABEL, TERMINAL_LABEL)
+from src.run import LVARDT, EarlyStop, get_rates, set_nav_frac
+from src.sweep import _get_pool, _init_worker
+from src.utils import format_nav_loc
+
+logger = logging.getLogger("fi")
+
+# sections of the APCount sites of `get_trace` (the "props" sites are the nodes)
+SITE_SECTIONS = {"soma": SOMA_LABEL, "init": AIS_LABEL, "comm": TERMINAL_LABEL}
+
+
+def _round_amp(amp, amp_tol):
+    return round(float(amp), max(2, int(np.ceil(-np.log10(amp_tol))) + 1))
+
+
+def find_rheobase(nrn_cell, max_amp=1., amp_tol=0.01, dur=500, solver=None, early_stop=EarlyStop(), results=None):
+    """Smallest amplitude (nA, to within `amp_tol`) at which the soma fires, by bisection between 0 and `max_amp`.
+
+    Returns NaN if the soma doesn't fire at `max_amp`. Every `get_rates` result is added to `results` (per amplitude).
+    """
+    if results is None:
+        results = {}
+
+    def fires(amp):
+        if amp not in results:
+            results[amp] = get_rates(nrn_cell, amp, dur, solver=solver, early_stop=early_stop)
+        return results[amp][0]["soma"] > 0
+
+    lo, hi = 0., _round_amp(max_amp, amp_tol)
+    if not fires(hi):
+        return np.nan
+    while hi - lo > amp_tol*(1 + 1e-9):
+        mid = _round_amp((lo + hi)/2, amp_tol)
+        if fires(mid):
+            hi = mid
+        else:
+            lo = mid
+    return hi
+
+
+def _bends(amps, rates, rate_tol):
+    # intervals next to points that are more than `rate_tol` from the line through their neighbours
+    intervals = set()
+    for i in range(1, len(amps) - 1):
+        line_rate = np.interp(amps[i], [amps[i - 1], amps[i + 1]], [rates[i - 1], rates[i + 1]])
+        if abs(rates[i] - line_rate) > rate_tol:
+            intervals.update([(amps[i - 1], amps[i]), (amps[i], amps[i + 1])])
+    return sorted(intervals)
+
+
+def get_fi_curve(nrn_cell, max_amp=1., n_amps=5, amp_tol=0.01, rate_tol=5., max_points=30, dur=500, solver=None,
+                 early_stop=EarlyStop()) -> pd.DataFrame:
+    """F-I curve of `nrn_cell` from its rheobase (see `find_rheobase`) to `max_amp`.
+
+    Starts with `n_amps` amplitudes, then adds the midpoints of intervals where the somatic rate bends by more than
+    `rate_tol` Hz (see `_bends`), until no more are needed or `max_points` amplitudes were run.
+    Returns a tidy DataFrame with the rate at every APCount site (see `get_rates`) per amplitude.
+    """
+    results = {}
+    rheobase = find_rheobase(nrn_cell, max_amp, amp_tol, dur, solver, early_stop, results)
+    if not np.isnan(rheobase):
+        for amp in np.linspace(rheobase, max_amp, n_amps):
+            amp = _round_amp(amp, amp_tol)
+            if amp not in results:
+                results[amp] = get_rates(nrn_cell, amp, dur, solver=solver, early_stop=early_stop)
+
+        while len(results) < max_points:
+            amps = sorted(amp for amp in results if amp >= rheobase)
+            new_amps = {_round_amp((lo + hi)/2, amp_tol)
+                        for lo, hi in _bends(amps, [results[amp][0]["soma"] for amp in amps], rate_tol)
+                        if hi - lo > amp_tol*(1 + 1e-9)} - set(results)
+            if not new_amps:
+                break
+            for amp in sorted(new_amps)[:max_points - len(results)]:
+                results[amp] = get_rates(nrn_cell, amp, dur, solver=solver, early_stop=early_stop)
+
+    rows = []
+    for amp in sorted(results):
+        rates, state, stop_time = results[amp]
+        for site, rate in rates.items():
+            rows.append({
+                CURRENT_LABEL: amp,
+                SITE_LABEL: site,
+                SECTION_LABEL: SITE_SECTIONS.get(site, site.replace("props", "node")),
+                FIRING_RATE_LABEL: rate,
+                RHEOBASE_LABEL: rheobase,
+                "state": state,
+                "stop_time": stop_time,
+            })
+    return pd.DataFrame(rows)
+
+
+def fi_key(pv_name, pv_params, nav_loc, frac, reset_biophys=reset_biophys, **kwargs):
+    """`get_fi_curve` of this process' cell with Nav1.1 at `frac` of baseline at `nav_loc` (see `set_nav_frac`)
+
+    The default solver is `LVARDT` (see `run_key`).
+    """
+    if kwargs.get("solver") is None:
+        kwargs["solver"] = LVARDT
+    pool = _get_pool(pv_name, pvParams(*pv_params), reset_biophys, n_cells=1)
+    with pool.borrow() as pv:
+        set_nav_frac(pv, frac, nav_loc, pool.base_nav)
+        fi_df = get_fi_curve(pv, **kwargs)
+    fi_df.insert(0, NAV_FRAC_LABEL, frac)
+    fi_df.insert(0, NAV_SECTIONS_LABEL, format_nav_loc(nav_loc))
+    fi_df.insert(0, "pv", pv_name)
+    return fi_df
+
+
+def run_fi(pvs, nav_loc_changes, fractions, reset_biophys=reset_biophys, n_workers=None, mechanisms=None,
+           mp_context="spawn", **kwargs) -> pd.DataFrame:
+    """`get_fi_curve` of every cell in `pvs` (one or a list) for every (nav_loc, frac), on `n_workers` processes.
+
+    Keyword arguments are passed to `get_fi_curve`. See `run_sweep` for `reset_biophys`, `mechanisms` and
+    `mp_context`. Returns the tidy DataFrames of every configuration together (in order).
+    """
+    if not isinstance(pvs, (list, tuple)):
+        pvs = [pvs]
+    configs = [(*get_pv_params(pv), nav_loc, frac) for pv, nav_loc, frac in product(pvs, nav_loc_changes, fractions)]
+    n_workers = min(n_workers or os.cpu_count(), len(configs))
+    with ProcessPoolExecutor(n_workers,
+                             mp_context=mp.get_context(mp_context),
+                             initializer=_init_worker,
+                             initargs=(mechanisms,)) as pool:
+        futures = [pool.submit(fi_key, pv_name, pv_params, nav_loc, frac, reset_biophys=reset_biophys, **kwargs)
+                   for pv_name, pv_params, nav_loc, frac in configs]
+        fi_dfs = [future.result() for future in futures]
+    fi_df = pd.concat(fi_dfs, ignore_index=True)
+    logger.info(f"{fi_df.groupby(['pv', NAV_SECTIONS_LABEL, NAV_FRAC_LABEL])[CURRENT_LABEL].nunique().sum()} "
+                f"amplitudes for {len(configs)} configurations")
+    return fi_df
+
+
+if __name__ == "__main__":
+    from pv_nrn import get_mechanisms_path, init_nrn
+    from src.run import getIF
+
+    mechanisms = get_mechanisms_path()
+    init_nrn(mechanisms)
+    pv = _get_pool("test_fi", pvParams(1000., 33., 1., 26.5), reset_biophys).cells[0]
+
+    fi_df = get_fi_curve(pv, max_amp=0.4, n_amps=3, amp_tol=0.02, max_points=8, dur=200)
+    soma_df = fi_df[fi_df[SITE_LABEL] == "soma"]
+    rheobase = soma_df[RHEOBASE_LABEL].iloc[0]
+    assert np.all(soma_df.loc[soma_df[CURRENT_LABEL] < rheobase, FIRING_RATE_LABEL] == 0)
+    assert np.all(soma_df.loc[soma_df[CURRENT_LABEL] >= rheobase, FIRING_RATE_LABEL] > 0)
+    assert soma_df[CURRENT_LABEL].nunique() <= 8
+    assert set(fi_df[SITE_LABEL]) >= {"soma", "init", "comm", "props[0]"}
+
+    # rates (of a short run, which isn't stopped early) are as from `getIF`
+    assert getIF([0.3], pv, dur=40, ap_secs="soma") == getIF([0.3], pv, dur=40, ap_secs="soma",
+                                                               early_stop=EarlyStop())
+
+    fi_df = run_fi(pv, ["nodes"], [1, 0.1], n_workers=2, mechanisms=mechanisms, max_amp=0.4, n_amps=2, amp_tol=0.1,
+                   dur=100)
+    assert set(fi_df[NAV_FRAC_LABEL]) == {1, 0.1}
@@ -0,0 +1,264 @@
+"""Render many figures of sweep results (see `run_sweep`) in parallel, from the cache, and only when their inputs change.
+
+Each figure is a `FigureSpec`: a plot function (importable by the workers) that takes the cached results of its keys
+and returns a figure, which is saved by `save_fig`. Figures are rendered and saved (in every format) on a pool of
+worker processes. A figure is skipped if its outputs exist and nothing it depends on changed since it was rendered:
+its cached results, the plot function (the file it is defined in, and `src/vis.py`) and its arguments (see
+`get_input_hash`).
+
+    specs = get_sweep_figure_specs(pv, stims, nav_loc_changes, fractions, dur)
+    render_figures(specs)
+"""
+import hashlib
+import inspect
+import json
+import logging
+import multiprocessing as mp
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.cache import describe, get_file_hash
+from src.data import get_file_path, load_cached_df
+from src.sweep import get_sweep_keys
+from src.utils import format_nav_loc
+
+logger = logging.getLogger("figures")
+
+# `plot` is called as `plot(data, **kwargs)`, where `data` is a dict of key to (AP, x_df), and returns a figure
+FigureSpec = namedtuple("FigureSpec", "name plot keys kwargs formats", defaults=({}, ("png", "pdf")))
+
+# files every figure depends on: `src/vis.py` has the default style of the workers (see `_init_worker`) and the plotting
+# functions, which plot functions (e.g. `plot_voltage_grid`) import within the function
+_PLOT_MODULES = (Path(__file__).parent / "vis.py",)
+
+RENDERED = "rendered"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+
+def _key_stat(key, cache_root=None, store=None):
+    # changes when a key is saved again (writes are atomic, see `save_cached_df`)
+    if store is not None:
+        path = store.root / "runs" / f"{key}.npy"
+        row = store.index.loc[key].to_json() if key in store else None
+        return [row, path.stat().st_mtime_ns if path.exists() else None]
+    path = get_file_path(key, root=cache_root)
+    if not path.exists():
+        return None
+    stat = path.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _get_plot_files(plot):
+    # the file of `plot`, those of the modules of this package it uses (as globals) and `_PLOT_MODULES`
+    package_dir = Path(__file__).parent.parent.resolve()
+    plot_files = {Path(inspect.getsourcefile(plot)).resolve(), *(path.resolve() for path in _PLOT_MODULES)}
+    for name in plot.__code__.co_names:
+        value = plot.__globals__.get(name)
+        module = value if inspect.ismodule(value) else inspect.getmodule(value)
+        module_file = getattr(module, "__file__", None)
+        if module_file is not None and package_dir in Path(module_file).resolve().parents:
+            plot_files.add(Path(module_file).resolve())
+    return sorted(plot_files)
+
+
+def get_input_hash(spec: FigureSpec, cache_root=None, store=None):
+    """Hash of what a figure depends on: its keys' cached results, plot function (and the modules it uses, see
+    `_get_plot_files`) and arguments"""
+    state = {
+        "plot": describe(spec.plot),
+        "plot_files": {path.name: get_file_hash(path) for path in _get_plot_files(spec.plot)},
+        "kwargs": {key: describe(val) for key, val in spec.kwargs.items()},
+        "formats": list(spec.formats),
+        "keys": {key: _key_stat(key, cache_root, store) for key in spec.keys},
+    }
+    return hashlib.sha1(json.dumps(state, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _init_worker():
+    import matplotlib
+    matplotlib.use("Agg")
+    from src.vis import set_default_style
+    set_default_style()
+
+
+def render_figure(spec: FigureSpec, cache_root=None, store=None, save_root="save"):
+    """Load the results of a figure's keys from the cache (or `store`), plot and save it. Returns the saved paths."""
+    import matplotlib.pyplot as plt
+    from src.vis import save_fig
+
+    data = {}
+    for key in spec.keys:
+        if store is None:
+            data[key] = load_cached_df(key, cache_root=cache_root)
+        else:
+            data[key] = store.get_ap(key), store.load_df(key)
+    fig = spec.plot(data, **spec.kwargs)
+    try:
+        return save_fig(spec.name, formats=spec.formats, fig=fig, root=save_root)
+    finally:
+        plt.close(fig)
+
+
+def _timed_render_figure(*args, **kwargs):
+    start = time.perf_counter()
+    paths = render_figure(*args, **kwargs)
+    return time.perf_counter() - start, paths
+
+
+def _load_record(path):
+    return json.loads(path.read_text()) if path.exists() else {}
+
+
+def _save_record(path, record):
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    tmp_path.write_text(json.dumps(record, indent=1, sort_keys=True))
+    os.replace(tmp_path, path)
+
+
+def render_figures(specs, n_workers=None, cache_root=None, store=None, save_root="save", force=False,
+                   mp_context="spawn") -> pd.DataFrame:
+    """Render the figures of `specs` whose inputs changed (or all if `force`) on `n_workers` processes.
+
+    The input hash of every rendered figure is kept in `figures.json` in the `save_root`. Figures that fail are logged
+    and rendered again next time. Returns a DataFrame with the status and render time (s) of every figure.
+    """
+    Path(save_root).mkdir(parents=True, exist_ok=True)
+    record_path = Path(save_root) / "figures.json"
+    record = _load_record(record_path)
+
+    rows = {}
+    todo = {}
+    for spec in specs:
+        input_hash = get_input_hash(spec, cache_root, store)
+        name = spec.name if spec.name.startswith("fig_") else f"fig_{spec.name}"
+        outputs_exist = all(get_file_path(name, root=save_root, ext=fmt).exists() for fmt in spec.formats)
+        if not force and outputs_exist and record.get(spec.name) == input_hash:
+            rows[spec.name] = {"name": spec.name, "status": SKIPPED, "time": np.nan}
+        else:
+            todo[spec.name] = (spec, input_hash)
+    logger.info(f"{len(specs) - len(todo)}/{len(specs)} figures up to date")
+
+    if len(todo):
+        n_workers = min(n_workers or os.cpu_count(), len(todo))
+        with ProcessPoolExecutor(n_workers,
+                                 mp_context=mp.get_context(mp_context),
+                                 initializer=_init_worker) as pool:
+            futures = {pool.submit(_timed_render_figure, spec, cache_root=cache_root, store=store,
+                                   save_root=save_root): name
+                       for name, (spec, _) in todo.items()}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    duration, _ = future.result()
+                except Exception:
+                    logger.exception(f"figure {name} failed")
+                    record.pop(name, None)
+                    rows[name] = {"name": name, "status": FAILED, "time": np.nan}
+                else:
+                    record[name] = todo[name][1]
+                    rows[name] = {"name": name, "status": RENDERED, "time": duration}
+                _save_record(record_path, record)
+
+    return pd.DataFrame([rows[spec.name] for spec in specs], columns=["name", "status", "time"])
+
+
+def plot_voltage_grid(data, grid, row_labels=None, col_labels=None, concise=True, backend="lines", lw=0.5,
+                      **kwargs):
+    """Figure of the voltage traces (see `plot_voltage_trace`) of the keys in `grid` (a list of rows of keys)"""
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    from src.vis import plot_voltage_trace
+
+    n_rows, n_cols = len(grid), len(grid[0])
+    fig, axes = plt.subplots(nrows=n_rows, ncols=n_cols, squeeze=False, sharex=True, sharey=True,
+                             figsize=(n_cols*1.5, n_rows), gridspec_kw=dict(wspace=0.2, hspace=0.1))
+    for i, row in enumerate(grid):
+        for j, key in enumerate(row):
+            ax = axes[i, j]
+            _, x_df = data[key]
+            plot_voltage_trace(x_df, concise=concise, thresh=False, backend=backend, lw=lw, ax=ax,
+                               legend="brief" if (i == 0 and j == n_cols - 1) else False, **kwargs)
+            ax.set(xlabel="", ylabel="")
+            if i == 0 and col_labels is not None:
+                ax.set_title(col_labels[j], fontsize="small")
+            if j == 0 and row_labels is not None:
+                ax.set_ylabel(row_labels[i], fontsize="small")
+    if axes[0, -1].get_legend() is not None:
+        sns.move_legend(axes[0, -1], "upper left", bbox_to_anchor=(1.05, 1), frameon=False, fontsize="x-small")
+    return fig
+
+
+def get_sweep_figure_specs(pv, stims, nav_loc_changes, fractions, dur, name="voltage_grid", solver=None,
+                           init_state=None, shape_plot=True, formats=("png", "pdf"), **kwargs):
+    """A `plot_voltage_grid` figure per stimulus of a sweep, with a row per nav_loc and a column per fraction.
+
+    The keys are those of `run_sweep` with the same arguments. Keyword arguments are passed to `plot_voltage_grid`.
+    """
+    sweep_keys = get_sweep_keys(pv, stims, nav_loc_changes, fractions, dur, solver=solver, init_state=init_state,
+                                shape_plot=shape_plot)
+    # in the order of `product(stims, nav_loc_changes, fractions)`
+    keys = np.array([key for key, *_ in sweep_keys], dtype=object).reshape(len(stims), len(nav_loc_changes),
+                                                                          len(fractions))
+    specs = []
+    for stim, stim_keys in zip(stims, keys):
+        amp, freq = stim
+        grid = stim_keys.tolist()
+        specs.append(FigureSpec(f"{name}_{pv.name}_{amp}_{freq}_{dur}",
+                                plot_voltage_grid,
+                                [key for row in grid for key in row],
+                                dict(grid=grid,
+                                     row_labels=[format_nav_loc(nav_loc) for nav_loc in nav_loc_changes],
+                                     col_labels=[f"{frac}" for frac in fractions],
+                                     **kwargs),
+                                formats))
+    return specs
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    from pv_nrn import get_mechanisms_path, init_nrn, pvParams, reset_biophys
+    from src.sweep import _get_pool, run_sweep
+
+    mechanisms = get_mechanisms_path()
+    init_nrn(mechanisms)
+    pv = _get_pool("test_figures", pvParams(1000., 33., 1., 26.5), reset_biophys).cells[0]
+    stims, nav_loc_changes, fractions, dur = [(0.75, 0), (0.75, 120)], ["ais", "nodes"], [1, 0.5], 20
+
+    with tempfile.TemporaryDirectory() as cache_root:
+        save_root = os.path.join(cache_root, "save")
+        run_sweep(pv, stims, nav_loc_changes, fractions, dur, n_workers=2, mechanisms=mechanisms,
+                  cache_root=cache_root)
+        specs = get_sweep_figure_specs(pv, stims, nav_loc_changes, fractions, dur)
+        assert len(specs) == len(stims) and len(specs[0].keys) == len(nav_loc_changes)*len(fractions)
+
+        status_df = render_figures(specs, n_workers=2, cache_root=cache_root, save_root=save_root)
+        assert (status_df["status"] == RENDERED).all(), status_df
+        assert len(list(Path(save_root).glob("fig_*.pdf"))) == len(specs)
+
+        # nothing changed
+        status_df = render_figures(specs, n_workers=2, cache_root=cache_root, save_root=save_root)
+        assert (status_df["status"] == SKIPPED).all(), status_df
+
+        # a key of the first figure is run again
+        os.remove(get_file_path(specs[0].keys[0], root=cache_root))
+        run_sweep(pv, stims[:1], nav_loc_changes[:1], fractions[:1], dur, n_workers=1, mechanisms=mechanisms,
+                  cache_root=cache_root)
+        status_df = render_figures(specs, n_workers=2, cache_root=cache_root, save_root=save_root)
+        assert status_df["status"].tolist() == [RENDERED, SKIPPED], status_df
+
+        # a plotting module changes
+        assert (Path(__file__).parent / "vis.py").resolve() in _get_plot_files(specs[0].plot)
+        plot_module = Path(cache_root) / "plot_module.py"
+        plot_module.write_text("STYLE = 1\n")
+        _PLOT_MODULES = (plot_module,)
+        input_hash = get_input_hash(specs[1], cache_root=cache_root)
+        plot_module.write_text("STYLE = 2\n")
+        assert get_input_hash(specs[1], cache_root=cache_root) != input_hash
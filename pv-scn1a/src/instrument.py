@@ -0,0 +1,228 @@
+"""Wall time and resources of each stage of simulation runs (cell build, biophysics, recorder setup, run, copy to a
+DataFrame, saving and loading), to find where the time of a sweep goes.
+
+Stages are recorded (see `StageRecord`) only while instrumentation is enabled, and otherwise cost a check of a flag.
+Records are kept in memory and, with a `path`, appended to a JSON lines file. Worker processes started while it is
+enabled (e.g. by `run_sweep`) inherit the `path` (through the `STAGES_ENV` environment variable) and append to it too:
+
+    with instrumented("stages.jsonl"):
+        run_sweep(pv, stims, nav_loc_changes, fractions, dur)
+    summarize_stages(get_stage_table("stages.jsonl"))
+
+Stages are added to code with `stage` (or the `staged` decorator), and runs (e.g. sweep keys) are labelled with
+`run_label`.
+"""
+import json
+import os
+import sys
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:
+    # (Windows)
+    resource = None
+
+# peak_rss (MB) is that of the process so far, after the stage. Fields a stage doesn't set are None.
+StageRecord = namedtuple("StageRecord", "time pid run stage wall_time n_steps n_vectors bytes_written bytes_read "
+                                        "peak_rss",
+                         defaults=(None,)*6)
+STAGES_ENV = "PV_STAGES_PATH"
+
+_enabled = False
+_path = None
+_records = []
+_run = None
+
+
+def enable(path=None):
+    """Record stages, in memory and (if given) in the JSON lines file at `path`, also by processes started from now"""
+    global _enabled, _path
+    _enabled = True
+    _path = None if path is None else Path(path)
+    if _path is not None:
+        _path.parent.mkdir(parents=True, exist_ok=True)
+        os.environ[STAGES_ENV] = str(_path)
+
+
+def disable():
+    global _enabled, _path
+    _enabled = False
+    _path = None
+    os.environ.pop(STAGES_ENV, None)
+
+
+def is_enabled():
+    return _enabled
+
+
+@contextmanager
+def instrumented(path=None):
+    """Record stages (see `enable`) within the context, starting with no records in memory"""
+    _records.clear()
+    enable(path)
+    try:
+        yield
+    finally:
+        disable()
+
+
+@contextmanager
+def run_label(label):
+    """Label the stages within the context with the run they are part of (e.g. a sweep key)"""
+    global _run
+    previous, _run = _run, label
+    try:
+        yield
+    finally:
+        _run = previous
+
+
+def _get_peak_rss():
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak_rss/1024**2 if sys.platform == "darwin" else peak_rss/1024
+
+
+def _add_record(record: StageRecord):
+    _records.append(record)
+    if _path is not None:
+        # a single (small) write per record, so that processes appending to the same file don't interleave records
+        with open(_path, "a") as f:
+            f.write(json.dumps(record._asdict()) + "\n")
+
+
+def record_stage(name, wall_time, **info):
+    """Record a stage timed by other means (e.g. across processes), if enabled"""
+    if _enabled:
+        _add_record(StageRecord(time.time(), os.getpid(), _run, name, wall_time, peak_rss=_get_peak_rss(), **info))
+
+
+@contextmanager
+def stage(name):
+    """Record the wall time of the code within the context as stage `name` of the current run.
+
+    Yields a dict, in which the code can set other fields of the `StageRecord` (e.g. "n_steps").
+    """
+    info = {}
+    if not _enabled:
+        yield info
+        return
+    start = time.perf_counter()
+    try:
+        yield info
+    finally:
+        record_stage(name, time.perf_counter() - start, **info)
+
+
+def staged(name):
+    """Decorator to record every call of a function as stage `name` (see `stage`)"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_stage_table(path=None):
+    """DataFrame of the stage records in the file at `path` (e.g. of a whole sweep), or of this process in memory"""
+    # (not imported by the processes that only record stages)
+    import pandas as pd
+
+    if path is None:
+        return pd.DataFrame(_records, columns=StageRecord._fields)
+    path = Path(path)
+    if not path.exists():
+        return pd.DataFrame(columns=StageRecord._fields)
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return pd.DataFrame(records, columns=StageRecord._fields)
+
+
+def summarize_stages(stage_df):
+    """Number of calls, total and mean wall time (s), totals of the other fields and the peak RSS (MB) per stage,
+    ordered by total wall time"""
+    summary = stage_df.groupby("stage").agg(
+        n=("wall_time", "size"),
+        wall_time=("wall_time", "sum"),
+        mean_wall_time=("wall_time", "mean"),
+        n_steps=("n_steps", "sum"),
+        n_vectors=("n_vectors", "sum"),
+        bytes_written=("bytes_written", "sum"),
+        bytes_read=("bytes_read", "sum"),
+        peak_rss=("peak_rss", "max"),
+    )
+    summary["fraction"] = summary["wall_time"]/summary["wall_time"].sum()
+    return summary.sort_values("wall_time", ascending=False)
+
+
+if os.environ.get(STAGES_ENV):
+    # a worker process started while instrumentation was enabled
+    enable(os.environ[STAGES_ENV])
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    import numpy as np
+
+    try:
+        from pv_nrn import get_mechanisms_path, init_nrn, pvParams, reset_biophys
+    except ImportError:
+        print("must be run from `pv-scn1a` directory")
+    from src.data import get_cached_df
+    from src.sweep import _get_pool, run_sweep
+    # the hooks use the imported module, rather than this one (`__main__`)
+    from src.instrument import get_stage_table, instrumented, run_label, stage
+
+    mechanisms = get_mechanisms_path()
+    init_nrn(mechanisms)
+    pv = _get_pool("test_instrument", pvParams(1000., 33., 1., 26.5), reset_biophys).cells[0]
+    stims, nav_loc_changes, fractions, dur = [(0.75, 0)], ["ais"], [1, 0.5], 20
+
+    with tempfile.TemporaryDirectory() as cache_root:
+        get_cached_df("instrument", pv, 0.75, dur, shape_plot=True, cache_root=cache_root)
+        assert len(get_stage_table()) == 0, "expected no records when disabled"
+
+        with instrumented():
+            with run_label("cached"):
+                get_cached_df("instrument", pv, 0.75, dur, shape_plot=True, cache_root=cache_root)
+        stage_df = get_stage_table()
+        assert stage_df["stage"].tolist() == ["load"] and stage_df["run"].tolist() == ["cached"]
+        assert stage_df["bytes_read"].iloc[0] > 0 and stage_df["peak_rss"].iloc[0] > 0
+
+        path = os.path.join(cache_root, "stages.jsonl")
+        with instrumented(path):
+            run_sweep(pv, stims, nav_loc_changes, fractions, dur, n_workers=2, mechanisms=mechanisms,
+                      cache_root=cache_root)
+        assert STAGES_ENV not in os.environ
+        stage_df = get_stage_table(path)
+        # workers start, build their cells, then run each key
+        assert set(stage_df["stage"]) == {"startup", "build", "biophys", "record", "run", "collect",
+                                          "restore_biophys", "save"}
+        assert stage_df["pid"].nunique() == 3
+        assert len(stage_df.query("stage == 'startup'")) == 2, "expected a startup record per worker"
+        assert (stage_df.query("stage == 'run'")["n_steps"] > 0).all()
+        assert (stage_df.query("stage == 'save'")["bytes_written"] > 0).all()
+        assert stage_df.query("stage == 'run'")["run"].nunique() == len(fractions)
+        summary_df = summarize_stages(stage_df)
+        assert summary_df.loc["save", "n"] == len(fractions) and np.isclose(summary_df["fraction"].sum(), 1)
+        print(summary_df)
+
+    # overhead of a stage when disabled
+    n = 100000
+    start = time.perf_counter()
+    for _ in range(n):
+        with stage("overhead"):
+            pass
+    print(f"{(time.perf_counter() - start)/n*1e6:.2f} μs per disabled stage")
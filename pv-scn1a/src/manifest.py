@@ -0,0 +1,242 @@
+"""Manifest of the keys of sweeps (see `run_sweep`), to restart an interrupted sweep without running its keys again.
+
+The manifest is an SQLite database with a row per key: its status (pending, running, done or failed), attempts,
+timing, error and where it is cached. It also keeps the arguments of every sweep, so that a sweep can be resumed from
+the command line (e.g. after the job was preempted)::
+
+    run_sweep(pv, stims, nav_loc_changes, fractions, dur, manifest=SweepManifest("sweep.sqlite"))
+
+    python -m src.manifest sweep.sqlite            # status of every key
+    python -m src.manifest sweep.sqlite --resume   # run the keys that aren't done
+
+Every change is a single SQLite transaction, so the manifest is consistent after a crash. Keys left "running" by an
+interrupted sweep are pending again when it is resumed.
+"""
+import argparse
+import logging
+import pickle
+import sqlite3
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from src.data import get_cache_root
+
+logger = logging.getLogger("manifest")
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sweeps (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created REAL,
+    n_keys INTEGER,
+    args BLOB
+);
+CREATE TABLE IF NOT EXISTS keys (
+    key TEXT PRIMARY KEY,
+    sweep INTEGER,
+    stim TEXT,
+    nav_loc TEXT,
+    frac REAL,
+    dur REAL,
+    status TEXT,
+    attempts INTEGER DEFAULT 0,
+    started REAL,
+    finished REAL,
+    duration REAL,
+    error TEXT,
+    location TEXT
+);
+"""
+
+
+class SweepManifest:
+    """SQLite manifest of sweep keys (see module docs)"""
+
+    def __init__(self, path=None):
+        if path is None:
+            path = Path(get_cache_root()) / "manifest.sqlite"
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        con = self._connect()
+        try:
+            con.executescript(_SCHEMA)
+        finally:
+            con.close()
+
+    def _connect(self):
+        # as a context manager, a connection commits (or rolls back) a transaction, but isn't closed
+        return sqlite3.connect(self.path, timeout=60)
+
+    def _execute(self, sql, params=()):
+        con = self._connect()
+        try:
+            with con:
+                return con.execute(sql, params).fetchall()
+        finally:
+            con.close()
+
+    def _executemany(self, sql, rows):
+        con = self._connect()
+        try:
+            with con:
+                con.executemany(sql, rows)
+        finally:
+            con.close()
+
+    def add_sweep(self, sweep_keys, args: dict) -> int:
+        """Add a sweep's keys (see `get_sweep_keys`) as pending (unless already in the manifest) and its `args` (those
+        of `run_sweep`, with the cell as `pv_name` and `pv_params`)"""
+        con = self._connect()
+        try:
+            with con:
+                sweep = con.execute("INSERT INTO sweeps (created, n_keys, args) VALUES (?, ?, ?)",
+                                    (time.time(), len(sweep_keys), pickle.dumps(args))).lastrowid
+                con.executemany("INSERT OR IGNORE INTO keys (key, sweep, stim, nav_loc, frac, dur, status) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                [(key, sweep, str(stim), str(nav_loc), frac, args["dur"], PENDING)
+                                 for key, stim, nav_loc, frac in sweep_keys])
+        finally:
+            con.close()
+        return sweep
+
+    def get_sweep_args(self, sweep=None) -> dict:
+        """Arguments of a sweep (default: the last one added)"""
+        if sweep is None:
+            rows = self._execute("SELECT args FROM sweeps ORDER BY id DESC LIMIT 1")
+        else:
+            rows = self._execute("SELECT args FROM sweeps WHERE id = ?", (sweep,))
+        if not rows:
+            raise KeyError(f"no sweep {sweep} in {self.path}")
+        return pickle.loads(rows[0][0])
+
+    def get_status(self, keys) -> dict:
+        """Status of each of `keys` (None if not in the manifest)"""
+        status = dict(self._execute(f"SELECT key, status FROM keys WHERE key IN ({','.join('?'*len(keys))})",
+                                    tuple(keys))) if len(keys) else {}
+        return {key: status.get(key) for key in keys}
+
+    def get_keys(self, status=None) -> list:
+        if status is None:
+            return [key for key, in self._execute("SELECT key FROM keys")]
+        return [key for key, in self._execute("SELECT key FROM keys WHERE status = ?", (status,))]
+
+    def reset_running(self) -> int:
+        """Set keys left "running" (by an interrupted sweep) to pending. Returns the number of keys reset."""
+        n_running = len(self.get_keys(RUNNING))
+        self._execute("UPDATE keys SET status = ? WHERE status = ?", (PENDING, RUNNING))
+        return n_running
+
+    def set_running(self, keys):
+        self._executemany("UPDATE keys SET status = ?, attempts = attempts + 1, error = NULL WHERE key = ?",
+                          [(RUNNING, key) for key in keys])
+
+    def set_done(self, keys, location, duration=None, started=None):
+        """Set keys as done, with where they are cached and the (wall clock) time each took"""
+        finished = time.time()
+        self._executemany("UPDATE keys SET status = ?, location = ?, started = ?, finished = ?, duration = ? "
+                          "WHERE key = ?",
+                          [(DONE, str(location), started, finished, duration, key) for key in keys])
+
+    def set_failed(self, keys, error):
+        self._executemany("UPDATE keys SET status = ?, finished = ?, error = ? WHERE key = ?",
+                          [(FAILED, time.time(), str(error), key) for key in keys])
+
+    @property
+    def table(self) -> pd.DataFrame:
+        """Every key, with its status, timing, error and location"""
+        con = self._connect()
+        try:
+            return pd.read_sql("SELECT * FROM keys", con, index_col="key")
+        finally:
+            con.close()
+
+    def summary(self) -> pd.DataFrame:
+        """Number of keys and their total duration (s) per sweep and status"""
+        return self.table.groupby(["sweep", "status"])["duration"].agg(["size", "sum"])
+
+
+def resume_sweep(manifest: SweepManifest, sweep=None, **kwargs):
+    """Run the keys of a sweep (default: the last one) that aren't done, with the arguments it was started with.
+
+    Keyword arguments (e.g. `n_workers`) replace those of the sweep.
+    """
+    from pv_nrn import get_pv, init_nrn
+    from src.sweep import run_sweep
+
+    args = {**manifest.get_sweep_args(sweep), **kwargs}
+    init_nrn(args.get("mechanisms"))
+    pv = get_pv(args.pop("pv_name"), *args.pop("pv_params"))
+    stims, nav_loc_changes, fractions, dur = (args.pop(arg) for arg in ("stims", "nav_loc_changes", "fractions",
+                                                                        "dur"))
+    return run_sweep(pv, stims, nav_loc_changes, fractions, dur, manifest=manifest, **args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Status of the keys in a sweep manifest, or resume a sweep")
+    parser.add_argument("path", help="manifest file (see `SweepManifest`)")
+    parser.add_argument("--resume", action="store_true", help="run the keys of the sweep that aren't done")
+    parser.add_argument("--sweep", type=int, default=None, help="id of the sweep to resume (default: the last)")
+    parser.add_argument("--n_workers", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    manifest = SweepManifest(args.path)
+    if args.resume:
+        kwargs = {} if args.n_workers is None else {"n_workers": args.n_workers}
+        resume_sweep(manifest, args.sweep, **kwargs)
+    print(manifest.summary())
+    failed = manifest.table.query(f"status == '{FAILED}'")
+    if len(failed):
+        print(failed[["attempts", "error"]])
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 1:
+        main()
+        sys.exit()
+
+    import tempfile
+
+    try:
+        from pv_nrn import get_mechanisms_path, init_nrn, pvParams, reset_biophys
+    except ImportError:
+        print("must be run from `pv-scn1a` directory")
+    from src.data import get_file_path
+    from src.sweep import _get_pool, get_sweep_keys, run_sweep
+
+    mechanisms = get_mechanisms_path()
+    init_nrn(mechanisms)
+    pv = _get_pool("test_manifest", pvParams(1000., 33., 1., 26.5), reset_biophys).cells[0]
+    stims, nav_loc_changes, fractions, dur = [(0.75, 0)], ["ais"], [1, 0.5], 20
+    sweep_keys = get_sweep_keys(pv, stims, nav_loc_changes, fractions, dur)
+
+    with tempfile.TemporaryDirectory() as cache_root:
+        manifest = SweepManifest(Path(cache_root) / "manifest.sqlite")
+        run_sweep(pv, stims, nav_loc_changes, fractions[:1], dur, n_workers=1, mechanisms=mechanisms,
+                  cache_root=cache_root, manifest=manifest)
+        assert manifest.get_status([key for key, *_ in sweep_keys]) == {sweep_keys[0][0]: DONE,
+                                                                        sweep_keys[1][0]: None}
+        assert manifest.table.loc[sweep_keys[0][0], "duration"] > 0
+        # set running by the worker, once
+        assert manifest.table.loc[sweep_keys[0][0], "attempts"] == 1
+
+        # a sweep interrupted while running the second key, which left a half-written file
+        manifest.add_sweep(sweep_keys, dict(pv_name="test_manifest", pv_params=tuple(pvParams(1000., 33., 1., 26.5)),
+                                            stims=stims, nav_loc_changes=nav_loc_changes, fractions=fractions,
+                                            dur=dur, cache_root=cache_root, n_workers=1, mechanisms=mechanisms))
+        manifest.set_running([sweep_keys[1][0]])
+        get_file_path(sweep_keys[1][0], root=cache_root).write_bytes(b"\x89HDF")
+        mtime = get_file_path(sweep_keys[0][0], root=cache_root).stat().st_mtime_ns
+
+        main([str(manifest.path), "--resume"])
+        assert set(manifest.get_status([key for key, *_ in sweep_keys]).values()) == {DONE}
+        assert manifest.table.loc[sweep_keys[1][0], "attempts"] == 2
+        assert get_file_path(sweep_keys[0][0], root=cache_root).stat().st_mtime_ns == mtime, \
+            "expected a key that is done not to be run again"
@@ -1,14 +1,17 @@
 import numpy as np
+import pandas as pd
 
-from src.constants import (DISTANCE_LABEL, SECTION_LABEL, TIME_LABEL,
+from src.constants import (AIS_LABEL, DISTANCE_LABEL, MAX_PROP_LABEL,
+                           SECTION_LABEL, TERMINAL_LABEL, TIME_LABEL,
                            VOLTAGE_LABEL)
-from src.data import is_long_form, wide_to_long
-from src.utils import nearest_value
+from src.data import LongView, _time_mask, is_long_form, wide_to_long
 
 
 def get_max_propagation(long_df, thresh=-20., time=(0.,)):
+    if isinstance(long_df, LongView):
+        return _get_max_propagation_wide(long_df.wide, thresh, time)
     if VOLTAGE_LABEL not in long_df.columns:
-        long_df = wide_to_long(long_df)
+        return _get_max_propagation_wide(long_df, thresh, time)
     if isinstance(time, float) or isinstance(time, int):
         time_mask = long_df[TIME_LABEL] >= time
     else:
@@ -24,66 +27,271 @@ def get_max_propagation(long_df, thresh=-20., time=(0.,)):
     return idx, distance
 
 
+def _get_max_propagation_wide(x_df, thresh, time):
+    # as for the long form, `idx` is the row of the first (segment, time) at the maximum distance (see `LongView`)
+    t = x_df.index.values
+    above = (x_df.values >= thresh) & _time_mask(t, time)[:, np.newaxis]
+    cols = np.flatnonzero(above.any(axis=0))
+    if cols.size == 0:
+        return None, np.nan
+    distances = x_df.columns.get_level_values(DISTANCE_LABEL).values.astype(float)
+    col = cols[np.argmax(distances[cols])]
+    return col*t.size + np.argmax(above[:, col]), distances[col]
+
+
+def _as_windows(windows):
+    """(start, end) array from time windows, each a start time or a (start,) or (start, end) tuple"""
+    windows = [(w,) if isinstance(w, float) or isinstance(w, int) else tuple(w) for w in windows]
+    return np.array([(w[0], w[1] if len(w) > 1 else np.inf) for w in windows], dtype=float).reshape(-1, 2)
+
+
+def get_max_propagation_arr(t, v, distances, windows, thresh=-20.):
+    """Farthest distance at which `v` (time x segments, recorded at times `t`) is at least `thresh` in each window.
+
+    `distances` are those of the segments (columns of `v`). All `windows` (see `get_max_propagation`) are processed
+    together from a cumulative count of above-threshold points per segment.
+    Returns an array of distances, one per window (NaN if no segment reached `thresh`).
+    """
+    t = np.asarray(t, dtype=float)
+    windows = _as_windows(windows)
+    distances = np.asarray(distances, dtype=float)
+
+    # farthest segments first, so the first segment above threshold in a window is the farthest
+    order = np.argsort(-distances, kind="stable")
+    above = np.asarray(v)[:, order] >= thresh
+    n_above = np.zeros((t.size + 1, above.shape[1]), dtype=np.int32)
+    np.cumsum(above, axis=0, out=n_above[1:])
+
+    start = np.searchsorted(t, windows[:, 0], side="left")
+    end = np.searchsorted(t, windows[:, 1], side="right")
+    in_window = (n_above[end] - n_above[start]) > 0
+    found = in_window.any(axis=1)
+    return np.where(found, distances[order][in_window.argmax(axis=1)], np.nan)
+
+
+def get_max_propagation_batch(dfs, windows, thresh=-20.) -> pd.DataFrame:
+    """Batched `get_max_propagation` for many runs and time windows.
+
+    `dfs` is a dict of run key to wide DataFrame (or `LongView`), and `windows` are either the same for every run or
+    a dict per key.
+    Returns a DataFrame of the maximum propagation distance with a row per (key, window).
+    """
+    max_prop_dfs = []
+    for key, x_df in dfs.items():
+        if isinstance(x_df, LongView):
+            x_df = x_df.wide
+        key_windows = _as_windows(windows[key] if isinstance(windows, dict) else windows)
+        distances = get_max_propagation_arr(x_df.index.values, x_df.values,
+                                            x_df.columns.get_level_values(DISTANCE_LABEL).values,
+                                            key_windows, thresh=thresh)
+        max_prop_dfs.append(pd.DataFrame({"key": key,
+                                          "window": np.arange(len(key_windows)),
+                                          "start": key_windows[:, 0],
+                                          "end": key_windows[:, 1],
+                                          MAX_PROP_LABEL: distances}))
+    if len(max_prop_dfs) == 0:
+        return pd.DataFrame(columns=["key", "window", "start", "end", MAX_PROP_LABEL]).set_index(["key", "window"])
+    return pd.concat(max_prop_dfs, ignore_index=True).set_index(["key", "window"])
+
+
+def get_ap_times_arr(t, v, thresh=0., gap_time=1.):
+    """Get AP (start) times for every column of `v` (time x sections), recorded at times `t`.
+
+    An AP starts at the first time `v >= thresh` that is at least `gap_time` after the previous AP start (or time 0).
+
+    All columns are processed together, with one vectorised step per AP. Returns a list of arrays, one per column.
+    """
+    t = np.asarray(t, dtype=float)
+    v = np.asarray(v)
+    if v.ndim == 1:
+        v = v[:, np.newaxis]
+    n_t, n_cols = v.shape
+    dtype = np.int32 if n_t < np.iinfo(np.int32).max else np.int64
+
+    # for every (time, column), the first row at or after it that is above threshold (or `n_t` if there is none)
+    next_above = np.where(v >= thresh, np.arange(n_t, dtype=dtype)[:, np.newaxis], dtype(n_t))
+    next_above = np.minimum.accumulate(next_above[::-1], axis=0)[::-1]
+    next_above = np.vstack([next_above, np.full((1, n_cols), n_t, dtype=dtype)])
+
+    ap_cols = []
+    ap_rows = []
+    cols = np.arange(n_cols)
+    prev_time = np.zeros(n_cols)
+    while cols.size:
+        start = np.searchsorted(t, prev_time + gap_time, side="left")
+        rows = next_above[start, cols]
+        found = rows < n_t
+        cols, rows = cols[found], rows[found]
+        ap_cols.append(cols)
+        ap_rows.append(rows)
+        prev_time = t[rows]
+
+    ap_cols = np.concatenate(ap_cols)
+    ap_rows = np.concatenate(ap_rows)
+    order = np.lexsort((ap_rows, ap_cols))
+    ap_cols, ap_rows = ap_cols[order], ap_rows[order]
+    splits = np.searchsorted(ap_cols, np.arange(1, n_cols))
+    return np.split(t[ap_rows], splits)
+
+
+def get_ap_times_wide(x_df, thresh=0., gap_time=1., secs=None):
+    """Get AP times at every section (or only `secs`) of a wide DataFrame (see `get_trace`) in a single pass.
+
+    As with `get_ap_times`, the first segment of each section is used. Returns a dict of section name to AP times.
+    """
+    sec_names = x_df.columns.get_level_values(SECTION_LABEL)
+    first_seg_mask = ~sec_names.duplicated()
+    if secs is not None:
+        first_seg_mask &= sec_names.isin([secs] if isinstance(secs, str) else secs)
+    ap_times = get_ap_times_arr(x_df.index.values, x_df.values[:, first_seg_mask],
+                                thresh=thresh, gap_time=gap_time)
+    return dict(zip(sec_names[first_seg_mask], ap_times))
+
+
 def _get_ap_times_wide(x_df, thresh, gap_time, sec):
     soma_df = x_df[sec].iloc[:, 0]
-    prev_idx = 0
-    above_thresh_mask = soma_df >= thresh
-    soma_above_thresh_df = soma_df[above_thresh_mask]
+    return get_ap_times_arr(soma_df.index.values, soma_df.values, thresh=thresh, gap_time=gap_time)[0]
+
+
+def _get_ap_times_long(long_df, thresh, gap_time, sec):
+    sec_mask = (long_df[SECTION_LABEL] == sec).values
+    voltage = long_df[VOLTAGE_LABEL].values[sec_mask].astype(float)
+    times = long_df[TIME_LABEL].values[sec_mask].astype(float)[voltage >= thresh]
+
+    # an AP starts at the first time (in row order) greater than `gap_time` after the previous start. Previous rows
+    # can't be greater than this (they would have been picked), so can search the running maximum.
+    max_times = np.maximum.accumulate(times)
     ap_start_times = []
-    while (idx := soma_above_thresh_df.loc[prev_idx+gap_time:].first_valid_index()) is not None:
-        ap_start_times.append(idx)
-        prev_idx = idx
+    prev_time = 0
+    while (idx := np.searchsorted(max_times, prev_time + gap_time, side="right")) < times.size:
+        prev_time = times[idx]
+        ap_start_times.append(prev_time)
+
     return np.array(ap_start_times)
 
 
-def _get_ap_times_long(long_df, thresh, gap_time, sec):
-    soma_above_thresh_df = long_df[(long_df[SECTION_LABEL] == sec) & (
-        long_df[VOLTAGE_LABEL] >= thresh)]
-    prev_idx = 0
+def _get_ap_times_events(ap_times, gap_time, sec):
+    # crossing times of the first recorded segment of `sec` (see `SPIKE_PLAN`), at least `gap_time` apart
+    times = ap_times[sec].iloc[0]
     ap_start_times = []
-    indices = soma_above_thresh_df.index
     prev_time = 0
-    for time in soma_above_thresh_df[TIME_LABEL]:
-        if time > prev_time+gap_time:
+    for time in times:
+        if time >= prev_time + gap_time:
             ap_start_times.append(time)
             prev_time = time
-
     return np.array(ap_start_times)
 
 
 def get_ap_times(long_or_wide_df, thresh=0, gap_time=1., sec="soma[0]"):
+    """AP start times at `sec` from a long or wide voltage DataFrame, or from the AP times of an `events` recording (see
+    `SPIKE_PLAN`, where the threshold of the recording is used instead of `thresh`)."""
+    if isinstance(long_or_wide_df, LongView):
+        long_or_wide_df = long_or_wide_df.wide
+    if isinstance(long_or_wide_df, pd.Series):
+        return _get_ap_times_events(long_or_wide_df, gap_time, sec=sec)
     if is_long_form(long_or_wide_df):
         return _get_ap_times_long(long_or_wide_df, thresh, gap_time, sec=sec)
     else:
         return _get_ap_times_wide(long_or_wide_df, thresh, gap_time, sec=sec)
 
 
+def calculate_failures_batch(times_list, other_times_list, tol=2.):
+    """Vectorised `calculate_failures` for many pairs of `times` and `other_times` (e.g. sites and runs) at once.
+
+    Each time is matched to its nearest time in the corresponding (sorted) `other_times` with a single
+    `searchsorted` over all pairs. Returns a list of failure time arrays, one per pair.
+    """
+    n_pairs = len(times_list)
+    times_list = [np.asarray(times, dtype=float) for times in times_list]
+    other_times_list = [np.sort(np.asarray(other_times, dtype=float)) for other_times in other_times_list]
+    group = np.repeat(np.arange(n_pairs), [times.size for times in times_list])
+    other_group = np.repeat(np.arange(n_pairs), [other.size for other in other_times_list])
+    times = np.concatenate(times_list) if n_pairs else np.array([])
+    other = np.concatenate(other_times_list) if n_pairs else np.array([])
+    if times.size == 0:
+        return [np.array([]) for _ in range(n_pairs)]
+
+    # offset each pair so that one sorted array (and search) covers all pairs
+    all_values = np.concatenate([times, other])
+    v_min = all_values.min()
+    span = all_values.max() - v_min + 1
+    idx = np.searchsorted(other_group*span + (other - v_min),
+                          group*span + (times - v_min), side="left")
+
+    # nearest is either the previous or next `other` time in the same pair (the previous one on a tie, as with
+    # `nearest_value`). A sentinel (in no pair) at the end covers the edges (index -1 and `other.size`).
+    other = np.append(other, np.nan)
+    other_group = np.append(other_group, -1)
+    lower_idx, upper_idx = idx - 1, idx
+    lower = np.where(other_group[lower_idx] == group, other[lower_idx], -np.inf)
+    upper = np.where(other_group[upper_idx] == group, other[upper_idx], np.inf)
+    nearest = np.where(times - lower <= upper - times, lower, upper)
+
+    failure_mask = (nearest < times) | (nearest - times > tol)
+    failure_times = times[failure_mask]
+    splits = np.searchsorted(group[failure_mask], np.arange(1, n_pairs))
+    return np.split(failure_times, splits)
+
+
 def calculate_failures(times, other_times, tol=2.):
     """Return failure times from `times` to `other_times` (within a tolerance `tol`). 
 
     That is, if there's a time `t` in `times` that does not have a corresponding time `t < t' < t+tol` in `other_times`, 
     `t` is added to the list of failure times.
     """
-    if len(other_times) == 0:
-        return np.array(times)
-    failure_times = []
-    for t in times:
-        other_t = nearest_value(other_times, t)
-#         print(f"{t=} | {other_t=}")
-        if other_t < t or other_t - t > tol:
-            failure_times.append(t)
-    return np.array(failure_times)
+    return calculate_failures_batch([times], [other_times], tol=tol)[0]
+
+
+# (from, to) sites for each failure type, where "pulse" are the stimulus pulse times
+FAILURE_PAIRS = {
+    "Initiation": ("pulse", AIS_LABEL),
+    "Propagation": (AIS_LABEL, TERMINAL_LABEL),
+    "Stimulation": ("pulse", TERMINAL_LABEL),
+}
+
+
+def get_failure_table(ap_times: dict, pulse_times=None, tol=2., pairs=None) -> pd.DataFrame:
+    """Failures of every type (see `FAILURE_PAIRS`) for all runs of a sweep, with one vectorised call.
+
+    `ap_times` is a dict of run key to a dict of site (e.g. `AIS_LABEL`) to AP times. `pulse_times` are either the
+    same for every run or a dict per key.
+
+    Returns a tidy DataFrame with a row per run key and failure type.
+    """
+    if pairs is None:
+        pairs = FAILURE_PAIRS
+    rows = []
+    times_list = []
+    other_times_list = []
+    for key, site_times in ap_times.items():
+        _pulse_times = pulse_times.get(key) if isinstance(pulse_times, dict) else pulse_times
+        site_times = {"pulse": _pulse_times, **site_times}
+        for failure_type, (from_site, to_site) in pairs.items():
+            if site_times.get(from_site) is None or site_times.get(to_site) is None:
+                continue
+            rows.append({"key": key, "Failure type": failure_type})
+            times_list.append(np.atleast_1d(site_times[from_site]))
+            other_times_list.append(np.atleast_1d(site_times[to_site]))
+
+    failure_times = calculate_failures_batch(times_list, other_times_list, tol=tol)
+    for row, times, failures in zip(rows, times_list, failure_times):
+        row["n"] = times.size
+        row["Failures"] = failures.size
+        row["Failure rate"] = failures.size/times.size if times.size else np.nan
+        row["Failure times"] = failures
+    return pd.DataFrame(rows, columns=["key", "Failure type", "n", "Failures", "Failure rate", "Failure times"])
 
 
 if __name__ == "__main__":
     try:
-        from pv_nrn import get_pv
+        from pv_nrn import get_mechanisms_path, get_pv, init_nrn
     except ImportError:
         print("must be run from `pv-scn1a` directory")
     from src.run import get_trace
     amp = 0.1  # nA
     dur = 10  # ms
 
+    init_nrn(get_mechanisms_path())
     t, v, AP, x_df = get_trace(get_pv(), amp, dur, shape_plot=True)
 
     ap_start_times = get_ap_times(x_df)
@@ -91,3 +299,16 @@ if __name__ == "__main__":
     ap_start_times_long = get_ap_times(long_df)
     assert all(ap_start_times ==
                ap_start_times_long), "ap times not the same for a wide and long dataframe!"
+    ap_times_all = get_ap_times_wide(x_df)
+    assert all(ap_times_all["soma[0]"] ==
+               ap_start_times), "ap times not the same for a single section and all sections!"
+    failures = calculate_failures_batch([[1., 5., 9.], [1., 5.]], [[1.5, 9.2], []])
+    assert np.array_equal(failures[0], [5.]) and np.array_equal(failures[1], [1., 5.]), \
+        "unexpected failure times!"
+
+    windows = [(0.,), (5., 15.), (100., 101.)]
+    max_prop_df = get_max_propagation_batch({"test": x_df}, windows)
+    for window, distance in zip(windows, max_prop_df[MAX_PROP_LABEL]):
+        _, long_distance = get_max_propagation(long_df, time=window)
+        assert distance == long_distance or (np.isnan(distance) and np.isnan(long_distance)), \
+            "batched and long form max propagation differ!"
@@ -1,26 +1,96 @@
+import time
+from collections import namedtuple
 from typing import List, Union
 
 import numpy as np
 import pandas as pd
 from neuron import h
 
+from pv_nrn import get_mech_param_names, get_segment_index
 from src.constants import DISTANCE_LABEL, SECTION_LABEL, TIME_LABEL
+from src.instrument import stage
 from src.settings import STIM_ONSET, STIM_PULSE_DUR
 
+# solver used by `hRun`:
+#   "cvode": variable time step with absolute/relative tolerances `atol`/`rtol` (irregular time points)
+#   "fixed": fixed time step of `dt` ms
+#   "cvode_interp": as "cvode", but recorded (interpolated by NEURON) at every `dt` ms, so runs share time points
+#   "lvardt": as "cvode", but with a separate integrator (and time points) per cell, so that cells simulated
+#             together (see `get_traces`) don't change each other's time steps
+Solver = namedtuple("Solver", "method dt atol rtol", defaults=("cvode", 0.025, 1e-3, 0.))
+CVODE = Solver("cvode")
+FIXED = Solver("fixed")
+CVODE_INTERP = Solver("cvode_interp")
+LVARDT = Solver("lvardt")
+
+RunStats = namedtuple("RunStats", "method wall_time n_steps n_points")
+
+# which segments (of the soma and axon) to record when `shape_plot` is a plan:
+#   sites: section names (e.g. "axon[1]", negative indices like "node[-1]" allowed), or None for all sections
+#   every: only every Nth segment
+#   spacing: only segments at least `spacing` μm further from the soma than the previously recorded segment
+#   events: record times when the voltage crosses `thresh` (with a NetCon) instead of the voltage
+#   first: only the first segment of each section (as used by `get_ap_times`)
+# a site without an index (e.g. "node") is every section of it, and the last segment (e.g. the terminal) is always
+# recorded
+RecordingPlan = namedtuple("RecordingPlan", "sites every spacing events thresh first",
+                           defaults=(None, 1, None, False, -20., False))
+# sites used by `concise_df` and AP time analyses
+CONCISE_PLAN = RecordingPlan(sites=("soma[0]", "axon[0]", "axon[1]", "node[-1]"))
+# AP times (as from `get_ap_times`) at the soma, AIS (axon[1]) and every node, including the terminal
+SPIKE_PLAN = RecordingPlan(sites=("soma[0]", "axon[1]", "node"), events=True, thresh=0., first=True)
+# when `get_rates` stops a run early, checked every `check_every` ms of stimulation:
+#   "steady": the last `n_isi` somatic inter-spike intervals vary by less than `cv_tol` (coefficient of variation)
+#   "block": no somatic AP and the voltage varies by less than `v_tol` mV for `check_every` ms, above `block_v` mV
+#   "silent": as "block", but below `block_v` mV (e.g. a subthreshold stimulus)
+EarlyStop = namedtuple("EarlyStop", "check_every n_isi cv_tol v_tol block_v", defaults=(50., 5, 0.05, 0.1, -40.))
+_last_run_stats = None
+# properties that `set_nrn_prop` sets per section: those of a section as a whole (rather than of its segments), and
+# `diam`, as NEURON only updates the geometry (areas and axial resistances) when it is set this way
+_SECTION_PROPS = ("L", "Ra", "nseg", "rallbranch", "diam")
+
+
+def count_cells() -> int:
+    """Number of cells (section trees) in the process, e.g. from `get_pv` and `CellPool`"""
+    roots = h.SectionList()
+    roots.allroots()
+    return sum(1 for _ in roots)
+
+
+def get_solver(solver: Union[Solver, str, None]) -> Solver:
+    """Get a `Solver` from a method name (with default values) or a `Solver` (returned as is).
+
+    The default (None) is `CVODE` while there is at most one cell in the process, and `LVARDT` otherwise: every cell
+    is simulated by a run, and (global) CVODE time steps would depend on all of them (cells at rest take few local
+    time steps).
+    """
+    if solver is None:
+        return CVODE if count_cells() <= 1 else LVARDT
+    if isinstance(solver, str):
+        return Solver(solver)
+    return solver
+
+
+def get_run_stats() -> RunStats:
+    """Wall-clock time and number of integration steps of the last `get_trace` run"""
+    return _last_run_stats
+
 
 def mut(Pv, MUT):
     """change Nav1.1 conductance within 'mutated' Nav11m channels"""
-    for sec in Pv.all:
-        if 'Nav11' in [mech.name() for seg in sec.allseg() for mech in seg]:
-            gNav = sec(0.5).gNav11bar_Nav11
-        for seg in sec:
-            for mech in seg:
-                if mech.name() == 'Nav11m':
-                    seg.gNav11bar_Nav11m = MUT*gNav
-                    seg.mh_Nav11m, seg.hh_Nav11m = -26.6, -60.2
-                    seg.tmh_Nav11m, seg.thh_Nav11m = -40.0, -65.0
-                if mech.name() == 'Nav11':
-                    seg.gNav11bar_Nav11 = (1.0 - MUT)*gNav
+    index = get_segment_index(Pv)
+    # Nav11 is scaled in every section with it, and Nav11m gets the rest of the Nav11 conductance of its section (in
+    # the sections with both, so that the segments of the two are in the same order)
+    gNav = index.get_section_values("gNav11bar_Nav11")
+    gNav_mut = index.get_section_values("gNav11bar_Nav11", require="gNav11bar_Nav11m")
+    index.set("gNav11bar_Nav11m", MUT*gNav_mut, ignore_missing=True, require="gNav11bar_Nav11")
+    index.apply({
+        "mh_Nav11m": -26.6,
+        "hh_Nav11m": -60.2,
+        "tmh_Nav11m": -40.0,
+        "thh_Nav11m": -65.0,
+    }, ignore_missing=True)
+    index.set("gNav11bar_Nav11", (1.0 - MUT)*gNav, ignore_missing=True)
     return Pv
 
 
@@ -30,20 +100,30 @@ def set_relative_nav11bar(Pv, proportion: float, at="nodes", base: Union[float,
         assert at != base, f"cannot change values at '{at}' when it is also the `base_sec`."
         base = getattr(Pv, base)[-1].gNav11bar_Nav11
 
-    for sec in getattr(Pv, at):
-        if "myelin" in sec.hname():
-            continue
-        sec.gNav11bar_Nav11 = base*proportion
+    index = get_segment_index(Pv)
+    missing = [sec_name for sec_name in index.missing("gNav11bar_Nav11", at) if "myelin" not in sec_name]
+    if missing:
+        raise AttributeError(f"'gNav11bar_Nav11' is not in section(s) {', '.join(missing)}")
+    index.set("gNav11bar_Nav11", base*proportion, at, ignore_missing=True)
+
+
+def set_nav_frac(Pv, frac: float, nav_loc, base_nav: dict):
+    """Set Nav1.1 conductance to `frac` of `base_nav` (see `reset_biophys`) at one or more locations `nav_loc`"""
+    if isinstance(nav_loc, str):
+        nav_loc = [nav_loc]
+    for _nav_loc in nav_loc:
+        set_relative_nav11bar(Pv, frac, at=_nav_loc, base=base_nav[_nav_loc])
 
 
 def set_nrn_prop(pv,  property: str, value: float, secs="all", ignore_error=False):
     """set neuron property"""
-    for sec in getattr(pv, secs):
-        try:
+    if property in _SECTION_PROPS:
+        for sec in getattr(pv, secs):
             setattr(sec, property, value)
-        except AttributeError as err:
-            if not ignore_error:
-                raise err
+        if property == "nseg":
+            get_segment_index(pv, rebuild=True)
+        return
+    get_segment_index(pv).set(property, value, secs, ignore_missing=ignore_error)
 
 
 def set_stim(sec, amplitude: float, duration: float, frequency: Union[float, bool] = False):
@@ -65,14 +145,19 @@ def set_stim(sec, amplitude: float, duration: float, frequency: Union[float, boo
         return Ic
 
 
-def record_var(sec, to_record: str, loc: float = 0.5):
-    """record voltage ('v'), time ('t') or action potentials ('apc')"""
+def record_var(sec, to_record: str, loc: float = 0.5, dt: float = None):
+    """record voltage ('v'), time ('t') or action potentials ('apc')
+
+    If `dt` is given, values are recorded every `dt` ms instead of every time step.
+    """
     to_record = to_record.upper()
     v = h.Vector()
+    record_args = () if dt is None else (dt,)
+    # `sec` decides which cell's time is recorded with a local time step (see `Solver`)
     if to_record == 'V':
-        v.record(sec(loc)._ref_v)
+        v.record(sec(loc)._ref_v, *record_args, sec=sec)
     elif to_record == 'T':
-        v.record(h._ref_t)
+        v.record(h._ref_t, *record_args, sec=sec)
     elif to_record == 'APC':
         v = h.APCount(sec(loc))
     else:
@@ -81,19 +166,158 @@ def record_var(sec, to_record: str, loc: float = 0.5):
     return v
 
 
-def get_trace(nrn_cell, stim_amp: float, stim_dur: float, stim_freq: float = 0, shape_plot: bool = False):
+def _short_name(sec):
+    sec_name = sec.hname()
+    return sec_name[sec_name.find(".")+1:]
+
+
+def get_record_segments(nrn_cell, plan: RecordingPlan = None):
+    """List of (section name, segment, distance from soma) of the soma and axon to record according to `plan`"""
+    if plan is None:
+        plan = RecordingPlan()
+    sites = None
+    if plan.sites is not None:
+        sites = set()
+        for site in plan.sites:
+            if "[" not in site:
+                sites.update(_short_name(sec) for sec in getattr(nrn_cell, site))
+                continue
+            sec_list_name, idx = site.rstrip("]").split("[")
+            sites.add(_short_name(getattr(nrn_cell, sec_list_name)[int(idx)]))
+
+    # set distance reference point
+    h.distance(0, nrn_cell.soma[0](0.5))
+
+    segments = []
+    for seclist in [nrn_cell.somatic, nrn_cell.axonal]:
+        for sec in seclist:
+            sec_name = _short_name(sec)
+            if sites is None or sec_name in sites:
+                # sec name for every *segment*
+                sec_segments = list(sec)[:1] if plan.first else sec
+                segments += [(sec_name, seg, h.distance(seg)) for seg in sec_segments]
+
+    last_segment = segments[-1]
+    segments = segments[::plan.every]
+    if plan.spacing is not None:
+        spaced_segments = []
+        prev_dist = -np.inf
+        for segment in segments:
+            if segment[2] - prev_dist >= plan.spacing:
+                spaced_segments.append(segment)
+                prev_dist = segment[2]
+        segments = spaced_segments
+    if segments[-1] is not last_segment:
+        segments.append(last_segment)
+    return segments
+
+
+def record_events(seg, thresh: float = -20.):
+    """record times when the voltage of `seg` crosses `thresh` (from below)"""
+    nc = h.NetCon(seg._ref_v, None, sec=seg.sec)
+    nc.threshold = thresh
+    times = h.Vector()
+    nc.record(times)
+    # keep a reference to the NetCon with its Vector
+    return nc, times
+
+
+def get_trace(nrn_cell, stim_amp: float, stim_dur: float, stim_freq: float = 0,
+              shape_plot: Union[bool, RecordingPlan] = False, solver: Union[Solver, str] = None, init_state=None):
     """Get voltage trace of a neuron.
 
     If `shape_plot=True`, then the voltage is recorded at the soma and all along the axon, which is captured in
     the pandas `v_df` DataFrame object.
+    `shape_plot` can also be a `RecordingPlan` to only record some segments (e.g. `CONCISE_PLAN`). If the plan is for
+    `events`, then instead of `v_df` a Series of threshold crossing times per segment (indexed like the `v_df`
+    columns) is returned.
+
+    See `Solver` for `solver` options (default: see `get_solver`). Timing of the run is available from
+    `get_run_stats`.
+    See `hRun` for `init_state` (e.g. `src.state.get_snapshot` to skip the pre-stimulus period).
     """
+    return get_traces([nrn_cell], [(stim_amp, stim_freq)], stim_dur, shape_plot=shape_plot, solver=solver,
+                      init_state=init_state)[0]
+
 
+def get_traces(nrn_cells, stims, stim_dur: float, shape_plot: Union[bool, RecordingPlan] = False,
+               solver: Union[Solver, str] = LVARDT, init_state=None):
+    """Get voltage traces of many neurons (e.g. from a `CellPool`), each with its own (amp, freq) stimulus in `stims`,
+    in a single run.
+
+    Returns a list of `get_trace` results, one per cell.
+    Cells only run independently with a local time step (the default, `LVARDT`) or a fixed time step (`FIXED`).
+    """
+    global _last_run_stats
+    solver = get_solver(solver)
+    record_dt = solver.dt if solver.method == "cvode_interp" else None
+
+    with stage("record") as info:
+        recordings = [_record_trace(nrn_cell, stim_amp, stim_dur, stim_freq, shape_plot, record_dt)
+                      for nrn_cell, (stim_amp, stim_freq) in zip(nrn_cells, stims)]
+        info["n_vectors"] = sum(_n_vectors(rec) for rec in recordings)
+
+    with stage("run") as info:
+        start_time = time.perf_counter()
+        hRun(stim_dur+20, solver=solver, init_state=init_state)  # add stim delay
+        _last_run_stats = RunStats(solver.method, time.perf_counter() - start_time,
+                                   sum(int(rec.t_steps.size()) - 1 for rec in recordings),
+                                   sum(int(rec.t.size()) for rec in recordings))
+        info["n_steps"] = _last_run_stats.n_steps
+
+    with stage("collect"):
+        return [_collect_trace(rec) for rec in recordings]
+
+
+def iter_trace(nrn_cell, stim_amp: float, stim_dur: float, stim_freq: float = 0,
+               shape_plot: Union[bool, RecordingPlan] = True, solver: Union[Solver, str] = None, init_state=None,
+               chunk_dur: float = 100.):
+    """As `get_trace`, but run `chunk_dur` ms at a time, yielding the recordings of each chunk (with `t` and `v` as
+    arrays), after which the recording vectors are emptied. So memory doesn't grow with the duration of the run.
+
+    AP counts are of the run so far. See `src.store.stream_trace` to save the chunks to disk.
+    With CVODE, chunk ends are extra time points of the run (which change the trace well within the tolerance).
+    """
+    global _last_run_stats
+    solver = get_solver(solver)
+    record_dt = solver.dt if solver.method == "cvode_interp" else None
+    rec = _record_trace(nrn_cell, stim_amp, stim_dur, stim_freq, shape_plot, record_dt)
+    if rec.plan is not None and rec.plan.events:
+        raise ValueError("event recordings are not chunked, use `get_trace`")
+    # `t_steps` can be `t`
+    vectors = list({id(vec): vec for vec in [rec.t, rec.v, rec.t_steps, *(rec.v_rec or [])]}.values())
+
+    T = stim_dur + 20  # add stim delay
+    wall_time, n_steps, n_points = 0., -1, 0
+    start_time = time.perf_counter()
+    init_run(T, solver, init_state)
+    t_end = h.t
+    while t_end < T:
+        t_end = min(t_end + chunk_dur, T)
+        h.continuerun(t_end)
+        wall_time += time.perf_counter() - start_time
+        n_steps += int(rec.t_steps.size())
+        n_points += int(rec.t.size())
+        _last_run_stats = RunStats(solver.method, wall_time, n_steps, n_points)
+
+        t, v, AP, v_df = _collect_trace(rec)
+        yield t.as_numpy().copy(), v.as_numpy().copy(), AP, v_df
+        for vec in vectors:
+            vec.resize(0)
+        start_time = time.perf_counter()
+
+
+_TraceRecording = namedtuple("_TraceRecording", "stim t v t_steps AP plan segments v_rec")
+
+
+def _record_trace(nrn_cell, stim_amp, stim_dur, stim_freq, shape_plot, record_dt):
     # must keep reference to object as NEURON automatically clears objects not in scope
     stim = set_stim(nrn_cell.soma[0], stim_amp, stim_dur, frequency=stim_freq)
 
-    t = record_var(nrn_cell.soma[0], 'T')
-    v = record_var(nrn_cell.soma[0], 'V')
-    v_df = None  # if shape_plot, then will be a DataFrame
+    t = record_var(nrn_cell.soma[0], 'T', dt=record_dt)
+    v = record_var(nrn_cell.soma[0], 'V', dt=record_dt)
+    # count integration steps
+    t_steps = t if record_dt is None else record_var(nrn_cell.soma[0], 'T')
 
     try:
         APsoma = record_var(nrn_cell.soma[0], 'APC', loc=0.5)
@@ -113,56 +337,213 @@ def get_trace(nrn_cell, stim_amp: float, stim_dur: float, stim_freq: float = 0,
         AP = record_var(nrn_cell.soma[0], 'APC',
                         loc=0.5)  # as in original file
 
+    plan, segments, v_rec = None, None, None
     if shape_plot:
-        v_rec = []
-        x = []
-        sec_names = []
-        # set distance reference point
-        h.distance(0, nrn_cell.soma[0](0.5))
-
-        for seclist in [nrn_cell.somatic, nrn_cell.axonal]:
-            for sec in seclist:
-                sec_name = sec.hname()
-                for seg in sec:
-                    v_rec.append(record_var(sec, "V", loc=seg.x))
-                    x.append(h.distance(seg))
-                    # sec name for every *segment*
-                    sec_names.append(sec_name[sec_name.find(".")+1:])
-
-    hRun(stim_dur+20)  # add stim delay
+        plan = shape_plot if isinstance(shape_plot, RecordingPlan) else RecordingPlan()
+        segments = get_record_segments(nrn_cell, plan)
+        if plan.events:
+            v_rec = [record_events(seg, plan.thresh) for _, seg, _ in segments]
+        else:
+            v_rec = [record_var(seg.sec, "V", loc=seg.x, dt=record_dt)
+                     for _, seg, _ in segments]
 
-    if shape_plot:
-        # columns are distance and index is time
-        v_df = pd.DataFrame({(sec_name, d_val): v_vec.as_numpy().copy()
-                             for sec_name, d_val, v_vec in zip(sec_names, x, v_rec)},
-                            index=t.as_numpy().copy(),
-                            dtype=float)
-        v_df.index.name = TIME_LABEL
-        v_df.columns.names = [SECTION_LABEL, DISTANCE_LABEL]
+    return _TraceRecording(stim, t, v, t_steps, AP, plan, segments, v_rec)
 
-    return t, v, AP, v_df
 
+def _n_vectors(rec: _TraceRecording):
+    # recording vectors (`t_steps` can be `t`), with those of an `events` plan
+    return len({id(rec.t), id(rec.v), id(rec.t_steps)}) + len(rec.v_rec or [])
 
-def getIF(inputs: List[float], Pv, dur: float = 500, ap_secs: Union[List, str] = "init"):
-    """get input-output (in frequency, Hz) for a list of inputs and diference sections `ap_secs`"""
+
+def _collect_trace(rec: _TraceRecording):
+    v_df = None  # if shape_plot, then will be a DataFrame
+    if rec.plan is not None:
+        sec_names = [sec_name for sec_name, _, _ in rec.segments]
+        x = [d_val for _, _, d_val in rec.segments]
+        if rec.plan.events:
+            v_df = pd.Series([times.as_numpy().copy() for _, times in rec.v_rec],
+                             index=pd.MultiIndex.from_arrays([sec_names, x],
+                                                             names=[SECTION_LABEL, DISTANCE_LABEL]),
+                             dtype=object)
+        else:
+            # columns are distance and index is time
+            v_df = pd.DataFrame({(sec_name, d_val): v_vec.as_numpy().copy()
+                                 for sec_name, d_val, v_vec in zip(sec_names, x, rec.v_rec)},
+                                index=rec.t.as_numpy().copy(),
+                                dtype=float)
+            v_df.index.name = TIME_LABEL
+            v_df.columns.names = [SECTION_LABEL, DISTANCE_LABEL]
+
+    return rec.t, rec.v, rec.AP, v_df
+
+
+def getIF(inputs: List[float], Pv, dur: float = 500, ap_secs: Union[List, str] = "init",
+          solver: Union[Solver, str] = None, early_stop: EarlyStop = None):
+    """get input-output (in frequency, Hz) for a list of inputs and diference sections `ap_secs`
+
+    With `early_stop`, runs end once the firing state is clear (see `get_rates`). See `src.fi` for F-I curves of many
+    configurations, with rheobase and adaptive amplitudes.
+    """
     if isinstance(ap_secs, str):
         aps = {ap_secs: []}
     else:
         aps = {ap_sec: [] for ap_sec in ap_secs}
 
     for AMP in inputs:
-        ap_dict = get_trace(Pv, AMP, dur)[2]
+        if early_stop is None:
+            ap_dict = get_trace(Pv, AMP, dur, solver=solver)[2]
+            rates = {ap_sec: ap_dict[ap_sec].n*(1000/dur) for ap_sec in aps}
+        else:
+            rates = get_rates(Pv, AMP, dur, solver=solver, early_stop=early_stop)[0]
         # convert to firing rate (Hz)
         for ap_sec, ap_list in aps.items():
-            ap_list.append(ap_dict[ap_sec].n*(1000/dur))
+            ap_list.append(rates[ap_sec])
     if len(aps) == 1:
         # only a single section
         return aps[ap_secs]
     return aps
 
 
-def hRun(T):
-    """Run a NEURON simulation for T milliseconds"""
+def _ap_sites(AP):
+    """(site, APCount) of every APCount of `get_trace` (with "props" as "props[0]", "props[1]", ...)"""
+    if not isinstance(AP, dict):
+        return [("soma", AP)]
+    sites = []
+    for site, apc in AP.items():
+        if isinstance(apc, list):
+            sites += [(f"{site}[{i}]", sub_apc) for i, sub_apc in enumerate(apc)]
+        else:
+            sites.append((site, apc))
+    return sites
+
+
+def _firing_state(t, v, soma_times, early_stop: EarlyStop):
+    t_now = t[-1]
+    window = t >= t_now - early_stop.check_every
+    if not np.any(soma_times >= t_now - early_stop.check_every):
+        if np.ptp(v[window]) < early_stop.v_tol:
+            return "block" if np.mean(v[window]) > early_stop.block_v else "silent"
+    elif soma_times.size > early_stop.n_isi:
+        isis = np.diff(soma_times[-(early_stop.n_isi + 1):])
+        if np.std(isis) < early_stop.cv_tol*np.mean(isis):
+            return "steady"
+    return None
+
+
+def get_rates(nrn_cell, stim_amp: float, stim_dur: float, solver: Union[Solver, str] = None,
+              early_stop: EarlyStop = EarlyStop()):
+    """Firing rate (Hz) at every APCount site of `get_trace` ("props" as "props[i]") for a step current.
+
+    The run ends early once the firing state is clear (see `EarlyStop`). A "steady" rate is extrapolated to the end
+    of the stimulus (from the last `n_isi` intervals, per site), while after a "block" or "silent" state no more APs
+    are counted. Returns (rates, state, stop_time), where the state is "full" if the run wasn't stopped.
+    """
+    solver = get_solver(solver)
+    rec = _record_trace(nrn_cell, stim_amp, stim_dur, 0, False, None)
+    sites = _ap_sites(rec.AP)
+    times = []
+    for _, apc in sites:
+        ap_times = h.Vector()
+        apc.record(ap_times)
+        times.append(ap_times)
+
+    T = stim_dur + STIM_ONSET
     h.tstop = T
-    h.cvode_active(1)
-    h.run()
+    set_solver(solver)
+    h.stdinit()
+    state = "full"
+    t_check = STIM_ONSET + early_stop.check_every if early_stop is not None else T
+    while t_check < T:
+        h.continuerun(t_check)
+        state = _firing_state(rec.t.as_numpy(), rec.v.as_numpy(), times[0].as_numpy(), early_stop) or "full"
+        if state != "full":
+            break
+        t_check += early_stop.check_every
+    else:
+        h.continuerun(T)
+    stop_time = h.t
+
+    rates = {}
+    for (site, apc), ap_times in zip(sites, times):
+        n = apc.n
+        if state == "steady":
+            # rate at this site over the last `n_isi` somatic intervals (a whole number of periods, so that any
+            # offset of the site's APs from the soma's doesn't matter)
+            soma_times = times[0].as_numpy()
+            window = soma_times[-1] - soma_times[-(early_stop.n_isi + 1)]
+            n_window = np.count_nonzero(ap_times.as_numpy() > stop_time - window)
+            n += n_window/window*(T - stop_time)
+        rates[site] = n*1000/stim_dur
+    return rates, state, stop_time
+
+
+def set_solver(solver: Union[Solver, str] = None):
+    """Set NEURON's integration method and its parameters (see `Solver`)"""
+    solver = get_solver(solver)
+    if solver.method == "fixed":
+        h.cvode_active(0)
+        h.steps_per_ms = 1/solver.dt
+        h.dt = solver.dt
+    elif solver.method in ("cvode", "cvode_interp", "lvardt"):
+        h.cvode_active(1)
+        h.cvode.atol(solver.atol)
+        h.cvode.rtol(solver.rtol)
+    else:
+        raise ValueError(f"unknown solver method '{solver.method}'")
+    h.cvode.use_local_dt(solver.method == "lvardt")
+
+
+def restore_state(state):
+    """Restore a `SaveState`, keeping the events from initialisation (e.g. stimulus onset) and the current PARAMETERs
+    of point processes (e.g. stimulus amplitude), which `SaveState` would otherwise also restore.
+    """
+    point_params = []
+    mech_type = h.MechanismType(1)
+    mech_name = h.ref("")
+    for i in range(int(mech_type.count())):
+        mech_type.select(i)
+        mech_type.selected(mech_name)
+        param_names = get_mech_param_names(mech_name[0])
+        for point_process in h.List(mech_name[0]):
+            point_params += [(point_process, param, getattr(point_process, param)) for param in param_names]
+    state.restore(1)
+    for point_process, param, value in point_params:
+        setattr(point_process, param, value)
+
+
+def init_run(T, solver: Union[Solver, str] = None, init_state=None):
+    """Initialise a run of T milliseconds (see `hRun`), to be advanced with `h.continuerun`"""
+    solver = get_solver(solver)
+    h.tstop = T
+    set_solver(solver)
+    if callable(init_state):
+        init_state = init_state(solver)
+    h.stdinit()
+    if init_state is not None:
+        restore_state(init_state)
+        if solver.method != "fixed":
+            h.cvode.re_init()
+        h.frecord_init()
+
+
+def hRun(T, solver: Union[Solver, str] = None, init_state=None):
+    """Run a NEURON simulation for T milliseconds (see `Solver` for `solver` options, and `get_solver` for the
+    default)
+
+    If given, the `init_state` (a `SaveState`, or a function of the `Solver` that returns one) is restored after
+    initialisation, and the run continues from its time. Recordings then start at that time.
+    """
+    init_run(T, solver, init_state)
+    h.continuerun(T)
+
+
+def compare_solvers(nrn_cell, stim_amp: float, stim_dur: float, solvers: List[Union[Solver, str]], **kwargs):
+    """Run `get_trace` with each solver and return a DataFrame of timing, number of steps, and AP counts"""
+    rows = []
+    for solver in solvers:
+        solver = get_solver(solver)
+        AP = get_trace(nrn_cell, stim_amp, stim_dur, solver=solver, **kwargs)[2]
+        ap_counts = {key: val.n for key, val in AP.items() if not isinstance(val, list)} \
+            if isinstance(AP, dict) else {"soma": AP.n}
+        rows.append({**solver._asdict(), **get_run_stats()._asdict(), **ap_counts})
+    return pd.DataFrame(rows)
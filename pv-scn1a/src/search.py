@@ -0,0 +1,186 @@
+"""Adaptive search for the critical Nav1.1 fraction at which APs fail to initiate, propagate or reach a firing rate.
+
+Instead of simulating a dense grid of fractions (e.g. `fractions = [1, 0.9, ..., 0]` in the notebook), the grid (of
+`tol` steps) is bisected, assuming that a `criterion` which holds for a fraction also holds for every larger fraction.
+Runs use the same keys as `run_sims` (see `get_key` and `get_cached_df`), so results already in the cache are reused,
+and are preferred as bisection points:
+
+    find_critical_fraction(pv, propagates, "nodes", (0.75, 120), 250, tol=0.01)
+"""
+import logging
+from collections import namedtuple
+from itertools import product
+
+import numpy as np
+import pandas as pd
+
+from pv_nrn import reset_biophys
+from src.constants import CURRENT_LABEL, DISTANCE_LABEL, NAV_SECTIONS_LABEL, STIM_FREQ_LABEL
+from src.data import LongView, get_cached_df, get_file_path
+from src.measure import get_max_propagation
+from src.run import set_nav_frac
+from src.utils import format_nav_loc, get_key
+
+logger = logging.getLogger("search")
+
+# `frac_fail` is the largest fraction (on the grid) for which the criterion fails (None if it never does) and
+# `frac_pass` the smallest for which it holds (None if it never does); `n_grid` is the size of the dense grid
+CriticalFraction = namedtuple("CriticalFraction",
+                              "criterion nav_loc stim frac_fail frac_pass n_sims n_cached n_grid")
+
+
+def initiates(AP, x_df, dur, min_rate=0.):
+    """Whether the AIS fires above `min_rate` (Hz)"""
+    return AP["init"].n*1000/dur > min_rate
+
+
+def propagates(AP, x_df, dur, min_distance=None, thresh=-20.):
+    """Whether an AP reaches `min_distance` (μm, default: the furthest recorded segment, see `get_max_propagation`)"""
+    if x_df is None:
+        raise ValueError("propagation needs the voltage of every segment (`shape_plot=True`)")
+    if min_distance is None:
+        wide_df = x_df.wide if isinstance(x_df, LongView) else x_df
+        min_distance = wide_df.columns.get_level_values(DISTANCE_LABEL).astype(float).max()
+    _, distance = get_max_propagation(x_df, thresh=thresh)
+    return distance >= min_distance
+
+
+def fires(AP, x_df, dur, rate=1., site="soma"):
+    """Whether `site` ("soma", "init" or "comm", see `get_trace`) fires at least at `rate` (Hz)
+
+    Use `functools.partial` to set the `rate`.
+    """
+    return AP[site].n*1000/dur >= rate
+
+
+CRITERIA = {
+    "initiation": initiates,
+    "propagation": propagates,
+    "firing": fires,
+}
+
+
+def get_fraction_grid(tol=0.1, lower=0., upper=1.):
+    """Fractions from `lower` to `upper` in steps of `tol` (whole numbers as `int`, as in the notebook's keys)"""
+    decimals = max(2, int(np.ceil(-np.log10(tol))) + 1)
+    grid = np.round(np.arange(lower, upper + tol/2, tol), decimals)
+    return [int(frac) if float(frac).is_integer() else float(frac) for frac in grid]
+
+
+def _next_idx(lo, hi, cached):
+    # the cached fraction closest to the middle, otherwise the middle
+    mid = (lo + hi)//2
+    between = [idx for idx in cached if lo < idx < hi]
+    if len(between):
+        return min(between, key=lambda idx: abs(idx - mid))
+    return mid
+
+
+def find_critical_fraction(pv, criterion, nav_loc, stim, dur, tol=0.1, lower=0., upper=1.,
+                           reset_biophys=reset_biophys, shape_plot=True, cache_root=None) -> CriticalFraction:
+    """Find the Nav1.1 fraction (at `nav_loc`, to within `tol`) below which `criterion` fails (see module docs).
+
+    `criterion` is called as `criterion(AP, x_df, dur)` (see `CRITERIA`) or is the name of one of `CRITERIA`.
+    """
+    criterion_name = criterion if isinstance(criterion, str) else getattr(criterion, "__name__", str(criterion))
+    if isinstance(criterion, str):
+        criterion = CRITERIA[criterion]
+    amp, freq = stim
+    grid = get_fraction_grid(tol, lower, upper)
+    keys = [get_key(pv, frac, nav_loc, stim, dur) for frac in grid]
+    cached = {idx for idx, key in enumerate(keys) if get_file_path(key, root=cache_root).exists()}
+    base_nav = reset_biophys(pv)
+    n_sims = n_cached = 0
+
+    def evaluate(idx):
+        nonlocal n_sims, n_cached
+        if idx in cached:
+            n_cached += 1
+        else:
+            reset_biophys(pv)
+            set_nav_frac(pv, grid[idx], nav_loc, base_nav)
+            n_sims += 1
+        AP, x_df = get_cached_df(keys[idx], pv, amp, dur, stim_freq=freq, shape_plot=shape_plot,
+                                 cache_root=cache_root)
+        return bool(criterion(AP, x_df, dur))
+
+    lo, hi = 0, len(grid) - 1
+    if not evaluate(hi):
+        frac_fail, frac_pass = grid[hi], None
+    elif evaluate(lo):
+        frac_fail, frac_pass = None, grid[lo]
+    else:
+        # `lo` fails and `hi` passes
+        while hi - lo > 1:
+            idx = _next_idx(lo, hi, cached)
+            if evaluate(idx):
+                hi = idx
+            else:
+                lo = idx
+        frac_fail, frac_pass = grid[lo], grid[hi]
+    reset_biophys(pv)
+
+    logger.info(f"{criterion_name} at {format_nav_loc(nav_loc)} {stim}: {n_sims} simulations "
+                f"({n_cached} cached) instead of {len(grid)}")
+    return CriticalFraction(criterion_name, nav_loc, stim, frac_fail, frac_pass, n_sims, n_cached, len(grid))
+
+
+def find_critical_fractions(pv, criterion, nav_loc_changes, stims, dur, **kwargs) -> pd.DataFrame:
+    """`find_critical_fraction` for every (stim, nav_loc), as a DataFrame with the simulations saved per row.
+
+    Keyword arguments are passed to `find_critical_fraction`.
+    """
+    rows = []
+    for stim, nav_loc in product(stims, nav_loc_changes):
+        result = find_critical_fraction(pv, criterion, nav_loc, stim, dur, **kwargs)
+        amp, freq = stim
+        rows.append({
+            **result._asdict(),
+            NAV_SECTIONS_LABEL: format_nav_loc(nav_loc),
+            CURRENT_LABEL: amp,
+            STIM_FREQ_LABEL: freq,
+            "n_saved": result.n_grid - result.n_sims,
+        })
+    critical_df = pd.DataFrame(rows)
+    logger.info(f"{critical_df['n_sims'].sum()} simulations instead of {critical_df['n_grid'].sum()} "
+                f"({critical_df['n_saved'].sum()} saved)")
+    return critical_df
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    try:
+        from pv_nrn import get_mechanisms_path, get_pv, init_nrn
+    except ImportError:
+        print("must be run from `pv-scn1a` directory")
+
+    init_nrn(get_mechanisms_path())
+    pv = get_pv(node_spacing=33, node_length=1., ais_L=26.5)
+    stim, dur = (0.75, 120), 20
+
+    with tempfile.TemporaryDirectory() as cache_root:
+        result = find_critical_fraction(pv, "propagation", "nodes", stim, dur, tol=0.05, cache_root=cache_root)
+        assert result.frac_pass - result.frac_fail <= 0.05 + 1e-9
+        assert result.n_sims < result.n_grid
+
+        # the same as on the dense grid (now partially cached)
+        grid = get_fraction_grid(0.05)
+        base_nav = reset_biophys(pv)
+        passes = []
+        for frac in grid:
+            reset_biophys(pv)
+            set_nav_frac(pv, frac, "nodes", base_nav)
+            AP, x_df = get_cached_df(get_key(pv, frac, "nodes", stim, dur), pv, stim[0], dur,
+                                     stim_freq=stim[1], shape_plot=True, cache_root=cache_root)
+            passes.append(propagates(AP, x_df, dur))
+        first_pass = passes.index(True)
+        assert all(passes[first_pass:]), "expected propagation to be monotonic in the fraction"
+        assert (result.frac_fail, result.frac_pass) == (grid[first_pass - 1], grid[first_pass])
+
+        # all cached
+        assert find_critical_fraction(pv, propagates, "nodes", stim, dur, tol=0.05,
+                                      cache_root=cache_root).n_sims == 0
+        critical_df = find_critical_fractions(pv, "initiation", ["nodes"], [stim], dur, tol=0.05,
+                                              cache_root=cache_root)
+        assert critical_df["frac_fail"].isna().all(), "expected nodal Nav1.1 not to be needed for initiation"
@@ -1,5 +1,3 @@
-import seaborn as sns
-
 STIM_ONSET = 20
 STIM_PULSE_DUR = 1.5
 
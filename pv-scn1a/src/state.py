@@ -0,0 +1,176 @@
+"""Snapshots of the state just before the stimulus, to skip simulating the pre-stimulus period.
+
+A snapshot is a `SaveState` of every cell in this process at `SNAPSHOT_TIME`, which is taken (or restored) by
+`get_snapshot` once `get_trace` has set up its stimulus and recordings:
+
+    get_trace(pv, 0.75, 250, stim_freq=120, shape_plot=True, init_state=get_snapshot)
+
+Snapshots are keyed by the model structure (sections and point processes), the geometry and biophysics of every
+section (see `get_sections_hash`) and the solver, and kept in memory and on disk. Note that traces from a snapshot
+start at `SNAPSHOT_TIME` instead of 0.
+"""
+import hashlib
+import json
+from pathlib import Path
+
+from neuron import h
+
+from src.cache import get_sections_hash, get_solver_settings
+from src.data import get_cache_root
+from src.run import Solver, _short_name, get_solver, restore_state
+from src.settings import STIM_ONSET
+
+# before the stimulus (and its events at `STIM_ONSET`)
+SNAPSHOT_TIME = STIM_ONSET - 1
+# time (ms) to settle from a nearby state (see `get_snapshot`)
+WARM_START_TIME = 5
+
+_snapshots = {}
+# (key, snapshot) of the last snapshot of each model structure, to warm-start from
+_last_snapshots = {}
+
+
+def get_snapshot_dir(root=None):
+    if root is None:
+        root = get_cache_root()
+    snapshot_dir = Path(root) / "snapshots"
+    snapshot_dir.mkdir(parents=True, exist_ok=True)
+    return snapshot_dir
+
+
+def get_structure_key():
+    """Hash of what a `SaveState` must match: the sections (and their segments) and the number of each point process"""
+    structure = [(_short_name(sec), sec.nseg) for sec in h.allsec()]
+    mech_type = h.MechanismType(1)
+    mech_name = h.ref("")
+    for i in range(int(mech_type.count())):
+        mech_type.select(i)
+        mech_type.selected(mech_name)
+        structure.append((mech_name[0], int(h.List(mech_name[0]).count())))
+    structure.append(("NetCon", int(h.List("NetCon").count())))
+    return hashlib.sha1(json.dumps(structure).encode()).hexdigest()
+
+
+def get_snapshot_key(solver: Solver = None, start_key=None):
+    """Key of the snapshot of the current model, settled from `v_init` or, if warm-started, from the snapshot with key
+    `start_key` (see `get_snapshot`)"""
+    state = {
+        "structure": get_structure_key(),
+        "sections": get_sections_hash(h.allsec()),
+        "solver": get_solver_settings(solver),
+        "time": SNAPSHOT_TIME,
+    }
+    if start_key is not None:
+        state["warm_start"] = {"start": start_key, "time": WARM_START_TIME}
+    return hashlib.sha1(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+
+def _take_snapshot(start_state=None):
+    h.stdinit()
+    if start_state is not None:
+        # settle from a nearby state instead of from `v_init`
+        restore_state(start_state)
+        h.t = SNAPSHOT_TIME - WARM_START_TIME
+        if h.cvode.active():
+            h.cvode.re_init()
+    h.continuerun(SNAPSHOT_TIME)
+    snapshot = h.SaveState()
+    snapshot.save()
+    return snapshot
+
+
+def get_snapshot(solver: Solver = None, cache_root=None, warm_start=False):
+    """Get the snapshot of the current model (see module docs), simulating up to `SNAPSHOT_TIME` if it isn't cached.
+
+    With `warm_start=True`, a missing snapshot is instead simulated for only `WARM_START_TIME` from the last snapshot
+    of the same structure (e.g. the previous configuration of a sweep). Use `functools.partial` to pass it to
+    `get_trace` as `init_state`. A (fully settled) snapshot is used if there is one, while a warm-started snapshot is
+    kept under its own key, which includes that of the snapshot it started from, so that it is never used in place of
+    a settled one.
+    """
+    solver = get_solver(solver)
+    structure_key = get_structure_key()
+    key = get_snapshot_key(solver)
+    start_key, start_state = _last_snapshots.get(structure_key, (None, None)) if warm_start else (None, None)
+    if start_key is not None and key not in _snapshots and not (get_snapshot_dir(cache_root) / f"{key}.dat").exists():
+        key = get_snapshot_key(solver, start_key=start_key)
+    else:
+        start_state = None
+    if key in _snapshots:
+        _last_snapshots[structure_key] = (key, _snapshots[key])
+        return _snapshots[key]
+
+    path = get_snapshot_dir(cache_root) / f"{key}.dat"
+    snapshot_file = h.File(str(path))
+    if path.exists():
+        snapshot = h.SaveState()
+        snapshot_file.ropen()
+        snapshot.fread(snapshot_file)
+    else:
+        snapshot = _take_snapshot(start_state)
+        snapshot_file.wopen()
+        snapshot.fwrite(snapshot_file)
+    snapshot_file.close()
+
+    _snapshots[key] = snapshot
+    _last_snapshots[structure_key] = (key, snapshot)
+    return snapshot
+
+
+def clear_snapshots():
+    """Clear the in-memory snapshots (those on disk are kept)"""
+    _snapshots.clear()
+    _last_snapshots.clear()
+
+
+if __name__ == "__main__":
+    import tempfile
+    from functools import partial
+
+    import numpy as np
+
+    try:
+        from pv_nrn import get_mechanisms_path, get_pv, init_nrn, reset_biophys
+    except ImportError:
+        print("must be run from `pv-scn1a` directory")
+    from src.run import FIXED, get_trace, set_nav_frac
+
+    init_nrn(get_mechanisms_path())
+    pv = get_pv()
+    base_nav = reset_biophys(pv)
+    # note that the APCount objects (of `AP`) are part of the model structure, so only the counts are kept
+    _, _, AP, x_df = get_trace(pv, 0.75, 20, stim_freq=120, shape_plot=True, solver=FIXED)
+    n_soma = AP["soma"].n
+    del AP
+
+    with tempfile.TemporaryDirectory() as cache_root:
+        init_state = partial(get_snapshot, cache_root=cache_root)
+        _, _, AP, x_df_snap = get_trace(pv, 0.75, 20, stim_freq=120, shape_plot=True, solver=FIXED,
+                                        init_state=init_state)
+        assert AP["soma"].n == n_soma
+        del AP
+        assert np.isclose(x_df_snap.index[0], SNAPSHOT_TIME)
+        assert np.allclose(x_df.loc[x_df.index >= SNAPSHOT_TIME + 0.01].values,
+                           x_df_snap.loc[x_df_snap.index >= SNAPSHOT_TIME + 0.01].values), \
+            "expected the same trace from a snapshot"
+
+        # from memory (with another amplitude) and from disk
+        get_trace(pv, 0.5, 20, stim_freq=120, shape_plot=True, solver=FIXED, init_state=init_state)
+        clear_snapshots()
+        x_df_disk = get_trace(pv, 0.75, 20, stim_freq=120, shape_plot=True, solver=FIXED,
+                              init_state=init_state)[3]
+        assert np.all(x_df_disk.values == x_df_snap.values), "expected the same trace from a saved snapshot"
+        assert len(list(get_snapshot_dir(cache_root).glob("*.dat"))) == 1
+
+        set_nav_frac(pv, 0.5, "ais", base_nav)
+        cold_keys = set(_snapshots)
+        get_trace(pv, 0.75, 20, stim_freq=120, shape_plot=True, solver=FIXED,
+                  init_state=partial(init_state, warm_start=True))
+        assert len(list(get_snapshot_dir(cache_root).glob("*.dat"))) == 2
+        warm_key, = set(_snapshots) - cold_keys
+
+        # a warm-started snapshot isn't used for a cold run of the same configuration
+        clear_snapshots()
+        get_trace(pv, 0.75, 20, stim_freq=120, shape_plot=True, solver=FIXED, init_state=init_state)
+        assert len(list(get_snapshot_dir(cache_root).glob("*.dat"))) == 3
+        assert len(_snapshots) == 1 and warm_key not in _snapshots
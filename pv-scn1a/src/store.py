@@ -0,0 +1,338 @@
+"""Columnar store of voltage traces, as an alternative to one `.h5` file per run (see `get_cached_df`).
+
+Layout (under `root`)::
+
+    index.csv           one row of metadata per run (pv params, frac, nav_loc, amp, freq, dur, APCount, ...)
+    time/<hash>.npy     time axes (float64), shared by all runs with the same time points
+    columns/<hash>.csv  (section, distance) of each recorded segment, shared by all runs of the same cell
+    runs/<key>.npy      float32 voltage matrix (segment x time) of each run
+    chunks/<key>/       time and voltage of each chunk of a run that is streamed to disk (see `stream_trace`), until
+                        the run is complete
+
+Arrays are opened as memory maps and stored segment-major, so slicing sections or time windows across many runs only
+reads what is needed.
+"""
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.constants import DISTANCE_LABEL, SECTION_LABEL, TIME_LABEL
+from src.data import _ap_series_to_ap, ap_to_series, events_to_frames, frames_to_events, get_cache_root
+from src.run import iter_trace
+
+
+def _hash_array(arr):
+    return hashlib.sha1(np.ascontiguousarray(arr).tobytes()).hexdigest()[:16]
+
+
+def _save_npy(path, arr):
+    """Save atomically, so that a partially written file is never read"""
+    tmp_path = path.with_suffix(".tmp.npy")
+    np.save(tmp_path, arr)
+    os.replace(tmp_path, path)
+
+
+def _write_csv(path, table):
+    # in full under a temporary name before it replaces the file (as `save_cached_df`), so that an interrupted write
+    # never truncates the table
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    table.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def _append_csv(path, rows_df):
+    """Append rows to a CSV table, whose columns need not be the same as (or in the same order as) its header"""
+    if not path.exists():
+        _write_csv(path, rows_df)
+        return
+    header = pd.read_csv(path, nrows=0).columns
+    if set(rows_df.columns) <= set(header):
+        # rows are appended by position, so in the order of the header
+        rows_df.reindex(columns=header).to_csv(path, mode="a", header=False, index=False)
+    else:
+        # new columns
+        table = pd.read_csv(path, dtype=str)
+        _write_csv(path, pd.concat([table, rows_df], ignore_index=True))
+
+
+class TraceStore:
+    """Store of voltage traces (see `get_trace`) with an index table of per-run metadata."""
+
+    def __init__(self, root=None):
+        if root is None:
+            root = Path(get_cache_root()) / "traces"
+        self.root = Path(root)
+        for sub_dir in ["time", "columns", "runs", "chunks"]:
+            (self.root / sub_dir).mkdir(parents=True, exist_ok=True)
+        self._index_path = self.root / "index.csv"
+        self._index = None
+        self._index_mtime = None
+
+    def __getstate__(self):
+        # without the cached table (e.g. for the arguments of a sweep, see `SweepManifest`)
+        return {**self.__dict__, "_index": None, "_index_mtime": None}
+
+    @property
+    def index(self) -> pd.DataFrame:
+        """Metadata of every run, with one row per key"""
+        if not self._index_path.exists():
+            return pd.DataFrame(columns=["key"]).set_index("key")
+        mtime = self._index_path.stat().st_mtime_ns
+        if self._index is None or mtime != self._index_mtime:
+            # hashes (e.g. "2401e5...") must not be read as numbers
+            index = pd.read_csv(self._index_path, dtype={"key": str, "time": str, "columns": str})
+            self._index = index.drop_duplicates("key", keep="last").set_index("key")
+            self._index_mtime = mtime
+        return self._index
+
+    def __contains__(self, key):
+        # the index row is written after the arrays, so a key in the index is complete
+        return key in self.index.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def save(self, key, x_df, ap_series=None, **meta):
+        """Save a wide voltage DataFrame (see `get_trace`), AP counts (see `ap_to_series`), and any metadata.
+
+        `x_df` can be None (e.g. `shape_plot=False`), in which case only AP counts and metadata are stored, or AP times
+        per site (e.g. `SPIKE_PLAN`, see `load_events`).
+        """
+        row = {"key": key, **meta}
+        if isinstance(x_df, pd.Series):
+            # AP times per site (see `events_to_frames`), as (site, time) rows
+            _, events = events_to_frames(x_df)
+            _save_npy(self.root / "runs" / f"{key}.npy", events.values.astype(float))
+            row.update({"columns": self._save_columns(x_df.index),
+                        "n_events": len(events)})
+        elif x_df is not None:
+            t = x_df.index.values.astype(float)
+            _save_npy(self.root / "runs" / f"{key}.npy",
+                      np.ascontiguousarray(x_df.values.T, dtype=np.float32))
+            row.update({"time": self._save_time(t),
+                        "columns": self._save_columns(x_df.columns),
+                        "n_t": t.size,
+                        "n_cols": x_df.shape[1]})
+        self._append_row(row, ap_series)
+
+    def _save_time(self, t):
+        t_hash = _hash_array(t)
+        t_path = self.root / "time" / f"{t_hash}.npy"
+        if not t_path.exists():
+            _save_npy(t_path, t)
+        return t_hash
+
+    def _save_columns(self, columns: pd.MultiIndex):
+        columns = columns.to_frame(index=False)
+        columns_hash = hashlib.sha1(columns.to_csv(index=False).encode()).hexdigest()[:16]
+        columns_path = self.root / "columns" / f"{columns_hash}.csv"
+        if not columns_path.exists():
+            columns.to_csv(columns_path, index=False)
+        return columns_hash
+
+    def _append_row(self, row, ap_series=None):
+        row["APCount"] = json.dumps(ap_series.to_dict() if ap_series is not None else {})
+        _append_csv(self._index_path, pd.DataFrame([row]))
+
+    def save_chunk(self, key, i, x_df):
+        """Save the `i`th chunk of a wide voltage DataFrame (see `iter_trace`), to be joined by `finish`"""
+        chunk_dir = self.root / "chunks" / key
+        chunk_dir.mkdir(exist_ok=True)
+        if i == 0:
+            (chunk_dir / "columns.txt").write_text(self._save_columns(x_df.columns))
+        _save_npy(chunk_dir / f"v_{i:05d}.npy", np.ascontiguousarray(x_df.values.T, dtype=np.float32))
+        # the time array is written last, so that a chunk with a time array is complete
+        _save_npy(chunk_dir / f"t_{i:05d}.npy", x_df.index.values.astype(float))
+
+    def _chunk_paths(self, key):
+        chunk_dir = self.root / "chunks" / key
+        t_paths = sorted(chunk_dir.glob("t_*.npy"))
+        return [(t_path, chunk_dir / t_path.name.replace("t_", "v_", 1)) for t_path in t_paths]
+
+    def load_partial(self, key) -> pd.DataFrame:
+        """Wide DataFrame of the chunks saved so far of a streamed run (e.g. one that was interrupted)"""
+        chunk_paths = self._chunk_paths(key)
+        if not chunk_paths:
+            return None
+        columns_hash = (self.root / "chunks" / key / "columns.txt").read_text()
+        columns = pd.read_csv(self.root / "columns" / f"{columns_hash}.csv")
+        t = np.concatenate([np.load(t_path) for t_path, _ in chunk_paths])
+        v = np.concatenate([np.load(v_path) for _, v_path in chunk_paths], axis=1)
+        return pd.DataFrame(v.T,
+                            index=pd.Index(t, name=TIME_LABEL),
+                            columns=pd.MultiIndex.from_frame(columns, names=[SECTION_LABEL, DISTANCE_LABEL]))
+
+    def finish(self, key, ap_series=None, **meta):
+        """Join the chunks of a streamed run into a single run (one chunk in memory at a time) and add it to the index"""
+        chunk_dir = self.root / "chunks" / key
+        chunk_paths = self._chunk_paths(key)
+        if not chunk_paths:
+            raise KeyError(f"no complete chunks of '{key}' in {chunk_dir} (see `save_chunk`)")
+        t_chunks = [np.load(t_path, mmap_mode="r") for t_path, _ in chunk_paths]
+        n_t = sum(t_chunk.size for t_chunk in t_chunks)
+        columns_hash = (chunk_dir / "columns.txt").read_text()
+        n_cols = np.load(chunk_paths[0][1], mmap_mode="r").shape[0]
+
+        t_path = self.root / "time" / f"{key}.tmp.npy"
+        run_path = self.root / "runs" / f"{key}.tmp.npy"
+        t = np.lib.format.open_memmap(t_path, mode="w+", dtype=float, shape=(n_t,))
+        v = np.lib.format.open_memmap(run_path, mode="w+", dtype=np.float32, shape=(n_cols, n_t))
+        start = 0
+        for t_chunk, (_, v_path) in zip(t_chunks, chunk_paths):
+            t[start:start + t_chunk.size] = t_chunk
+            v[:, start:start + t_chunk.size] = np.load(v_path, mmap_mode="r")
+            start += t_chunk.size
+        t.flush()
+        v.flush()
+        t_hash = _hash_array(t)
+        del t, v
+        os.replace(t_path, self.root / "time" / f"{t_hash}.npy")
+        os.replace(run_path, self.root / "runs" / f"{key}.npy")
+
+        self._append_row({"key": key, **meta, "time": t_hash, "columns": columns_hash, "n_t": n_t, "n_cols": n_cols},
+                         ap_series)
+        shutil.rmtree(chunk_dir)
+
+    def get_time(self, key) -> np.ndarray:
+        return np.load(self.root / "time" / f"{self.index.loc[key, 'time']}.npy", mmap_mode="r")
+
+    def get_columns(self, key) -> pd.MultiIndex:
+        columns = pd.read_csv(self.root / "columns" / f"{self.index.loc[key, 'columns']}.csv")
+        return pd.MultiIndex.from_frame(columns, names=[SECTION_LABEL, DISTANCE_LABEL])
+
+    def get_voltage(self, key) -> np.ndarray:
+        """Memory-mapped (segment x time) voltage matrix"""
+        return np.load(self.root / "runs" / f"{key}.npy", mmap_mode="r")
+
+    def get_ap(self, key):
+        """AP counts as returned by `get_cached_df`"""
+        return _ap_series_to_ap(pd.Series(json.loads(self.index.loc[key, "APCount"]), dtype=object))
+
+    def load_df(self, key, secs=None, time=None) -> pd.DataFrame:
+        """Load a wide DataFrame (as from `get_trace`), optionally only for section(s) `secs` and a `time` window.
+
+        `time` is either a start time or a (start, end) tuple. Returns None if no voltage was stored for `key`, and the
+        AP times of runs with an `events` plan (see `load_events`).
+        """
+        if not pd.isna(self.index.loc[key].get("n_events", np.nan)):
+            return self.load_events(key)
+        if pd.isna(self.index.loc[key].get("time", np.nan)):
+            return None
+        t = self.get_time(key)
+        columns = self.get_columns(key)
+        v = self.get_voltage(key)
+
+        col_idx = np.arange(len(columns))
+        if secs is not None:
+            if isinstance(secs, str):
+                secs = [secs]
+            col_idx = np.flatnonzero(columns.get_level_values(SECTION_LABEL).isin(secs))
+
+        t_start, t_end = 0, t.size
+        if time is not None:
+            if isinstance(time, float) or isinstance(time, int):
+                time = (time,)
+            t_start = np.searchsorted(t, time[0], side="left")
+            if len(time) > 1:
+                t_end = np.searchsorted(t, time[1], side="right")
+
+        x_df = pd.DataFrame(v[col_idx, t_start:t_end].T,
+                            index=pd.Index(t[t_start:t_end], name=TIME_LABEL),
+                            columns=columns[col_idx])
+        return x_df
+
+    def load_events(self, key) -> pd.Series:
+        """AP times per site (as from `get_trace` with an `events` plan)"""
+        sites = self.get_columns(key).to_frame(index=False)
+        events = np.load(self.root / "runs" / f"{key}.npy").reshape(-1, 2)
+        return frames_to_events(sites, pd.DataFrame({"site": events[:, 0].astype(int), TIME_LABEL: events[:, 1]}))
+
+    def select(self, secs=None, time=None, **meta):
+        """Load DataFrames (see `load_df`) for all runs whose metadata match `meta`, as a dict per key"""
+        index = self.index
+        mask = np.ones(len(index), dtype=bool)
+        for meta_key, meta_val in meta.items():
+            mask &= (index[meta_key] == meta_val).values
+        return {key: self.load_df(key, secs=secs, time=time) for key in index.index[mask]}
+
+
+def stream_trace(store: TraceStore, key, nrn_cell, stim_amp: float, stim_dur: float, chunk_dur: float = 100.,
+                 stim_freq: float = 0, shape_plot=True, solver=None, init_state=None, **meta):
+    """Like `get_trace` followed by `store.save`, but with each chunk of `chunk_dur` ms saved to disk as it is
+    simulated (see `iter_trace`), so memory doesn't grow with `stim_dur`.
+
+    Chunks of an interrupted run can be loaded with `store.load_partial(key)`. Returns the AP counts.
+    """
+    for i, (t, v, AP, x_df) in enumerate(iter_trace(nrn_cell, stim_amp, stim_dur, stim_freq=stim_freq,
+                                                    shape_plot=shape_plot, solver=solver, init_state=init_state,
+                                                    chunk_dur=chunk_dur)):
+        store.save_chunk(key, i, x_df)
+    ap_series = ap_to_series(AP)
+    store.finish(key, ap_series, **meta)
+    return _ap_series_to_ap(ap_series)
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    try:
+        from pv_nrn import get_mechanisms_path, get_pv, init_nrn
+    except ImportError:
+        print("must be run from `pv-scn1a` directory")
+    from src.run import FIXED, SPIKE_PLAN, get_trace
+
+    init_nrn(get_mechanisms_path())
+    t, v, AP, x_df = get_trace(get_pv(), 0.1, 10, shape_plot=True)
+
+    with tempfile.TemporaryDirectory() as root:
+        store = TraceStore(root)
+        store.save("test", x_df, ap_to_series(AP), amp=0.1, dur=10)
+        assert "test" in store
+        loaded_df = store.load_df("test")
+        assert np.allclose(loaded_df.values, x_df.values.astype(np.float32)), \
+            "values weren't stored/loaded properly!"
+        assert store.get_ap("test")["soma"].n == AP["soma"].n
+        soma_df = store.select(secs="soma[0]", time=(5, 10), amp=0.1)["test"]
+        assert soma_df.shape[1] == 1 and soma_df.index.min() >= 5
+
+        # streamed in chunks, as a single run
+        _, _, AP, x_df = get_trace(get_pv(), 0.75, 40, stim_freq=120, shape_plot=True, solver=FIXED)
+        AP_streamed = stream_trace(store, "streamed", get_pv(), 0.75, 40, chunk_dur=15, stim_freq=120, solver=FIXED)
+        assert AP_streamed["soma"].n == AP["soma"].n
+        assert np.all(store.load_df("streamed").values == x_df.values.astype(np.float32)), \
+            "expected the same trace in chunks"
+        assert not (store.root / "chunks" / "streamed").exists()
+
+        # an interrupted run keeps its complete chunks
+        for i, (_, _, _, chunk_df) in zip(range(2), iter_trace(get_pv(), 0.75, 40, stim_freq=120, solver=FIXED,
+                                                                chunk_dur=15)):
+            store.save_chunk("interrupted", i, chunk_df)
+        partial_df = store.load_partial("interrupted")
+        assert "interrupted" not in store and partial_df.index[-1] == x_df.index[partial_df.shape[0] - 1]
+
+        try:
+            store.finish("no_chunks")
+        except KeyError:
+            pass
+        else:
+            raise AssertionError("expected a run without chunks not to be finished")
+
+        # AP times only
+        _, _, AP, ap_times = get_trace(get_pv(), 0.75, 40, stim_freq=120, shape_plot=SPIKE_PLAN, solver=FIXED)
+        store.save("events", ap_times, ap_to_series(AP))
+        loaded_times = store.load_df("events")
+        assert all(np.array_equal(times, loaded) for times, loaded in zip(ap_times, loaded_times))
+        assert len(ap_times["soma[0]"].iloc[0]) == AP["soma"].n
+
+        # rows with new columns rewrite the table, which is replaced only once written in full
+        table_path = Path(root) / "table.csv"
+        _append_csv(table_path, pd.DataFrame({"key": ["a"], "n": [1]}))
+        _append_csv(table_path, pd.DataFrame({"key": ["b"], "n": [2], "new": [3.]}))
+        table = pd.read_csv(table_path)
+        assert table["key"].tolist() == ["a", "b"] and table["new"].iloc[1] == 3.
+        assert not table_path.with_name("table.csv.tmp").exists()
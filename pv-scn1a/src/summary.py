@@ -0,0 +1,247 @@
+"""Summary metrics of every run, computed right after it is simulated and kept in a single table, so that figures of
+AP counts, firing rates, propagation and failures don't need the voltage traces to be loaded again.
+
+The table (`summary.csv` under the cache root) has a row per (run key, site), with the sweep parameters of the run,
+the metrics of the site (see `get_run_metrics`) and those of the whole run. Runs are appended as they complete (see
+`run_sweep(summary=...)`), and runs already in the table are not processed again:
+
+    summary = SummaryTable(window=(25, 250))
+    run_sweep(pv, stims, nav_loc_changes, fractions, dur, summary=summary)
+    summary.select(**{STIM_FREQ_LABEL: 120})
+"""
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.constants import (AIS_LABEL, AP_LABEL, DISTANCE_LABEL, INSTA_FR_LABEL, MAX_PROP_LABEL, SECTION_LABEL,
+                           SOMA_LABEL, TERMINAL_LABEL, TIME_LABEL)
+from src.data import LongView, get_cache_root
+from src.measure import get_ap_times, get_max_propagation
+from src.store import _append_csv
+from src.utils import get_last_sec, get_pulse_times
+
+# APCount site (see `get_trace`) and section (None for the last section) of each summary site
+SUMMARY_SITES = {
+    SOMA_LABEL: ("soma", "soma[0]"),
+    AIS_LABEL: ("init", "axon[1]"),
+    TERMINAL_LABEL: ("comm", None),
+}
+AP_TIMES_LABEL = "AP times (ms)"
+
+
+def get_ifr(ap_times):
+    """Instantaneous firing rate (Hz) from the mean interval between AP times (0 for fewer than 2 APs)"""
+    if len(ap_times) < 2:
+        return 0.
+    return 1000/np.mean(np.diff(ap_times))
+
+
+def get_failure_rates(n_pulses, ap_times):
+    """Failure rates of a run from the number of stimulus pulses and of APs (as `calculate_failure_rates` in the
+    notebook): of initiation (pulses without an AP at the AIS), of propagation (APs at the AIS that don't reach the
+    terminal, 0 if initiation fails for 95% of the pulses or more) and of the stimulation as a whole.
+
+    `ap_times` is a dict of site (`AIS_LABEL` and `TERMINAL_LABEL`) to AP times. For a step current (no pulses), the
+    initiation and stimulation failure rates are NaN.
+    """
+    n_ais, n_term = len(ap_times[AIS_LABEL]), len(ap_times[TERMINAL_LABEL])
+    init_rate = (n_pulses - n_ais)/n_pulses if n_pulses else np.nan
+    if not init_rate >= 0.95 and n_ais > 0:
+        prop_rate = (n_ais - n_term)/n_ais
+    else:
+        prop_rate = 0.
+    return {
+        "Propagation": prop_rate,
+        "Initiation": init_rate,
+        "Stimulation": (n_pulses - n_term)/n_pulses if n_pulses else np.nan,
+    }
+
+
+def _sel_window(x_df, window):
+    # only the voltages within the time `window`, as in the notebook (so that an AP that started before it isn't
+    # counted)
+    if window is None or isinstance(x_df, pd.Series):
+        return x_df
+    if isinstance(x_df, LongView):
+        return x_df.sel(time=window)
+    if isinstance(x_df.columns, pd.MultiIndex):
+        return x_df[(x_df.index >= window[0]) & (x_df.index <= window[1])]
+    return x_df[(x_df[TIME_LABEL] >= window[0]) & (x_df[TIME_LABEL] <= window[1])]
+
+
+def _in_window(times, window):
+    times = np.atleast_1d(np.asarray(times, dtype=float))
+    if window is None:
+        return times
+    return times[(times >= window[0]) & (times <= window[1])]
+
+
+def _get_max_distance(x_df, thresh, window):
+    if isinstance(x_df, pd.Series):
+        # AP times (see `SPIKE_PLAN`), of the recorded segments that fired in the window
+        fired = [len(_in_window(times, window)) > 0 for times in x_df.values]
+        distances = x_df.index.get_level_values(DISTANCE_LABEL).values.astype(float)[fired]
+        return distances.max() if distances.size else np.nan
+    _, distance = get_max_propagation(x_df, thresh=thresh, time=(0.,) if window is None else window)
+    return distance
+
+
+def get_run_metrics(x_df, AP, stim_freq, stim_dur, thresh=-20., window=None) -> pd.DataFrame:
+    """Summary metrics of a run (see `get_trace`), with a row per site (see `SUMMARY_SITES`).
+
+    Per site: the AP count (of the whole run), and the AP times (at `thresh`, of the voltages within the time
+    `window` (start, end)) and instantaneous firing rate. Per run (on every row): the maximum propagation distance and
+    the failure rate of each type (see `get_failure_rates`) within the `window`, as in the notebook.
+    `x_df` is a wide or long voltage DataFrame, the AP times of an `events` recording, or None (AP counts only).
+    """
+    rows = []
+    ap_times = {}
+    window_df = None if x_df is None else _sel_window(x_df, window)
+    for site, (ap_site, sec) in SUMMARY_SITES.items():
+        row = {SECTION_LABEL: site, AP_LABEL: AP[ap_site].n}
+        if x_df is not None:
+            if sec is None:
+                sec = get_last_sec(x_df)
+            ap_times[site] = _in_window(get_ap_times(window_df, thresh=thresh, sec=sec), window)
+            row[AP_TIMES_LABEL] = json.dumps(ap_times[site].tolist())
+            row[INSTA_FR_LABEL] = get_ifr(ap_times[site])
+        rows.append(row)
+    metrics_df = pd.DataFrame(rows)
+    if x_df is None:
+        return metrics_df
+
+    metrics_df[MAX_PROP_LABEL] = _get_max_distance(x_df.wide if isinstance(x_df, LongView) else x_df,
+                                                   thresh, window)
+    # (the pulses of a stimulus as long as the window)
+    n_pulses = len(get_pulse_times(stim_freq, stim_dur if window is None else window[1] - window[0])) \
+        if stim_freq > 0 else 0
+    for failure_type, rate in get_failure_rates(n_pulses, ap_times).items():
+        metrics_df[f"{failure_type} failure rate"] = rate
+    return metrics_df
+
+
+class SummaryTable:
+    """Table of summary metrics (see `get_run_metrics`) of many runs, which are appended as they are simulated.
+
+    `thresh` and `window` are passed to `get_run_metrics`, and should be the same every time the table is
+    opened (they aren't part of the run keys).
+    """
+
+    def __init__(self, path=None, thresh=-20., window=None):
+        if path is None:
+            path = Path(get_cache_root()) / "summary.csv"
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.thresh = thresh
+        self.window = window
+        self._table = None
+        self._table_mtime = None
+        # keys of the runs in the file, kept up to date by `add` (so that checking keys doesn't re-read the file)
+        self._keys = None
+        self._keys_mtime = None
+
+    def __getstate__(self):
+        # without the cached table (e.g. for the arguments of a sweep, see `SweepManifest`)
+        return {**self.__dict__, "_table": None, "_table_mtime": None, "_keys": None, "_keys_mtime": None}
+
+    def _get_mtime(self):
+        return self.path.stat().st_mtime_ns if self.path.exists() else None
+
+    @property
+    def table(self) -> pd.DataFrame:
+        """Summary of every run, indexed by (key, site)"""
+        if not self.path.exists():
+            return pd.DataFrame(columns=["key", SECTION_LABEL]).set_index(["key", SECTION_LABEL])
+        mtime = self.path.stat().st_mtime_ns
+        if self._table is None or mtime != self._table_mtime:
+            table = pd.read_csv(self.path, dtype={"key": str})
+            table = table.drop_duplicates(["key", SECTION_LABEL], keep="last")
+            self._table = table.set_index(["key", SECTION_LABEL])
+            self._table_mtime = mtime
+        return self._table
+
+    @property
+    def keys(self) -> set:
+        """Keys of the runs in the table"""
+        mtime = self._get_mtime()
+        if self._keys is None or mtime != self._keys_mtime:
+            self._keys = set(self.table.index.get_level_values("key"))
+            self._keys_mtime = mtime
+        return self._keys
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, x_df, AP, stim_freq, stim_dur, **params):
+        """Append the metrics of a run (see `get_run_metrics`) with its sweep `params` (e.g. Nav1.1 fraction)"""
+        metrics_df = get_run_metrics(x_df, AP, stim_freq, stim_dur, thresh=self.thresh, window=self.window)
+        params_df = pd.DataFrame([{"key": key, **params}] * len(metrics_df))
+        keys = self.keys
+        _append_csv(self.path, pd.concat([params_df, metrics_df], axis=1))
+        keys.add(key)
+        self._keys_mtime = self._get_mtime()
+
+    def get_ap_times(self, key, site=SOMA_LABEL) -> np.ndarray:
+        return np.array(json.loads(self.table.loc[(key, site), AP_TIMES_LABEL]))
+
+    def select(self, **params) -> pd.DataFrame:
+        """Rows of the runs with the given sweep `params` (e.g. `**{NAV_FRAC_LABEL: 0.5}`)"""
+        mask = np.ones(len(self.table), dtype=bool)
+        for param, value in params.items():
+            mask &= (self.table[param] == value).values
+        return self.table[mask]
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    try:
+        from pv_nrn import get_mechanisms_path, get_pv, init_nrn
+    except ImportError:
+        print("must be run from `pv-scn1a` directory")
+    from src.data import ap_to_series, _ap_series_to_ap, wide_to_long
+    from src.run import SPIKE_PLAN, get_trace
+
+    init_nrn(get_mechanisms_path())
+    pv = get_pv()
+    dur = 50
+    _, _, AP, x_df = get_trace(pv, 0.75, dur, stim_freq=120, shape_plot=True)
+    AP = _ap_series_to_ap(ap_to_series(AP))
+    metrics_df = get_run_metrics(x_df, AP, 120, dur)
+    assert metrics_df[AP_LABEL].tolist() == [AP[site].n for site, _ in SUMMARY_SITES.values()]
+    assert np.allclose(metrics_df.select_dtypes("number"),
+                       get_run_metrics(wide_to_long(x_df), AP, 120, dur).select_dtypes("number"),
+                       equal_nan=True), "expected the same metrics from a wide and long dataframe"
+    assert metrics_df[MAX_PROP_LABEL].iloc[0] == get_max_propagation(x_df)[1]
+    assert 0 <= metrics_df["Stimulation failure rate"].iloc[0] <= 1
+    # as `calculate_failure_rates` in the notebook
+    assert get_failure_rates(4, {AIS_LABEL: [1, 2, 3], TERMINAL_LABEL: [1]}) == {
+        "Propagation": 2/3, "Initiation": 0.25, "Stimulation": 0.75}
+    assert get_failure_rates(40, {AIS_LABEL: [1], TERMINAL_LABEL: []})["Propagation"] == 0
+    window_df = get_run_metrics(x_df, AP, 120, dur, window=(25, dur))
+    n_pulses = len(get_pulse_times(120, dur - 25))
+    assert window_df["Initiation failure rate"].iloc[0] == \
+        (n_pulses - len(get_ap_times(x_df.loc[25:dur], thresh=-20., sec="axon[1]")))/n_pulses
+
+    _, _, AP_events, events = get_trace(pv, 0.75, dur, stim_freq=120, shape_plot=SPIKE_PLAN)
+    events_df = get_run_metrics(events, AP, 120, dur, window=(0, dur))
+    assert np.allclose(events_df[INSTA_FR_LABEL],
+                       get_run_metrics(x_df, AP, 120, dur, thresh=0., window=(0, dur))[INSTA_FR_LABEL],
+                       atol=1), "expected about the same rates from AP times"
+    del AP_events
+
+    with tempfile.TemporaryDirectory() as cache_root:
+        summary = SummaryTable(Path(cache_root) / "summary.csv")
+        summary.add("test", x_df, AP, 120, dur, frac=1)
+        summary.add("test_none", None, AP, 0, dur, frac=0.5, amp=0.75)
+        assert "test" in summary and "test_none" in summary and len(summary) == 2
+        assert summary._table is None or "test_none" not in summary._table.index, "expected no re-read by `add`"
+        assert "test_none" in SummaryTable(summary.path), "expected the same keys from the file"
+        assert len(summary.select(frac=1)) == len(SUMMARY_SITES)
+        assert np.array_equal(summary.get_ap_times("test"),
+                              metrics_df.set_index(SECTION_LABEL)[AP_TIMES_LABEL].map(json.loads)[SOMA_LABEL])
@@ -0,0 +1,378 @@
+"""Run (stim, nav_loc, frac) sweeps across a pool of worker processes.
+
+Each worker is its own NEURON instance that builds its own cell (see `CellPool`), so keys are independent and give the
+same results as running them one after the other (see `run_sims` in the notebook) with the same solver. Keys are run
+with `LVARDT` by default, which is in their names (see `get_key`).
+Results are streamed back to this process and saved to the cache (see `src.data`) as they complete.
+"""
+import logging
+import multiprocessing as mp
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import product
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from pv_nrn import CellPool, get_pv_params, init_nrn, pvParams, reset_biophys
+from src.constants import (CURRENT_LABEL, NAV_FRAC_LABEL, NAV_PERC_LABEL,
+                           NAV_SECTIONS_LABEL, STIM_FREQ_LABEL, VOLTAGE_LABEL)
+from src.data import (LongView, _ap_series_to_ap, get_file_path, is_saved,
+                      load_cached_df, save_cached_df, wide_to_long, ap_to_series)
+from src.instrument import record_stage, run_label
+from src.manifest import DONE
+from src.run import LVARDT, RecordingPlan, get_solver, get_trace, get_traces, set_nav_frac
+from src.utils import format_nav_loc, get_key, perc_decrease
+
+logger = logging.getLogger("sweep")
+
+# of the last `run_sweep`: keys in the sweep and run (not cached), workers, wall time (s) to run the keys and the startup
+# time (s) of each worker (from the start of the pool until it can run keys: spawn, imports and `init_nrn`)
+SweepStats = namedtuple("SweepStats", "n_keys n_run n_workers wall_time startup_times")
+_last_sweep_stats = None
+# startup time of this worker process, returned with its first results (see `_timed_run_keys`)
+_startup_time = None
+
+
+def get_sweep_keys(pv, stims, nav_loc_changes, fractions, dur, solver=None, init_state=None, shape_plot=True):
+    """List of (key_name, stim, nav_loc, frac) for every combination in the sweep (in the same order as `run_sims`)
+
+    Keys of runs from a snapshot (`init_state`, whose traces start later) end with "_snapshot" (or "_snapshot_warm"
+    for warm-started snapshots, which depend on the keys run before, see `get_snapshot`), and those of AP time
+    recordings (a `shape_plot` plan with `events`, e.g. `SPIKE_PLAN`) with "_events".
+    The default `solver` (None) is `LVARDT`, as for `run_key`.
+    """
+    solver = LVARDT if solver is None else solver
+    suffix = "" if init_state is None else "_snapshot"
+    if getattr(init_state, "keywords", {}).get("warm_start"):
+        suffix += "_warm"
+    if isinstance(shape_plot, RecordingPlan) and shape_plot.events:
+        suffix += "_events"
+    return [(get_key(pv, frac, nav_loc, stim, dur, solver=solver) + suffix, stim, nav_loc, frac)
+            for stim, nav_loc, frac in product(stims, nav_loc_changes, fractions)]
+
+
+def get_sweep_stats() -> SweepStats:
+    """Number of keys, workers, wall-clock time and worker startup times of the last `run_sweep`"""
+    return _last_sweep_stats
+
+
+def _init_worker(mechanisms=None, pool_started=None):
+    global _startup_time
+    init_nrn(mechanisms)
+    if pool_started is not None:
+        _startup_time = time.time() - pool_started
+        record_stage("startup", _startup_time)
+
+
+def _get_pool(pv_name, pv_params, reset_biophys, n_cells=1):
+    # cell(s) of this process, which are restored to baseline (`reset_biophys`) after every key
+    # (cached with the same arguments however they are passed, so that callers don't evict each other's pool)
+    return _get_cached_pool(pv_name, pvParams(*pv_params), reset_biophys, n_cells)
+
+
+@lru_cache(maxsize=1)
+def _get_cached_pool(pv_name, pv_params, reset_biophys, n_cells):
+    return CellPool(n_cells, pv_name, *pv_params, reset_biophys=reset_biophys)
+
+
+def run_key(pv_name, pv_params, stim, nav_loc, frac, dur, reset_biophys=reset_biophys, shape_plot=True,
+            solver=None, init_state=None):
+    """Run a single sweep key on this process' cell.
+
+    The default `solver` (None) is `LVARDT`, so that the result doesn't depend on other cells in the process (e.g. of
+    `get_pv`), which (global) CVODE would integrate with shared time steps.
+    Returns the AP counts (see `ap_to_series`) and voltage DataFrame, which (unlike hoc objects) can be pickled.
+    """
+    solver = LVARDT if solver is None else solver
+    pool = _get_pool(pv_name, pvParams(*pv_params), reset_biophys, n_cells=1)
+    with pool.borrow() as pv:
+        set_nav_frac(pv, frac, nav_loc, pool.base_nav)
+        amp, freq = stim
+        t, v, AP, x_df = get_trace(pv, amp, dur, stim_freq=freq,
+                                   shape_plot=shape_plot, solver=solver, init_state=init_state)
+        ap_series = ap_to_series(AP)
+    return ap_series, x_df
+
+
+def run_keys(pv_name, pv_params, key_params, dur, reset_biophys=reset_biophys, shape_plot=True, solver=LVARDT,
+             n_cells=None, init_state=None):
+    """Run many sweep keys, given as (stim, nav_loc, frac), on this process' cells in a single run (see `get_traces`).
+
+    `n_cells` is the size of this process' pool of cells (default: the number of keys), which is kept between calls.
+    A `solver` of None is `LVARDT` (see `run_key`). Returns a list of `run_key` results.
+    """
+    solver = LVARDT if solver is None else solver
+    pool = _get_pool(pv_name, pvParams(*pv_params), reset_biophys, n_cells=n_cells or len(key_params))
+    cells = [pool.acquire() for _ in key_params]
+    try:
+        for pv, (stim, nav_loc, frac) in zip(cells, key_params):
+            set_nav_frac(pv, frac, nav_loc, pool.base_nav)
+        traces = get_traces(cells, [stim for stim, _, _ in key_params], dur,
+                            shape_plot=shape_plot, solver=solver, init_state=init_state)
+        results = [(ap_to_series(AP), x_df) for t, v, AP, x_df in traces]
+    finally:
+        for pv in cells:
+            pool.release(pv)
+    return results
+
+
+def _timed_run_keys(key_names, *args, manifest=None, **kwargs):
+    # (wall clock) time of `run_keys` in the worker, without the time queued in the pool, and the worker's startup time
+    # (only with its first results)
+    global _startup_time
+    if manifest is not None:
+        # when the batch starts, rather than when it is queued (the manifest is safe to write from many processes)
+        manifest.set_running(key_names)
+    start = time.perf_counter()
+    with run_label(",".join(key_names)):
+        results = run_keys(*args, **kwargs)
+    startup_time, _startup_time = _startup_time, None
+    return time.perf_counter() - start, results, startup_time
+
+
+def _sweep_params(stim, nav_loc, frac, dur):
+    amp, freq = stim
+    return {
+        NAV_FRAC_LABEL: frac,
+        NAV_PERC_LABEL: perc_decrease(frac),
+        NAV_SECTIONS_LABEL: format_nav_loc(nav_loc),
+        CURRENT_LABEL: amp,
+        "Stim. duration": dur,
+        STIM_FREQ_LABEL: freq,
+    }
+
+
+def _result_entry(AP, x_df, stim, nav_loc, frac, dur):
+    return {
+        # AP times (e.g. `SPIKE_PLAN`) are kept as a Series
+        "df": LongView(x_df) if isinstance(x_df, pd.DataFrame) else x_df,
+        **_sweep_params(stim, nav_loc, frac, dur),
+        "APCount": AP
+    }
+
+
+def _store_meta(pv, stim, nav_loc, frac, dur):
+    pv_name, pv_params = get_pv_params(pv)
+    amp, freq = stim
+    return {"pv": pv_name,
+            **pv_params._asdict(),
+            "frac": frac,
+            "nav_loc": format_nav_loc(nav_loc),
+            "amp": amp,
+            "freq": freq,
+            "dur": dur}
+
+
+def _manifest_todo(manifest, sweep_keys, args):
+    # keys that aren't done, except those cached completely (e.g. before the manifest was used), which are set as done
+    manifest.add_sweep(sweep_keys, args)
+    store, cache_root = args["store"], args["cache_root"]
+    n_reset = manifest.reset_running()
+    if n_reset:
+        logger.info(f"{n_reset} keys of an interrupted sweep are pending again")
+    status = manifest.get_status([key_name for key_name, *_ in sweep_keys])
+    todo = []
+    for sweep_key in sweep_keys:
+        key_name = sweep_key[0]
+        if store is None:
+            # files that aren't done are checked, as an old version could have left them half-written
+            cached = (get_file_path(key_name, root=cache_root).exists() if status[key_name] == DONE
+                      else is_saved(key_name, cache_root=cache_root))
+            location = get_file_path(key_name, root=cache_root)
+        else:
+            cached = key_name in store
+            location = store.root
+        if not cached:
+            todo.append(sweep_key)
+        elif status[key_name] != DONE:
+            manifest.set_done([key_name], location)
+    return todo
+
+
+def run_sweep(pv, stims, nav_loc_changes, fractions, dur, reset_biophys=reset_biophys, shape_plot=True,
+              load=False, n_workers=None, mechanisms=None, cache_root=None, store=None, solver=None,
+              mp_context="spawn", batch_size=1, init_state=None, summary=None, manifest=None):
+    """Parallel version of `run_sims`.
+
+    Keys already in the cache are skipped. The rest are run on `n_workers` processes (default: number of CPUs).
+
+    Note that `reset_biophys` must be importable by the workers (e.g. defined in `pv_nrn.py`, like
+    `reset_biophys_pulse`) when using the (default) "spawn" `mp_context`.
+    `mechanisms` is passed to `init_nrn` (e.g. "nrnmech_def.dll" on Windows).
+    If a `store` (see `TraceStore`) is given, traces are saved there instead of to `.h5` files in the `cache_root`.
+    The `solver` (see `Solver`) is included in the key names (unless it is `CVODE`). The default (None) runs keys
+    with `LVARDT`, so that they don't depend on the other cells of a worker.
+    With `batch_size > 1`, each worker simulates that many keys at once (see `run_keys`), which needs a solver with
+    independent cells (default: `LVARDT`).
+    `init_state` is passed to `get_trace` (e.g. `partial(get_snapshot, warm_start=True)`, see `src.state`) and must be
+    importable by the workers.
+    With `shape_plot=SPIKE_PLAN` (see `RecordingPlan`), only AP times are recorded and saved.
+    If a `summary` (see `SummaryTable`) is given, the metrics of every key are added to it as they complete, and those
+    of keys in the cache that aren't in the `summary` yet are added from the cache.
+    If a `manifest` (see `SweepManifest`) is given, the status, timing and errors of every key are recorded there (so
+    that the sweep can be resumed, see `resume_sweep`). Keys that fail are then recorded and the rest of the sweep is
+    run before raising.
+
+    Returns a dict of results per key (as `run_sims`, but with a `LongView` as "df") if `load=True`, otherwise a dict
+    of AP counts per key.
+    """
+    solver = LVARDT if solver is None else get_solver(solver)
+    if batch_size > 1:
+        if solver.method not in ("lvardt", "fixed"):
+            raise ValueError(f"cells simulated together with '{solver.method}' are not independent, use 'lvardt' "
+                             f"or 'fixed'")
+    pv_name, pv_params = get_pv_params(pv)
+    sweep_keys = get_sweep_keys(pv, stims, nav_loc_changes, fractions, dur, solver=solver, init_state=init_state,
+                                shape_plot=shape_plot)
+    if manifest is not None:
+        todo = _manifest_todo(manifest, sweep_keys, dict(
+            pv_name=pv_name, pv_params=tuple(pv_params), stims=stims, nav_loc_changes=nav_loc_changes,
+            fractions=fractions, dur=dur, reset_biophys=reset_biophys, shape_plot=shape_plot, n_workers=n_workers,
+            mechanisms=mechanisms, cache_root=cache_root, store=store, solver=solver, mp_context=mp_context,
+            batch_size=batch_size, init_state=init_state, summary=summary))
+    elif store is None:
+        todo = [sweep_key for sweep_key in sweep_keys
+                if not get_file_path(sweep_key[0], root=cache_root).exists()]
+    else:
+        todo = [sweep_key for sweep_key in sweep_keys if sweep_key[0] not in store]
+    logger.info(f"{len(sweep_keys) - len(todo)}/{len(sweep_keys)} keys in cache")
+
+    global _last_sweep_stats
+    sweep_start = time.perf_counter()
+    results = {}
+    failed = []
+    startup_times = []
+    if len(todo):
+        batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+        n_workers = min(n_workers or os.cpu_count(), len(batches))
+        with ProcessPoolExecutor(n_workers,
+                                 mp_context=mp.get_context(mp_context),
+                                 initializer=_init_worker,
+                                 initargs=(mechanisms, time.time())) as pool:
+            futures = {pool.submit(_timed_run_keys, [key_name for key_name, *_ in batch], pv_name, pv_params,
+                                   [(stim, nav_loc, frac) for _, stim, nav_loc, frac in batch], dur,
+                                   reset_biophys=reset_biophys, shape_plot=shape_plot, solver=solver,
+                                   n_cells=batch_size, init_state=init_state, manifest=manifest): batch
+                       for batch in batches}
+            pbar = tqdm(total=len(todo))
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    duration, batch_results, startup_time = future.result()
+                except Exception as error:
+                    if manifest is None:
+                        raise
+                    logger.exception(f"keys {[key_name for key_name, *_ in batch]} failed")
+                    manifest.set_failed([key_name for key_name, *_ in batch], repr(error))
+                    failed += batch
+                    pbar.update(len(batch))
+                    continue
+                if startup_time is not None:
+                    startup_times.append(startup_time)
+                for (key_name, stim, nav_loc, frac), (ap_series, x_df) in zip(batch, batch_results):
+                    if store is None:
+                        with run_label(key_name):
+                            save_cached_df(key_name, ap_series, x_df,
+                                           cache_root=cache_root)
+                    else:
+                        store.save(key_name, x_df, ap_series,
+                                   **_store_meta(pv, stim, nav_loc, frac, dur))
+                    AP = _ap_series_to_ap(ap_series)
+                    if summary is not None:
+                        summary.add(key_name, x_df, AP, stim[1], dur, pv=pv_name,
+                                    **_sweep_params(stim, nav_loc, frac, dur))
+                    results[key_name] = _result_entry(AP, x_df, stim, nav_loc, frac, dur) if load else AP
+                    if manifest is not None:
+                        manifest.set_done([key_name], store.root if store is not None
+                                          else get_file_path(key_name, root=cache_root),
+                                          duration=duration/len(batch), started=time.time() - duration)
+                pbar.update(len(batch))
+            pbar.close()
+        if startup_times:
+            logger.info(f"worker startup: {np.mean(startup_times):.2f} s mean, {np.max(startup_times):.2f} s max "
+                        f"({len(startup_times)} workers)")
+    _last_sweep_stats = SweepStats(len(sweep_keys), len(todo), len(startup_times), time.perf_counter() - sweep_start,
+                                   startup_times)
+    if len(failed):
+        raise RuntimeError(f"{len(failed)}/{len(sweep_keys)} keys failed (see {manifest.path}), the rest are saved")
+
+    # keep the order of the sweep
+    ordered_results = {}
+    for key_name, stim, nav_loc, frac in sweep_keys:
+        if key_name not in results:
+            if store is None:
+                with run_label(key_name):
+                    AP, x_df = load_cached_df(key_name, cache_root=cache_root)
+            else:
+                AP, x_df = store.get_ap(key_name), store.load_df(key_name)
+            if summary is not None and key_name not in summary:
+                summary.add(key_name, x_df, AP, stim[1], dur, pv=pv_name,
+                            **_sweep_params(stim, nav_loc, frac, dur))
+            results[key_name] = _result_entry(AP, x_df, stim, nav_loc, frac, dur) if load else AP
+        ordered_results[key_name] = results[key_name]
+    return ordered_results
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    from pv_nrn import get_mechanisms_path
+    from src.run import CVODE, FIXED
+
+    mechanisms = get_mechanisms_path()
+    init_nrn(mechanisms)
+    # use the same cell as `run_key` (in this process)
+    pv = _get_pool("test_sweep", pvParams(1000., 33., 1., 26.5), reset_biophys).cells[0]
+    dur = 20
+    stims = [(0.75, 0)]
+    nav_loc_changes = ["ais", ("somatic", "nodes")]
+    fractions = [1, 0.5]
+
+    with tempfile.TemporaryDirectory() as cache_root:
+        results = run_sweep(pv, stims, nav_loc_changes, fractions, dur, load=True, n_workers=2,
+                            mechanisms=mechanisms, cache_root=cache_root)
+
+    # compare to serial, with the solver in the key names
+    pv_name, pv_params = get_pv_params(pv)
+    for key_name, stim, nav_loc, frac in get_sweep_keys(pv, stims, nav_loc_changes, fractions, dur):
+        assert key_name == get_key(pv, frac, nav_loc, stim, dur, solver=LVARDT) != get_key(pv, frac, nav_loc, stim,
+                                                                                           dur, solver=CVODE)
+        ap_series, x_df = run_key(pv_name, pv_params, stim, nav_loc, frac, dur)
+        assert np.allclose(wide_to_long(x_df)[VOLTAGE_LABEL].astype(float),
+                           results[key_name]["df"][VOLTAGE_LABEL].astype(float)), \
+            f"parallel and serial results differ for {key_name}"
+
+    # another (idle) cell in the process doesn't change a key's result
+    from pv_nrn import build_pv
+
+    other_pv = build_pv("test_sweep_other")
+    ap_series_other, x_df_other = run_key(pv_name, pv_params, stim, nav_loc, frac, dur)
+    assert np.array_equal(x_df_other.values, x_df.values), "expected the same result with another cell"
+
+    # keys simulated together (in one run per worker) are independent of each other
+    with tempfile.TemporaryDirectory() as cache_root:
+        batch_results = run_sweep(pv, stims, nav_loc_changes, fractions, dur, load=True, n_workers=2,
+                                  mechanisms=mechanisms, cache_root=cache_root, batch_size=2, solver=FIXED)
+    for key_name, stim, nav_loc, frac in get_sweep_keys(pv, stims, nav_loc_changes, fractions, dur, solver=FIXED):
+        ap_series, x_df = run_keys(pv_name, pv_params, [(stim, nav_loc, frac)], dur, solver=FIXED)[0]
+        assert np.allclose(x_df.values, batch_results[key_name]["df"].wide.values), \
+            f"batched and single results differ for {key_name}"
+
+    # summary metrics of new keys as they complete, and of cached keys
+    from src.summary import SummaryTable
+
+    with tempfile.TemporaryDirectory() as cache_root:
+        summary = SummaryTable(os.path.join(cache_root, "summary.csv"))
+        run_sweep(pv, stims, nav_loc_changes, fractions[:1], dur, n_workers=2, mechanisms=mechanisms,
+                  cache_root=cache_root, summary=summary)
+        assert len(summary) == len(nav_loc_changes)
+        os.remove(summary.path)
+        run_sweep(pv, stims, nav_loc_changes, fractions, dur, n_workers=2, mechanisms=mechanisms,
+                  cache_root=cache_root, summary=summary)
+        assert len(summary) == len(nav_loc_changes)*len(fractions)
+        assert set(summary.table[NAV_FRAC_LABEL]) == set(fractions)
@@ -5,10 +5,22 @@ import pandas as pd
 import numpy as np
 
 from src.constants import DISTANCE_LABEL, NAV_FRAC_LABEL, SECTION_LABEL
+from src.settings import STIM_ONSET
 
 
-def get_key(pv, frac, nav_loc, stim, dur):
-    return f"{pv.name}_{frac}_{nav_loc}_{stim}_{dur}"
+def get_key(pv, frac, nav_loc, stim, dur, solver=None):
+    key = f"{pv.name}_{frac}_{nav_loc}_{stim}_{dur}"
+    if solver is None:
+        # the solver a run would use (see `get_solver`, imported here as this module doesn't import NEURON), where
+        # CVODE (of a single cell) isn't in the key
+        from src.run import CVODE, get_solver
+
+        solver = get_solver(None)
+        solver = None if solver == CVODE else solver
+    if solver is not None:
+        # non-default solver (see `Solver` in run.py)
+        key = f"{key}_{tuple(solver) if not isinstance(solver, str) else solver}"
+    return key
 
 
 def format_nav_loc(nav_loc: str):
@@ -46,4 +58,36 @@ def nearest_value(arr, value):
 
 
 def get_last_sec(long_df):
+    if isinstance(long_df, pd.Series):
+        # AP times (see `SPIKE_PLAN`)
+        distances = long_df.index.get_level_values(DISTANCE_LABEL)
+        return long_df.index.get_level_values(SECTION_LABEL)[distances.argmax()]
+    # (imported here, so that importing this module doesn't import NEURON, e.g. in sweep workers)
+    from src.data import LongView
+
+    if isinstance(long_df, LongView):
+        long_df = long_df.wide
+    if isinstance(long_df.columns, pd.MultiIndex):
+        # wide (see `get_trace`)
+        distances = long_df.columns.get_level_values(DISTANCE_LABEL).astype(float)
+        return long_df.columns.get_level_values(SECTION_LABEL)[distances.argmax()]
     return long_df.loc[long_df[DISTANCE_LABEL].idxmax()][SECTION_LABEL]
+
+
+def get_pulse_times(frequency, duration):
+    """Return when the pulses occured"""
+    dt = 0.1
+    delay = STIM_ONSET  # ms
+
+    if frequency <= 0:
+        return delay
+
+    delay_idx = int(delay/dt)
+    x = np.round(np.arange(0, duration+dt+delay, dt), 2)
+
+    num = duration/1000 * frequency
+
+    x_mask = np.rint(np.linspace(0, duration, int(num+1)) /
+                     dt).astype(int) + delay_idx
+
+    return x[x_mask][:-1]
@@ -1,17 +1,27 @@
 import logging
 
+import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import seaborn as sns
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
 
 from src.constants import (AIS_LABEL, DISTANCE_LABEL, SITE_LABEL,
                            TERMINAL_LABEL, TIME_LABEL, VOLTAGE_LABEL)
-from src.data import concise_df, get_file_path, is_long_form, wide_to_long
+from src.data import (LongView, _concise_columns, _time_mask, concise_df, get_file_path, is_long_form, long_to_wide,
+                      wide_to_long)
 from src.settings import SECTION_PALETTE, STIM_ONSET, STIM_PULSE_DUR
+from src.utils import get_pulse_times  # noqa: F401 (was defined here)
 
 logger = logging.getLogger("vis")
 
+# dashes of the first levels of `style` (as seaborn's)
+_DASHES = ["", (4, 1.5), (1, 1), (3, 1.25, 1.5, 1.25), (5, 1, 1, 1)]
+# layers of more lines than this are rasterized (see `plot_voltage_lines`)
+RASTERIZE_LINES = 10
+
 
 def set_default_style():
     sns.set_theme(context="notebook",  # poster or paper
@@ -37,7 +47,13 @@ def plot_voltage_trace(df: pd.DataFrame,
                        offset=False,
                        edge=False,
                        ax_props: dict = None,
-                       ax=None, **kwargs):
+                       ax=None,
+                       backend="seaborn", **kwargs):
+    """Voltage of every segment over time, coloured by distance (or of the soma, AIS and terminal if `concise`).
+
+    With `backend="lines"`, traces are drawn from the wide voltage DataFrame (see `plot_voltage_lines`) instead of
+    with `sns.lineplot`, which is much faster for long or many traces.
+    """
     legend = kwargs.pop("legend", "brief")
     palette = kwargs.pop("palette", "Spectral")
     alpha = kwargs.pop("alpha", 0.5)
@@ -45,9 +61,25 @@ def plot_voltage_trace(df: pd.DataFrame,
     if ax is None:
         _, ax = plt.subplots()
 
+    if backend == "lines":
+        if concise and palette == "Spectral":
+            palette = SECTION_PALETTE
+            alpha = 1
+        xlim = None if ax_props is None else ax_props.get("xlim")
+        plot_voltage_lines(df, concise=concise, offset=offset, legend=legend, palette=palette, alpha=alpha,
+                           time=xlim, ax=ax, **kwargs)
+        return _finish_voltage_ax(ax, thresh, ax_props)
+    elif backend != "seaborn":
+        raise ValueError(f"unknown backend '{backend}', use 'seaborn' or 'lines'")
+
     hue = DISTANCE_LABEL
 
-    if not is_long_form(df):
+    if concise and not is_long_form(df):
+        # only melt the concise sites
+        df = LongView(df) if not isinstance(df, LongView) else df
+    elif isinstance(df, LongView):
+        df = df.to_frame()
+    elif not is_long_form(df):
         df = wide_to_long(df)
 
     if concise:
@@ -71,6 +103,10 @@ def plot_voltage_trace(df: pd.DataFrame,
                  ax=ax,
                  **kwargs)
 
+    return _finish_voltage_ax(ax, thresh, ax_props)
+
+
+def _finish_voltage_ax(ax, thresh, ax_props):
     if ax_props is not None:
         ax.set(**ax_props)
     if not isinstance(thresh, bool):
@@ -78,6 +114,114 @@ def plot_voltage_trace(df: pd.DataFrame,
     return ax
 
 
+def decimate_minmax(t, v, n_bins):
+    """Keep only the minimum and maximum (in time order) of every column of `v` (time x columns) in each of `n_bins`
+    bins of time points, so that peaks are kept when drawing with one bin per pixel.
+
+    Returns arrays of times and values, each (points x columns). Nothing is removed from fewer than `2*n_bins` points.
+    """
+    t = np.asarray(t, dtype=float)
+    v = np.asarray(v, dtype=float)
+    if v.ndim == 1:
+        v = v[:, np.newaxis]
+    n_t, n_cols = v.shape
+    if n_bins < 1 or n_t <= 2*n_bins:
+        return np.repeat(t[:, np.newaxis], n_cols, axis=1), v
+
+    n_per_bin = -(-n_t//n_bins)
+    n_bins = -(-n_t//n_per_bin)
+    # the last bin is padded with the last time point
+    padded = np.vstack([v, np.repeat(v[-1:], n_bins*n_per_bin - n_t, axis=0)])
+    binned = padded.reshape(n_bins, n_per_bin, n_cols)
+    i_min = binned.argmin(axis=1)
+    i_max = binned.argmax(axis=1)
+    rows = np.stack([np.minimum(i_min, i_max), np.maximum(i_min, i_max)], axis=1)
+    rows = np.minimum(rows + (np.arange(n_bins)*n_per_bin)[:, np.newaxis, np.newaxis], n_t - 1)
+    rows = rows.reshape(2*n_bins, n_cols)
+    return t[rows], v[rows, np.arange(n_cols)]
+
+
+def _group_mean(v, codes, n_levels):
+    # mean of the columns of `v` at each level (as seaborn's estimator for traces with the same hue)
+    if len(codes) == n_levels:
+        return v[:, np.argsort(codes)]
+    order = np.argsort(codes, kind="stable")
+    starts = np.searchsorted(codes[order], np.arange(n_levels))
+    return np.add.reduceat(v[:, order], starts, axis=1)/np.bincount(codes, minlength=n_levels)
+
+
+def plot_voltage_lines(df, concise=False, offset=False, legend="brief", palette="Spectral", alpha=0.5, time=None,
+                       ax=None, rasterized=None, **kwargs):
+    """Draw voltage traces (as `plot_voltage_trace`) as a `LineCollection` from the wide voltage DataFrame.
+
+    Each trace is reduced to the minimum and maximum in every pixel of the axes' width (see `decimate_minmax`), within
+    the `time` window (a start time or (start, end), e.g. the x limits). Layers of many lines (see `RASTERIZE_LINES`)
+    are rasterized unless `rasterized` is given. Other keyword arguments (e.g. `lw`, `zorder`) are passed to the
+    `LineCollection`.
+    """
+    if ax is None:
+        _, ax = plt.subplots()
+    if isinstance(df, LongView):
+        df = df.wide
+    elif is_long_form(df):
+        df = long_to_wide(df)
+    if time is not None:
+        df = df.loc[_time_mask(df.index.values, time)]
+
+    lw = kwargs.pop("lw", kwargs.pop("linewidth", mpl.rcParams["lines.linewidth"]))
+    style = kwargs.pop("style", SITE_LABEL if concise else None)
+    dashes = kwargs.pop("dashes", True)
+    v = df.values.astype(float)
+    if concise:
+        hue = SITE_LABEL
+        mask, sites = _concise_columns(df)
+        v = v[:, mask]
+        codes, levels = pd.factorize(pd.Index(sites))
+        v = _group_mean(v, codes, len(levels))
+        if offset:
+            v[:, levels.get_loc(TERMINAL_LABEL)] -= offset
+        colors = sns.color_palette(palette, n_colors=len(levels))
+        norm = cmap = None
+    else:
+        hue = DISTANCE_LABEL
+        codes, levels = pd.factorize(df.columns.get_level_values(DISTANCE_LABEL).astype(float), sort=True)
+        v = _group_mean(v, codes, len(levels))
+        norm = mpl.colors.Normalize(levels.min(), levels.max())
+        cmap = sns.color_palette(palette, as_cmap=True) if isinstance(palette, str) else mpl.colors.ListedColormap(
+            sns.color_palette(palette))
+        colors = cmap(norm(levels.values))
+    if style == hue and dashes:
+        linestyles = [(0, dash) if dash else "solid" for dash in np.resize(np.array(_DASHES, dtype=object), len(levels))]
+    else:
+        linestyles = ["solid"]*len(levels)
+
+    n_pixels = int(ax.get_window_extent().width)
+    t_lines, v_lines = decimate_minmax(df.index.values, v, n_pixels)
+    lines = LineCollection(np.stack([t_lines.T, v_lines.T], axis=-1), colors=colors, linewidths=lw,
+                           linestyles=linestyles, alpha=alpha,
+                           rasterized=len(levels) > RASTERIZE_LINES if rasterized is None else rasterized, **kwargs)
+    ax.add_collection(lines)
+    # "best" legend locations (as with seaborn) avoid lines, but not the paths of a `LineCollection`, so add invisible
+    # lines (of the envelope of many traces)
+    if v_lines.shape[1] > RASTERIZE_LINES:
+        t_lines, v_lines = t_lines[:, :2], np.stack([v_lines.min(axis=1), v_lines.max(axis=1)], axis=1)
+    ax.plot(t_lines, v_lines, visible=False)
+    ax.autoscale_view()
+    ax.set(xlabel=TIME_LABEL, ylabel=VOLTAGE_LABEL)
+
+    if legend:
+        if concise or legend == "full":
+            legend_levels, labels = levels, list(levels)
+        else:
+            legend_levels, labels = sns.utils.locator_to_legend_entries(mpl.ticker.MaxNLocator(nbins=6),
+                                                                        (levels.min(), levels.max()), float)
+        handles = [Line2D([], [], color=colors[i] if concise else cmap(norm(level)), lw=lw, alpha=alpha,
+                          linestyle=linestyles[i] if concise else "solid")
+                   for i, level in enumerate(legend_levels)]
+        ax.legend(handles, labels, title=hue)
+    return ax
+
+
 def get_pulse_xy(amp, frequency, duration):
     """Return 2 arrays of time and current amplitude, respectively"""
     dt = 0.1
@@ -103,34 +247,29 @@ def get_pulse_xy(amp, frequency, duration):
     return x[:-1], y[:-1]
 
 
-def get_pulse_times(frequency, duration):
-    """Return when the pulses occured"""
-    dt = 0.1
-    delay = STIM_ONSET  # ms
-
-    if frequency <= 0:
-        return delay
-
-    delay_idx = int(delay/dt)
-    x = np.round(np.arange(0, duration+dt+delay, dt), 2)
-
-    num = duration/1000 * frequency
-
-    x_mask = np.rint(np.linspace(0, duration, int(num+1)) /
-                     dt).astype(int) + delay_idx
-
-    return x[x_mask][:-1]
-
-
-def save_fig(name, formats=("png", "pdf"), fig=None):
+def save_fig(name, formats=("png", "pdf"), fig=None, root="save"):
     if fig is None:
         fig = plt.gcf()
     if not name.startswith("fig_"):
         name = f"fig_{name}"
     logger.info(f"saving {name}")
     name_len = len(name)
+    file_names = []
     for fmt in formats:
-        file_name = get_file_path(name, root="save", ext=fmt)
+        file_name = get_file_path(name, root=root, ext=fmt)
         logger.info("       " + " "*name_len + f" .{fmt}")
         fig.savefig(file_name, facecolor=fig.get_facecolor(), transparent=True)
+        file_names.append(file_name)
     logger.info(f"saved")
+    return file_names
+
+
+if __name__ == "__main__":
+    t = np.arange(0, 100, 0.025)
+    v = np.stack([np.sin(t), np.where(np.isclose(t, 42.), 40., -70.)], axis=1)
+    t_dec, v_dec = decimate_minmax(t, v, 100)
+    assert v_dec.shape == (200, 2)
+    assert np.array_equal(v_dec.max(axis=0), v.max(axis=0)) and np.array_equal(v_dec.min(axis=0), v.min(axis=0)), \
+        "expected peaks to be kept!"
+    assert np.all(np.diff(t_dec, axis=0) >= 0), "expected points in time order!"
+    assert decimate_minmax(t[:150], v[:150], 100)[1].shape == (150, 2)